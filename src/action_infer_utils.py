@@ -0,0 +1,163 @@
+import re
+import random
+import threading
+
+from src.action_utils import PetAction
+
+# --- 本地行为推断 ---
+# 大多数 Action Agent 的输出只是挑一个 EMOTION_SING_* 动画、给 mood/boredom 一点微调，
+# 不值得为每条消息再发一次补全。本地按词典与规则推断动画与数值，立即返回；
+# 只有用户输入里可能有需要记住的信息或关系变化时，才请求远程 Action Agent。
+
+# 动画 -> 关键词 (在桌宠回复中出现计 1 分，在用户输入中出现计 0.5 分)
+ANIMATE_LEXICON = {
+    "EMOTION_SING_HAPPY": ["哈哈", "嘿嘿", "开心", "高兴", "太好了", "好呀", "好耶", "棒", "加油", "嗯嗯", "~", "😊", "😄"],
+    "EMOTION_SING_ENJOY": ["喜欢", "舒服", "享受", "好吃", "真好", "幸福", "惬意", "美味", "好玩"],
+    "EMOTION_SING_BLUSH": ["害羞", "脸红", "讨厌啦", "人家", "才不是", "羞", "诶嘿", "被你发现", "///"],
+    "EMOTION_SING_SAD": ["难过", "伤心", "呜呜", "哭", "可惜", "失落", "寂寞", "孤单", "想你", "😢"],
+    "EMOTION_SING_ANGRY": ["生气", "哼", "气死", "可恶", "过分", "不理你", "讨厌你", "笨蛋", "😠"],
+    "EMOTION_SING_DISGUST": ["恶心", "好脏", "嫌弃", "咦", "臭", "不要碰", "走开"],
+    "EMOTION_SING_SORRY": ["对不起", "抱歉", "不好意思", "原谅", "我错了", "是我不好"],
+}
+ANIMATE_MIN_SCORE = 1.0
+
+# 情绪倾向 -> mood 调整 (与 Prompt 规则一致：对话愉快 +0.5~1，争吵 -2)
+POSITIVE_ANIMATIONS = {"EMOTION_SING_HAPPY", "EMOTION_SING_ENJOY", "EMOTION_SING_BLUSH"}
+NEGATIVE_ANIMATIONS = {"EMOTION_SING_ANGRY", "EMOTION_SING_DISGUST"}
+MOOD_PLEASANT = 0.5
+MOOD_QUARREL = -2.0
+MOOD_SAD = -0.5
+BOREDOM_ENGAGED = -0.5   # 用户认真聊天 (输入较长) 时降低无聊
+ENGAGED_INPUT_CHARS = 15
+TOUCH_LIMIT = 0.1        # 纯触摸互动的调整幅度上限
+
+# 可能需要写入长期记忆的用户输入 (自我介绍、偏好、重大事件、明确要求记住)
+MEMORY_CUES = re.compile(
+    r"我(?:叫|的名字|是(?!不是|说)|在.{0,8}(?:工作|上班|上学|读书)|(?:很|最|超|特别)?(?:喜欢|讨厌|爱吃|不吃|害怕)|养了|住在|今年|的生日)"
+    r"|记住|记得|别忘|生日|纪念日|考试|面试|毕业|入职|辞职|升职|结婚|分手|生病|住院|搬家|去世|出差|旅游"
+)
+# 可能触发关系变更的用户输入
+RELATIONSHIP_CUES = re.compile(
+    r"喜欢你|爱你|讨厌你|恨你|在一起|做我的|女朋友|男朋友|求婚|嫁给|娶你|绝交|再也不|永远|发誓|约定|原谅你|最好的朋友"
+)
+TOUCH_PREFIX = "*用户"  # 触摸 Prompt 的开头，见 pet_core.touch_prompt
+
+ACTION_AUDIT_RATE = 0.1  # 没有线索的回合里，按这个比例在后台请求远程 Agent 对照一致率
+MOOD_TOLERANCE = 0.2     # mood 调整在这个范围内视为 "不变"
+
+
+def _sign(value):
+    if value > MOOD_TOLERANCE:
+        return 1
+    if value < -MOOD_TOLERANCE:
+        return -1
+    return 0
+
+
+class LocalActionEngine:
+    """
+    词典 + 规则的本地行为推断。set_classifier 可以换上一个小模型：
+    classifier(user_input, text_reply) 返回 Action 字典 (或 None 表示交回规则)，结果同样经 PetAction 校验。
+    同时统计与远程 Action Agent 的一致率并打印出来。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.classifier = None
+        self.audit_rate = ACTION_AUDIT_RATE
+        self.stats = {"compared": 0, "animate": 0, "mood": 0,
+                      "flagged": 0, "flagged_used": 0, "audits": 0, "missed": 0}
+
+    def set_classifier(self, classifier):
+        self.classifier = classifier
+
+    @staticmethod
+    def is_touch(user_input, is_touch=False):
+        """调用方明确标记的触摸，或者看起来是触摸 Prompt 的输入"""
+        return is_touch or user_input.startswith(TOUCH_PREFIX)
+
+    def needs_remote(self, user_input, current_stats=None, is_touch=False):
+        """用户输入里可能有需要记住的信息或关系变化时，交给远程 Action Agent"""
+        if self.is_touch(user_input, is_touch) or user_input.startswith("("):  # 触摸与系统触发不入记忆
+            return False
+        return bool(MEMORY_CUES.search(user_input) or RELATIONSHIP_CUES.search(user_input))
+
+    def should_audit(self):
+        return random.random() < self.audit_rate
+
+    def _score_animations(self, user_input, text_reply):
+        scores = {}
+        for name, words in ANIMATE_LEXICON.items():
+            score = sum(text_reply.count(w) for w in words) + 0.5 * sum(user_input.count(w) for w in words)
+            if score:
+                scores[name] = score
+        return scores
+
+    @staticmethod
+    def _clamp_touch(adjust):
+        return {k: max(-TOUCH_LIMIT, min(TOUCH_LIMIT, v)) for k, v in adjust.items()}
+
+    def infer(self, user_input, text_reply, current_stats=None, is_touch=False):
+        """立即给出表现层的 PetAction (动画与数值)，不含记忆与关系"""
+        touch = self.is_touch(user_input, is_touch)
+        if self.classifier:
+            try:
+                data = self.classifier(user_input, text_reply)
+                if data is not None:
+                    action = PetAction.from_dict(data).presentation()
+                    if touch:
+                        action.adjust = self._clamp_touch(action.adjust)
+                    return action
+            except Exception as e:
+                print(f"[LocalAction] Classifier error, falling back to rules: {e}")
+
+        scores = self._score_animations(user_input, text_reply)
+        animate = max(scores, key=scores.get) if scores and max(scores.values()) >= ANIMATE_MIN_SCORE else None
+
+        adjust = {}
+        if animate in POSITIVE_ANIMATIONS:
+            adjust["mood"] = MOOD_PLEASANT
+        elif animate in NEGATIVE_ANIMATIONS:
+            adjust["mood"] = MOOD_QUARREL
+        elif animate == "EMOTION_SING_SAD":
+            adjust["mood"] = MOOD_SAD
+
+        if touch:
+            adjust = self._clamp_touch(adjust)
+        elif len(user_input) >= ENGAGED_INPUT_CHARS:
+            adjust["boredom"] = BOREDOM_ENGAGED
+        return PetAction(animate, adjust)
+
+    def compare(self, local, remote, flagged):
+        """
+        对照一次本地推断与远程 Action Agent 的结果。
+        flagged: 本地判断需要远程 (否则是抽样对照)；用来统计记忆线索的命中与漏判。
+        """
+        remote_needed = bool(remote.memorize or remote.update_relationship)
+        with self._lock:
+            s = self.stats
+            s["compared"] += 1
+            s["animate"] += local.animate == remote.animate
+            s["mood"] += _sign(local.adjust.get("mood", 0)) == _sign(remote.adjust.get("mood", 0))
+            if flagged:
+                s["flagged"] += 1
+                s["flagged_used"] += remote_needed
+            else:
+                s["audits"] += 1
+                s["missed"] += remote_needed
+            n = s["compared"]
+            print(f"[LocalAction] Agreement with remote: animate {s['animate']}/{n} ({s['animate'] / n:.0%}), "
+                  f"mood {s['mood']}/{n} ({s['mood'] / n:.0%}); "
+                  f"cues used {s['flagged_used']}/{s['flagged']}, missed memories {s['missed']}/{s['audits']} audits")
+
+    def agreement(self):
+        """动画一致率，还没有对照样本时返回 None"""
+        with self._lock:
+            n = self.stats["compared"]
+            return self.stats["animate"] / n if n else None
+
+
+_engine = LocalActionEngine()
+
+
+def get_action_engine():
+    return _engine
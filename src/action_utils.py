@@ -0,0 +1,258 @@
+import re
+import json
+
+from src.parameters import ANIMATION_PATH
+
+# --- 行为指令 (Action) ---
+# Persona / Action Agent / 编程模式输出的行为指令统一解析成 PetAction：
+#   - 支持 JSON Schema 的服务商：Action Agent 直接输出 JSON (response_format)
+#   - 其他情况：模型把 JSON 包在 <ACTION>...</ACTION> 里，可能夹在流式文本中
+# 两种输出都由 TagStreamParser 逐块解析，JSON 由 load_json 宽松读取，最后经 PetAction 校验。
+
+CONTROL_TAGS = ("ACTION", "REASONING", "EXIT")
+
+# 各数值单次调整的范围，超出的截断 (与 Prompt 中的工程规则一致)
+ADJUST_LIMITS = {
+    "mood": (-5.0, 5.0),
+    "boredom": (-5.0, 5.0),
+    "fatigue": (-5.0, 5.0),
+    "capability": (-1.0, 1.0),
+    "intimacy": (-0.1, 0.05),
+}
+
+ACTION_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "animate": {"type": "string", "enum": sorted(n for n in vars(ANIMATION_PATH) if n.startswith("EMOTION_SING_"))},
+        "adjust": {
+            "type": "object",
+            "properties": {key: {"type": "number"} for key in ADJUST_LIMITS},
+            "additionalProperties": False,
+        },
+        "memorize": {"type": "string"},
+        "update_relationship": {"type": "string"},
+    },
+    "additionalProperties": False,
+}
+
+# OpenAI 兼容接口的结构化输出参数
+ACTION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "pet_action", "schema": ACTION_JSON_SCHEMA, "strict": False},
+}
+
+
+def _as_object(data):
+    return data if isinstance(data, dict) else None
+
+
+def load_json(text):
+    """
+    宽松地读取模型输出的 JSON 对象。先按原样解析，失败后依次尝试：
+    去掉 ``` 围栏、从第一个 { 开始读出一个完整对象 (忽略其后的杂质)、删除多余的尾逗号、
+    补齐被截断的右括号。读不出来时返回 None 并打印原文，而不是静默丢弃。
+    """
+    if not text or not text.strip():
+        return None
+    text = text.strip()
+    try:
+        return _as_object(json.loads(text))
+    except json.JSONDecodeError:
+        pass
+
+    text = re.sub(r'^```(?:json)?\s*|\s*```$', '', text)
+    start = text.find("{")
+    if start < 0:
+        print(f"[Action] No JSON object in: {text[:80]!r}")
+        return None
+    body = text[start:]
+    try:
+        return _as_object(json.JSONDecoder().raw_decode(body)[0])
+    except json.JSONDecodeError:
+        pass
+
+    body = re.sub(r',\s*([\]}])', r'\1', body[:body.rfind("}") + 1] if "}" in body else body)
+    candidates = [body]
+    missing = body.count("{") - body.count("}")
+    if missing > 0:
+        candidates.append(body.rstrip().rstrip(",") + "}" * missing)  # 输出被截断
+    for candidate in candidates:
+        try:
+            return _as_object(json.JSONDecoder().raw_decode(candidate)[0])
+        except json.JSONDecodeError:
+            continue
+    print(f"[Action] Unparseable JSON: {text[:80]!r}")
+    return None
+
+
+class TagStreamParser:
+    """
+    增量解析夹带控制标签的输出：每次 feed 一段新文本，返回目前为止可以显示的文本。
+    标签块 (<ACTION> / <REASONING> / <EXIT>) 的内容单独收集，不会出现在可见文本里；
+    末尾半个标签 (例如 "<ACT") 先扣住，等下一段到来再判断。
+    """
+    def __init__(self, tags=CONTROL_TAGS):
+        self.tags = tags
+        self.text_parts = []
+        self.blocks = {}   # tag -> 内容
+        self._tag = None   # 当前所在的标签块
+        self._pending = ""
+
+    def feed(self, delta):
+        data = self._pending + (delta or "")
+        self._pending = ""
+        i = 0
+        while i < len(data):
+            if self._tag is None:
+                j = data.find("<", i)
+                if j < 0:
+                    self.text_parts.append(data[i:])
+                    break
+                self.text_parts.append(data[i:j])
+                rest = data[j:]
+                opened = next((t for t in self.tags if rest.startswith(f"<{t}>")), None)
+                if opened:
+                    self._tag = opened
+                    self.blocks.setdefault(opened, "")
+                    i = j + len(opened) + 2
+                elif any(f"<{t}>".startswith(rest) for t in self.tags):
+                    self._pending = rest  # 可能是半个开始标签
+                    break
+                else:
+                    self.text_parts.append("<")
+                    i = j + 1
+            else:
+                close = f"</{self._tag}>"
+                j = data.find(close, i)
+                if j < 0:
+                    tail = data[i:]
+                    keep = next((n for n in range(min(len(close) - 1, len(tail)), 0, -1)
+                                 if close.startswith(tail[-n:])), 0)
+                    self.blocks[self._tag] += tail[:len(tail) - keep]
+                    self._pending = tail[len(tail) - keep:]
+                    break
+                self.blocks[self._tag] += data[i:j]
+                self._tag = None
+                i = j + len(close)
+        return self.visible_text()
+
+    def finish(self):
+        """输出结束：扣住的半个标签其实不是标签，放回可见文本 (或未闭合的标签块)。返回最终可见文本"""
+        if self._pending:
+            if self._tag is None:
+                self.text_parts.append(self._pending)
+            else:
+                self.blocks[self._tag] += self._pending
+            self._pending = ""
+        return self.visible_text()
+
+    def visible_text(self):
+        return "".join(self.text_parts).strip()
+
+    def block(self, tag):
+        """标签块的内容 (没有闭合的也算)，没有出现过返回 None"""
+        return self.blocks.get(tag)
+
+    def action(self):
+        """
+        解析出的 PetAction。没有 <ACTION> 块但整段就是 JSON 时 (结构化输出)，按整段解析。
+        """
+        raw = self.block("ACTION")
+        if raw is None:
+            text = re.sub(r'^```(?:json)?\s*', '', self.visible_text())
+            if not text.startswith("{"):
+                return PetAction()
+            raw = text
+        return PetAction.from_dict(load_json(raw))
+
+
+def split_reply(raw):
+    """一次性解析完整输出，返回 (可见文本, PetAction)"""
+    parser = TagStreamParser()
+    parser.feed(raw)
+    return parser.finish(), parser.action()
+
+
+def parse_tag_json(raw, tag):
+    """读取完整输出中某个标签块的 JSON，没有或读不出来返回 {}"""
+    parser = TagStreamParser()
+    parser.feed(raw)
+    parser.finish()
+    block = parser.block(tag)
+    return (load_json(block) or {}) if block is not None else {}
+
+
+class PetAction:
+    """
+    校验过的行为指令。不认识的字段、不存在的动画、不允许调整的数值都会被丢弃并打印出来；
+    调整幅度截断到 ADJUST_LIMITS。跨线程信号里传 to_dict() 的结果。
+    """
+    def __init__(self, animate=None, adjust=None, memorize="", update_relationship=""):
+        self.animate = animate
+        self.adjust = adjust or {}
+        self.memorize = memorize
+        self.update_relationship = update_relationship
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, PetAction):
+            return data
+        if not isinstance(data, dict):
+            return cls()
+        dropped = [k for k in data if k not in ("animate", "adjust", "memorize", "update_relationship")]
+
+        animate = data.get("animate")
+        if animate is not None and not (isinstance(animate, str) and hasattr(ANIMATION_PATH, animate)):
+            dropped.append(f"animate={animate!r}")
+            animate = None
+
+        adjust = {}
+        raw_adjust = data.get("adjust") or {}
+        if not isinstance(raw_adjust, dict):
+            dropped.append("adjust")
+            raw_adjust = {}
+        for key, value in raw_adjust.items():
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                dropped.append(f"adjust.{key}")
+                continue
+            if key not in ADJUST_LIMITS:
+                dropped.append(f"adjust.{key}")
+                continue
+            low, high = ADJUST_LIMITS[key]
+            adjust[key] = max(low, min(high, value))
+
+        def text_field(name):
+            value = data.get(name) or ""
+            if not isinstance(value, str):
+                dropped.append(name)
+                return ""
+            return value.strip()
+
+        action = cls(animate, adjust, text_field("memorize"), text_field("update_relationship"))
+        if dropped:
+            print(f"[Action] Dropped invalid fields: {', '.join(dropped)}")
+        return action
+
+    def to_dict(self):
+        data = {}
+        if self.animate:
+            data["animate"] = self.animate
+        if self.adjust:
+            data["adjust"] = dict(self.adjust)
+        if self.memorize:
+            data["memorize"] = self.memorize
+        if self.update_relationship:
+            data["update_relationship"] = self.update_relationship
+        return data
+
+    def presentation(self):
+        """只保留表现层 (动画与数值)，用于缓存回放与主动搭话"""
+        return PetAction(self.animate, dict(self.adjust))
+
+    def __bool__(self):
+        return bool(self.to_dict())
+
+    def __repr__(self):
+        return f"PetAction({self.to_dict()})"
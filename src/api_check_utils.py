@@ -0,0 +1,106 @@
+import time
+import asyncio
+
+from src.memory_utils import MemoryManager
+from src.backend_utils import get_llm_client, current_backend
+
+MODEL_LIST_TTL = 6 * 3600  # 模型列表缓存有效期 (秒)
+PROBE_TIMEOUT = 15.0       # 单项检测的超时 (秒)
+PROBES = ("connection", "chat", "coder")
+PROBE_LABELS = {"connection": "连接", "chat": "Chat", "coder": "Coder"}
+
+
+class ModelListCache:
+    """
+    各后端 + Base URL 可用的模型列表，落盘缓存 MODEL_LIST_TTL 秒，供模型输入框自动补全。
+    按 (后端, Base URL) 分开存放，模拟后端的模型名不会混进真实线路的列表。
+    """
+    def __init__(self, memory_manager=None):
+        self.memory_manager = memory_manager or MemoryManager()
+
+    @staticmethod
+    def _key(base_url, backend=None):
+        url = (base_url or "").strip().rstrip("/") or "(default)"
+        return f"{backend or current_backend()}|{url}"
+
+    def get(self, base_url, allow_stale=False, backend=None):
+        """返回缓存的模型列表；过期或没有时返回 None (allow_stale=True 时过期的也返回)"""
+        entry = self.memory_manager.load_model_cache().get(self._key(base_url, backend))
+        if not entry:
+            return None
+        if not allow_stale and time.time() - entry.get("updated", 0) > MODEL_LIST_TTL:
+            return None
+        return entry.get("models", [])
+
+    def is_stale(self, base_url, backend=None):
+        """没有缓存或已经过期，需要重新获取"""
+        return self.get(base_url, backend=backend) is None
+
+    def put(self, base_url, models, backend=None):
+        entries = self.memory_manager.load_model_cache()
+        entries[self._key(base_url, backend)] = {"updated": time.time(), "models": sorted(models)}
+        self.memory_manager.save_model_cache(entries)
+
+
+def describe_error(e, model_name=""):
+    error_msg = str(e)
+    if "401" in error_msg:
+        return "401 Unauthorized (Key错误)"
+    if "404" in error_msg:
+        return f"404: 模型 '{model_name}' 不存在"
+    if isinstance(e, ValueError):
+        return error_msg
+    if isinstance(e, asyncio.TimeoutError):
+        return "超时"
+    if "proxy" in error_msg.lower() or "connect" in error_msg.lower():
+        return "代理连接失败"
+    return f"错误: {error_msg[:30]}..."
+
+
+async def _probe(client, probe, chat_model, coder_model, cached_models=None):
+    """执行一项检测，返回 (结果文本, 新获取的模型列表或 None)。cached_models: 仍然有效的缓存，直接复用"""
+    if probe == "connection":
+        if cached_models is not None:
+            return f"模型数 {len(cached_models)} (缓存)", None
+        models = await client.models.list()
+        ids = [m.id for m in models.data]
+        return f"模型数 {len(ids)}", ids
+    model = chat_model if probe == "chat" else coder_model
+    if not model:
+        raise ValueError("未填写模型")
+    content = "Hi" if probe == "chat" else "print('hello')"
+    await client.chat.completions.create(model=model, messages=[{"role": "user", "content": content}], max_tokens=5)
+    return f"'{model}' 可用", None
+
+
+async def run_api_checks(api_key, base_url, proxy_url, http2, chat_model, coder_model,
+                         probes=PROBES, backend=None, cache=None, refresh_models=True):
+    """
+    在同一个共享客户端上并发执行各项检测，每项单独计时。
+    返回 [{"probe", "ok", "message", "latency_ms"}]，顺序与 probes 相同；
+    连接检测拿到的模型列表写入 cache。refresh_models=False 时，缓存仍然有效就不再重新获取
+    (同时检测 Chat / Coder 时它们已经验证了连通性)。
+    """
+    backend = backend or current_backend()
+    client = get_llm_client(api_key, base_url, proxy_url, http2, backend=backend)
+    cached_models = None
+    if cache is not None and not refresh_models:
+        cached_models = cache.get(base_url, backend=backend)
+
+    async def timed(probe):
+        start = time.monotonic()
+        try:
+            message, models = await asyncio.wait_for(
+                _probe(client, probe, chat_model, coder_model, cached_models), PROBE_TIMEOUT)
+            if models is not None and cache is not None:
+                cache.put(base_url, models, backend=backend)
+            ok = True
+        except Exception as e:
+            message = describe_error(e, chat_model if probe == "chat" else coder_model)
+            ok = False
+        return {"probe": probe, "ok": ok, "message": message,
+                "latency_ms": (time.monotonic() - start) * 1000}
+
+    if client is None:
+        return [{"probe": p, "ok": False, "message": "错误: 未安装 openai 库", "latency_ms": 0.0} for p in probes]
+    return list(await asyncio.gather(*(timed(p) for p in probes)))
@@ -0,0 +1,236 @@
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import threading
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.http_utils import get_async_openai_client
+from src.prompts import WITH_ACTION_RULE
+from src.token_utils import count_message_tokens, count_tokens
+
+# --- LLM 后端 ---
+# 各客户端只用到 OpenAI 异步客户端的一小部分接口：
+#   await client.chat.completions.create(model, messages, temperature, stream=False, stream_options=None)
+# 非流式返回 .choices[0].message.content 与 .usage；流式返回异步迭代器，块中带 .choices[0].delta.content，
+# 最后一块带 .usage。三种后端都提供这套接口：
+#   "openai": 真实的 OpenAI 兼容接口
+#   "stub":   进程内的确定性模拟，按脚本回复并附带 <ACTION>，可配置延迟，不需要网络和 API Key
+#   "local":  在本机启动一个说 OpenAI 协议的模拟服务器，走完整的 HTTP 链路
+BACKENDS = ("openai", "stub", "local")
+
+STUB_SCRIPT = {
+    "chat": [
+        "嗯嗯，我在听呢！",
+        "诶嘿，被你发现啦~",
+        "今天也要加油哦！",
+        "唔……让我想想。",
+        "好呀好呀，就这么办！",
+    ],
+    "action": {"animate": "EMOTION_SING_HAPPY", "adjust": {"mood": 0.1}},
+    "coder": "好的，这是一个示例实现：\n```python\ndef hello():\n    print(\"hello\")\n```",
+    "summary": "我和用户聊了一会儿，用户今天心情不错。",
+    "goodbye": "拜拜，下次见哦~",
+}
+
+_backend = "openai"
+_stub_latency = 0.3       # 首字前的等待 (秒)
+_stub_token_delay = 0.02  # 流式输出每块之间的间隔 (秒)
+_local_server = None
+_local_lock = threading.Lock()
+
+
+def configure_backend(settings):
+    global _backend, _stub_latency, _stub_token_delay
+    backend = settings.get("llm_backend", "openai")
+    _backend = backend if backend in BACKENDS else "openai"
+    _stub_latency = settings.get("stub_latency", _stub_latency)
+    _stub_token_delay = settings.get("stub_token_delay", _stub_token_delay)
+
+
+def current_backend():
+    return _backend
+
+
+def requires_api_key():
+    """只有真实后端需要 API Key"""
+    return _backend == "openai"
+
+
+def get_llm_client(api_key, base_url, proxy_url=None, http2=False, backend=None):
+    """按当前后端 (或指定的 backend) 返回客户端；真实后端下与 get_async_openai_client 相同"""
+    backend = backend or _backend
+    if backend == "stub":
+        return StubClient()
+    if backend == "local":
+        return get_async_openai_client("local-stub", start_local_server(), None, False)
+    return get_async_openai_client(api_key, base_url, proxy_url, http2)
+
+
+# --- 脚本回复 ---
+def _pick(options, messages):
+    """按最后一条消息的内容确定性地挑选，相同输入总是相同回复"""
+    last = (messages[-1].get("content") or "") if messages else ""
+    index = int(hashlib.md5(last.encode("utf-8")).hexdigest(), 16) % len(options)
+    return options[index]
+
+
+def _action_block():
+    return f"<ACTION>\n{json.dumps(STUB_SCRIPT['action'], ensure_ascii=False)}\n</ACTION>"
+
+
+def stub_reply(messages, structured=False):
+    """根据 Prompt 的类型给出脚本化的回复 (structured: 请求带 JSON Schema 时直接返回 JSON)"""
+    prompt = "\n".join(m.get("content") or "" for m in messages)
+    if "后台逻辑Agent" in prompt:
+        return json.dumps(STUB_SCRIPT["action"], ensure_ascii=False) if structured else _action_block()
+    if "<EXIT>" in prompt:
+        result = {"goodbye": STUB_SCRIPT["goodbye"], "summary": STUB_SCRIPT["summary"],
+                  "memorize": "", "update_relationship": ""}
+        return f"<EXIT>\n{json.dumps(result, ensure_ascii=False)}\n</EXIT>"
+    if "用户准备离开了" in prompt:
+        return STUB_SCRIPT["goodbye"]
+    if "编程协作模式" in prompt:
+        return STUB_SCRIPT["coder"]
+    if "总结为简短摘要" in prompt or "压缩成简短的要点" in prompt:
+        return STUB_SCRIPT["summary"]
+    text = _pick(STUB_SCRIPT["chat"], messages)
+    if WITH_ACTION_RULE in prompt or "<ACTION>...</ACTION> 块" in prompt:
+        return f"{text}\n{_action_block()}"
+    return text
+
+
+def stub_usage(model, messages, reply):
+    prompt_tokens = count_message_tokens(messages, model)
+    completion_tokens = count_tokens(reply, model)
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                           total_tokens=prompt_tokens + completion_tokens,
+                           prompt_tokens_details=SimpleNamespace(cached_tokens=0))
+
+
+def _chunks(text, size=4):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+# --- 进程内模拟后端 ---
+class _StubCompletions:
+    async def create(self, model, messages, temperature=None, stream=False, stream_options=None,
+                     response_format=None, **kwargs):
+        reply = stub_reply(messages, structured=bool(response_format))
+        usage = stub_usage(model, messages, reply)
+        await asyncio.sleep(_stub_latency)
+        if stream:
+            return self._stream(reply, usage if stream_options and stream_options.get("include_usage") else None)
+        message = SimpleNamespace(role="assistant", content=reply)
+        return SimpleNamespace(model=model, choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")],
+                               usage=usage)
+
+    async def _stream(self, reply, usage):
+        for piece in _chunks(reply):
+            yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=piece))], usage=None)
+            await asyncio.sleep(_stub_token_delay)
+        if usage:
+            yield SimpleNamespace(choices=[], usage=usage)
+
+
+class _StubModels:
+    async def list(self):
+        await asyncio.sleep(_stub_latency)
+        return SimpleNamespace(data=[SimpleNamespace(id="stub", object="model", owned_by="local")])
+
+
+class StubClient:
+    """确定性的模拟客户端，接口与 AsyncOpenAI 的 chat.completions / models 部分一致"""
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=_StubCompletions())
+        self.models = _StubModels()
+
+
+# --- 本地模拟服务器 ---
+class _StubHandler(BaseHTTPRequestHandler):
+    """只实现 /v1/models 与 /v1/chat/completions (含 SSE 流式)"""
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json({"object": "list", "data": [{"id": "stub", "object": "model", "owned_by": "local"}]})
+        else:
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json({"error": {"message": "not found"}}, 404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = request.get("model", "stub")
+        messages = request.get("messages", [])
+        reply = stub_reply(messages, structured=bool(request.get("response_format")))
+        usage = vars(stub_usage(model, messages, reply))
+        usage["prompt_tokens_details"] = {"cached_tokens": 0}
+        time.sleep(_stub_latency)
+
+        created = int(time.time())
+        if not request.get("stream"):
+            self._send_json({"id": "chatcmpl-stub", "object": "chat.completion", "created": created, "model": model,
+                             "choices": [{"index": 0, "message": {"role": "assistant", "content": reply},
+                                          "finish_reason": "stop"}],
+                             "usage": usage})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def send_event(data):
+            self.wfile.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        base = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model}
+        for piece in _chunks(reply):
+            send_event({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+            time.sleep(_stub_token_delay)
+        send_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send_event({**base, "choices": [], "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def start_local_server(host="127.0.0.1", port=0):
+    """启动 (或复用) 本地模拟服务器，返回它的 base_url"""
+    global _local_server
+    with _local_lock:
+        if _local_server is None:
+            _local_server = ThreadingHTTPServer((host, port), _StubHandler)
+            _local_server.daemon_threads = True
+            threading.Thread(target=_local_server.serve_forever, name="LocalStubServer", daemon=True).start()
+            print(f"[Backend] Local stub server on http://{host}:{_local_server.server_port}/v1")
+        return f"http://{host}:{_local_server.server_port}/v1"
+
+
+if __name__ == "__main__":
+    # 单独运行：python -m src.backend_utils --port 8765，然后把 Base URL 指向 http://127.0.0.1:8765/v1
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的本地模拟服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=_stub_latency)
+    parser.add_argument("--token-delay", type=float, default=_stub_token_delay)
+    args = parser.parse_args()
+    configure_backend({"stub_latency": args.latency, "stub_token_delay": args.token_delay})
+    start_local_server(args.host, args.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
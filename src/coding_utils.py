@@ -1,12 +1,18 @@
 import html
 import re
 import uuid
-import json
 from PyQt6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, QTextBrowser,
                              QPushButton, QSplitter, QLabel, QFrame, QSizeGrip, QApplication)
-from PyQt6.QtCore import Qt, pyqtSignal, QThread, QRegularExpression, QUrl
+from PyQt6.QtCore import Qt, pyqtSignal, QRegularExpression, QUrl
 from PyQt6.QtGui import QFont, QTextCursor, QColor, QPalette, QSyntaxHighlighter, QTextCharFormat, QTextBlockFormat, QDesktopServices
 
+try:
+    from src.pet_workers import CoderWorker
+    from src.action_utils import split_reply
+except ImportError:
+    from pet_workers import CoderWorker
+    from action_utils import split_reply
+
 # --- 1. Geek 语法高亮器 (用于输入框) ---
 class GeekHighlighter(QSyntaxHighlighter):
     def __init__(self, parent=None):
@@ -125,23 +131,7 @@ def highlight_code_html(code_text):
         
     return "".join(result)
 
-# --- 3. 后台工作线程 ---
-class CoderWorker(QThread):
-    reply_signal = pyqtSignal(str, dict)
-
-    def __init__(self, client, text, stats, persona):
-        super().__init__()
-        self.client = client
-        self.text = text
-        self.stats = stats
-        self.persona = persona
-
-    def run(self):
-        if self.client:
-            reply, action = self.client.chat(self.text, self.stats, self.persona)
-            self.reply_signal.emit(reply, action)
-
-# --- 4. 编程窗口主类 ---
+# --- 3. 编程窗口主类 ---
 class CodingWindow(QWidget):
     action_signal = pyqtSignal(dict) 
 
@@ -227,6 +217,15 @@ class CodingWindow(QWidget):
                 font-weight: bold;
             }
             QPushButton#send_btn:hover { background-color: #1177bb; }
+            QPushButton#stop_btn {
+                background-color: #a1260d;
+                color: white;
+                border: none;
+                border-radius: 4px;
+                font-family: 'Segoe UI', sans-serif;
+                font-weight: bold;
+            }
+            QPushButton#stop_btn:hover { background-color: #c72e0f; }
         """)
 
         main_layout = QVBoxLayout(self)
@@ -252,7 +251,7 @@ class CodingWindow(QWidget):
         self.close_btn = QPushButton("×")
         self.close_btn.setObjectName("close_btn")
         self.close_btn.setFixedSize(30, 30)
-        self.close_btn.clicked.connect(self.hide)
+        self.close_btn.clicked.connect(self.close_window)
 
         title_layout.addWidget(self.header_label)
         title_layout.addStretch()
@@ -282,7 +281,7 @@ class CodingWindow(QWidget):
         self.input_field = QTextEdit()
         self.input_field.setObjectName("input_field")
         self.input_field.setAcceptRichText(False) 
-        self.input_field.setPlaceholderText("# 输入代码或指令... (Ctrl+Enter 发送)")
+        self.input_field.setPlaceholderText("# 输入代码或指令... (Ctrl+Enter 发送，/coder 或 /chat 开头指定模型)")
         
         self.highlighter = GeekHighlighter(self.input_field.document())
 
@@ -292,8 +291,16 @@ class CodingWindow(QWidget):
         self.send_btn.setCursor(Qt.CursorShape.PointingHandCursor)
         self.send_btn.clicked.connect(self.send_message)
 
+        self.stop_btn = QPushButton("STOP")
+        self.stop_btn.setObjectName("stop_btn")
+        self.stop_btn.setFixedSize(90, 40)
+        self.stop_btn.setCursor(Qt.CursorShape.PointingHandCursor)
+        self.stop_btn.clicked.connect(self.cancel_request)
+        self.stop_btn.hide()
+
         input_layout.addWidget(self.input_field)
         input_layout.addWidget(self.send_btn, 0, Qt.AlignmentFlag.AlignBottom)
+        input_layout.addWidget(self.stop_btn, 0, Qt.AlignmentFlag.AlignBottom)
         
         self.splitter.addWidget(input_container)
         self.splitter.setStretchFactor(0, 7)
@@ -304,7 +311,10 @@ class CodingWindow(QWidget):
 
         # 底部手柄
         bottom_bar = QHBoxLayout()
-        bottom_bar.setContentsMargins(0, 0, 5, 5)
+        bottom_bar.setContentsMargins(10, 0, 5, 5)
+        self.status_label = QLabel("")
+        self.status_label.setStyleSheet("color: #6a9955; font-family: Consolas; font-size: 11px;")
+        bottom_bar.addWidget(self.status_label)
         bottom_bar.addStretch()
         size_grip = QSizeGrip(self.main_frame)
         bottom_bar.addWidget(size_grip)
@@ -348,6 +358,23 @@ class CodingWindow(QWidget):
             if found: break
         if found: self.render_all_history()
 
+    def close_window(self):
+        """关闭窗口时中止未完成的请求，不再让结果晚到"""
+        self.cancel_request()
+        self.hide()
+
+    def cancel_request(self):
+        """中止正在进行的请求 (连同底层 HTTP 连接)"""
+        if not self.is_processing:
+            return
+        if self.worker:
+            self.worker.cancel()
+        self.worker = None
+        self.is_processing = False
+        self.stop_btn.hide()
+        self.send_btn.show()
+        self.append_system_message("Request interrupted.")
+
     def start_session(self):
         self.show()
         if not self.history:
@@ -367,23 +394,27 @@ class CodingWindow(QWidget):
         
         stats = self.get_stats()
         persona = self.get_persona()
-        self.worker = CoderWorker(self.client, text, stats, persona)
+        # 开场招呼不需要 Coder 模型
+        self.worker = CoderWorker(self.client, text, stats, persona, role="chat" if is_system else None)
         self.worker.reply_signal.connect(self.handle_reply)
+        self.worker.status_signal.connect(self.set_status)
         self.worker.start()
+        self.send_btn.hide()
+        self.stop_btn.show()
+
+    def set_status(self, text):
+        """底部状态栏"""
+        self.status_label.setText(text)
 
     def handle_reply(self, reply, action):
+        if self.sender() is not self.worker:
+            return  # 已中止的请求
         self.is_processing = False
-        # 再次清理，确保 UI 不显示标签
-        reply = re.sub(r'<REASONING>.*?</REASONING>', '', reply, flags=re.DOTALL).strip()
-        
-        # 尝试提取动作
-        match = re.search(r'<ACTION>(.*?)</ACTION>', reply, re.DOTALL)
-        if match:
-            if not action:
-                try:
-                    action = json.loads(match.group(1).strip())
-                except: pass
-            reply = reply.replace(match.group(0), "").strip()
+        self.stop_btn.hide()
+        self.send_btn.show()
+        # 再次清理，确保 UI 不显示标签 (CoderClient 已经解析过动作，这里只兜底)
+        reply, parsed = split_reply(reply)
+        action = action or parsed.to_dict()
 
         self.append_ai_message(reply)
         if action: self.action_signal.emit(action)
@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+try:
+    from openai import AsyncOpenAI
+    import httpx
+except ImportError:
+    AsyncOpenAI = None
+    httpx = None
+
+# HTTP/2 需要额外安装 h2 (pip install httpx[http2])，没有时自动退回 HTTP/1.1
+try:
+    import h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# --- 进程级共享连接池 ---
+# LLMClient / CoderClient / 设置界面的检测与代理测试都在 LLMEngine 的事件循环上，共用同一批 httpx 连接，
+# 只有 base_url 或代理真正变化时才新建，保存设置不会丢掉已建立的 keep-alive 连接和 TLS 会话。
+_lock = threading.Lock()
+_async_http_clients = {}    # (base_url, proxy_url, http2) -> httpx.AsyncClient
+_async_openai_clients = OrderedDict()  # (base_url, proxy_url, http2, api_key) -> AsyncOpenAI，按最近使用排序
+# AsyncOpenAI 按 api_key 区分，换 Key 或在设置界面检测别的 Key 都会新建一个；只保留最近用过的几个。
+# 它们不持有连接 (连接池属于上面共享的 httpx 客户端)，丢弃时不需要关闭，仍在使用的实例也不受影响。
+MAX_OPENAI_CLIENTS = 8
+
+DEFAULT_TIMEOUT = 60.0
+CONNECT_TIMEOUT = 10.0
+
+
+def _normalize(base_url, proxy_url):
+    base_url = (base_url or "").strip().rstrip("/")
+    proxy_url = (proxy_url or "").strip() or None
+    return base_url, proxy_url
+
+
+def _new_http_client(proxy_url, http2):
+    return httpx.AsyncClient(
+        proxy=proxy_url,
+        http2=http2,
+        timeout=httpx.Timeout(DEFAULT_TIMEOUT, connect=CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120.0),
+    )
+
+
+def get_async_http_client(base_url=None, proxy_url=None, http2=False):
+    """获取（必要时创建）共享的 httpx 异步客户端，带连接池与 keep-alive"""
+    if not httpx:
+        return None
+    base_url, proxy_url = _normalize(base_url, proxy_url)
+    http2 = bool(http2) and HTTP2_AVAILABLE
+    key = (base_url, proxy_url, http2)
+
+    with _lock:
+        client = _async_http_clients.get(key)
+        if client is None or client.is_closed:
+            client = _new_http_client(proxy_url, http2)
+            _async_http_clients[key] = client
+            print(f"[HTTP] New async transport: {base_url or '(direct)'} proxy={proxy_url} http2={http2}")
+        return client
+
+
+def get_async_openai_client(api_key, base_url, proxy_url=None, http2=False):
+    """获取共享连接池之上的 AsyncOpenAI 客户端，相同配置返回同一个实例"""
+    if not AsyncOpenAI:
+        return None
+    base_url, proxy_url = _normalize(base_url, proxy_url)
+    http2 = bool(http2) and HTTP2_AVAILABLE
+    key = (base_url, proxy_url, http2, api_key)
+
+    with _lock:
+        client = _async_openai_clients.get(key)
+        if client is not None:
+            _async_openai_clients.move_to_end(key)
+            return client
+
+    client = AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url or None,
+        http_client=get_async_http_client(base_url, proxy_url, http2),
+        max_retries=0,  # 429 等重试交给 LLMScheduler，SDK 内部重试会绕过限速
+    )
+    with _lock:
+        client = _async_openai_clients.setdefault(key, client)
+        _async_openai_clients.move_to_end(key)
+        while len(_async_openai_clients) > MAX_OPENAI_CLIENTS:
+            _async_openai_clients.popitem(last=False)
+        return client
+
+
+async def aclose_all():
+    """关闭所有异步连接，需要在 LLMEngine 的事件循环中执行"""
+    with _lock:
+        clients = list(_async_http_clients.values())
+        _async_http_clients.clear()
+        _async_openai_clients.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception:
+            pass
+
@@ -0,0 +1,120 @@
+import time
+import asyncio
+import threading
+
+from src.memory_utils import MemoryManager
+from src.llm_scheduler import request_priority, PRIORITY_BACKGROUND
+
+MAX_JOB_ATTEMPTS = 5  # 反复失败 (或反复在执行中崩溃) 这么多次后放弃
+JOB_CONCURRENCY = 1   # 同时执行的后台任务数
+
+
+class JobQueue:
+    """
+    持久化的后台任务队列 (data/jobs.json)：会话总结等任务先写盘再执行，成功后才删除，
+    进程中途退出的任务下次启动时继续。
+    - 同一个 key 只保留一份，后写入的覆盖先写入的，崩溃重启不会让任务越积越多
+    - 每次执行前先把尝试次数写盘，超过 MAX_JOB_ATTEMPTS 次就丢弃
+    - 任务在 LLMEngine 的事件循环上执行，不占用 UI 线程
+    """
+    def __init__(self, memory_manager=None):
+        self.memory_manager = memory_manager or MemoryManager()
+        self._lock = threading.Lock()
+        self.jobs = self.memory_manager.load_jobs()  # key -> {"kind", "payload", "attempts", "created"}
+        self.handlers = {}    # kind -> async handler(payload)
+        self.held = set()     # 本进程内还在积累的任务 (例如当前会话)，暂不执行
+        self.running = set()
+        self._semaphore = None
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def _save(self):
+        self.memory_manager.save_jobs(self.jobs)
+
+    def put(self, kind, key, payload, hold=False):
+        """写入 (或覆盖) 一个任务。hold=True 表示暂不执行，但进程意外退出后下次启动会执行"""
+        with self._lock:
+            old = self.jobs.get(key)
+            self.jobs[key] = {"kind": kind, "payload": payload,
+                              "attempts": old["attempts"] if old else 0,
+                              "created": old["created"] if old else time.time()}
+            if hold:
+                self.held.add(key)
+            else:
+                self.held.discard(key)
+            self._save()
+
+    def complete(self, key):
+        with self._lock:
+            self.held.discard(key)
+            if self.jobs.pop(key, None) is not None:
+                self._save()
+
+    def pending(self):
+        with self._lock:
+            return [key for key in self.jobs if key not in self.held and key not in self.running]
+
+    async def run_pending(self):
+        """执行所有待办任务 (并发数不超过 JOB_CONCURRENCY)"""
+        keys = self.pending()
+        if keys:
+            await asyncio.gather(*(self.run(key) for key in keys))
+
+    async def run(self, key):
+        """执行一个任务，成功返回 True；失败的任务留在队列里等下次"""
+        token = request_priority.set(PRIORITY_BACKGROUND)
+        try:
+            return await self._run(key)
+        finally:
+            request_priority.reset(token)  # 调用方 (例如结束会话) 接下来的请求恢复原来的优先级
+
+    async def _run(self, key):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(JOB_CONCURRENCY)
+        async with self._semaphore:
+            with self._lock:
+                job = self.jobs.get(key)
+                if job is None or key in self.running or key in self.held:
+                    return False
+                handler = self.handlers.get(job["kind"])
+                if handler is None:
+                    return False
+                job["attempts"] += 1
+                if job["attempts"] > MAX_JOB_ATTEMPTS:
+                    del self.jobs[key]
+                    self._save()
+                    print(f"[Jobs] Dropped {key} after {MAX_JOB_ATTEMPTS} attempts")
+                    return False
+                self.running.add(key)
+                self._save()
+
+            try:
+                await handler(job["payload"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[Jobs] {key} failed (attempt {job['attempts']}/{MAX_JOB_ATTEMPTS}): {e}")
+                return False
+            finally:
+                self.running.discard(key)
+
+            with self._lock:
+                # 执行期间被新内容覆盖的任务保留，下次再执行
+                if self.jobs.get(key) is job:
+                    del self.jobs[key]
+                    self._save()
+            print(f"[Jobs] Completed {key}")
+            return True
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
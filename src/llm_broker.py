@@ -0,0 +1,491 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import secrets
+import argparse
+import itertools
+import threading
+import subprocess
+import concurrent.futures
+from multiprocessing.connection import Listener, Client
+
+from src.llm_scheduler import request_priority, PRIORITY_USER
+
+# --- LLM Broker 进程 ---
+# 可选：把 LLMClient / CoderClient 放进一个独立的子进程 (python -m src.llm_broker)，
+# 网络 I/O、Prompt 组装、JSON 解码与正则后处理都在子进程里完成，界面进程只负责渲染。
+# 两个进程之间走本机 socket (multiprocessing.connection，带随机 authkey)，每条消息是一个 JSON：
+#   请求: {"id", "target": "chat"/"coder", "method", "args", "kwargs", "stream", "priority"}
+#   取消: {"cancel": id}          退出: {"shutdown": 等待秒数}
+#   回复: {"id", "delta": 文本} (流式) / {"id", "result", "stats"} / {"id", "error"}
+#   统计: {"stats": true} -> {"stats": 快照} (设置界面的排队数与线路排名)
+#   回复与统计都带上 {"state": {target: {方法名: 值}}}，界面线程直接读这份缓存
+# 子进程崩溃时进行中的调用以错误结束，并在后台线程上重新拉起子进程，界面线程从不等待启动。
+
+BROKER_KEY_ENV = "VPET_BROKER_KEY"
+BROKER_READY_PREFIX = "BROKER_PORT "
+BROKER_START_TIMEOUT = 30.0  # 等待子进程就绪 (导入 openai 等) 的秒数
+BROKER_CALL_TIMEOUT = 10.0   # 同步调用 (update_config 等) 的超时
+BROKER_UI_TIMEOUT = 0.5      # 界面线程上需要等结果的查询 (peek_response) 的超时，超时按默认值处理
+BROKER_RESTART_DELAY = 10.0  # 后台重启失败后，至少隔这么多秒再试
+
+# 界面线程频繁查询的无参方法：子进程在每条回复里带上最新值，界面进程直接读缓存，不做同步往返
+CACHED_STATE = ("is_ready", "needs_warm_up", "has_pending_jobs", "session_length")
+
+# 界面线程上调用、不需要返回值的方法：只发送请求不等待，失败时打印错误
+FIRE_AND_FORGET = ("remember_active_message", "remember_goodbye")
+
+# 界面线程上调用的同步方法：Broker 不可用时打印错误并返回这里的默认值，而不是抛出异常
+# (Qt 槽函数里未捕获的异常会让整个程序退出)。其余方法失败时抛出异常，由调用方 (LLMTask) 处理。
+UI_SAFE_DEFAULTS = {
+    "is_ready": False,
+    "needs_warm_up": False,
+    "has_pending_jobs": False,
+    "session_length": 0,
+    "peek_response": None,
+    "update_config": None,
+}
+
+
+def _encode(message):
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _public_methods(obj):
+    """可以远程调用的方法：{方法名: 是否为协程}"""
+    methods = {}
+    for name in dir(obj):
+        if name.startswith("_"):
+            continue
+        attr = getattr(obj, name, None)
+        if callable(attr) and not isinstance(attr, type):
+            methods[name] = asyncio.iscoroutinefunction(attr)
+    return methods
+
+
+def _stats_snapshot():
+    """
+    带回界面进程的统计：Token 用量、首条回复延迟、本地动作一致率，
+    以及只存在于子进程中的调度器排队数与线路排名。
+    """
+    from src.vlm_utils import usage_snapshot
+    from src.action_infer_utils import get_action_engine
+    from src.llm_router import get_router
+    from src.llm_scheduler import get_scheduler
+    return {"usage": usage_snapshot(), "actions": dict(get_action_engine().stats),
+            "queue": get_scheduler().queue_depth(), "ranking": get_router().ranking()}
+
+
+# --- 子进程端 ---
+class BrokerServer:
+    """在子进程中持有真正的 LLMClient / CoderClient，按请求调用它们的方法"""
+    def __init__(self, conn):
+        from src.vlm_utils import LLMClient, CoderClient
+        self.conn = conn
+        self.targets = {"chat": LLMClient(), "coder": CoderClient()}
+        self.methods = {name: _public_methods(target) for name, target in self.targets.items()}
+        self.tasks = {}
+        self.shutdown_timeout = 0.0
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        with self._send_lock:
+            try:
+                self.conn.send_bytes(_encode(message))
+            except (OSError, EOFError):
+                pass  # 界面进程已经退出
+
+    def run(self):
+        asyncio.run(self._main())
+
+    def _state(self):
+        """CACHED_STATE 中各客户端实际拥有的方法的当前值"""
+        return {target: {name: getattr(client, name)() for name in CACHED_STATE
+                         if self.methods[target].get(name) is False}
+                for target, client in self.targets.items()}
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.send({"ready": self.methods, "state": self._state()})
+        threading.Thread(target=self._reader, name="BrokerReader", daemon=True).start()
+        await self.stopped.wait()
+        await self._drain(self.shutdown_timeout)
+
+    def _reader(self):
+        while True:
+            try:
+                message = json.loads(self.conn.recv_bytes())
+            except (EOFError, OSError):
+                message = {"shutdown": 0.0}  # 界面进程断开，不再等待
+            self.loop.call_soon_threadsafe(self._dispatch, message)
+            if "shutdown" in message:
+                return
+
+    def _dispatch(self, message):
+        if "stats" in message:
+            self.send({"stats": _stats_snapshot(), "state": self._state()})
+            return
+        if "shutdown" in message:
+            self.shutdown_timeout = message["shutdown"]
+            self.stopped.set()
+            return
+        if "cancel" in message:
+            task = self.tasks.get(message["cancel"])
+            if task:
+                task.cancel()
+            return
+
+        request_id, target, method = message["id"], message.get("target"), message.get("method")
+        if method not in self.methods.get(target, {}):
+            self.send({"id": request_id, "error": f"Unknown method {target}.{method}"})
+            return
+        func = getattr(self.targets[target], method)
+        args, kwargs = message.get("args") or [], message.get("kwargs") or {}
+        if message.get("stream"):
+            kwargs["on_delta"] = lambda text: self.send({"id": request_id, "delta": text})
+
+        if self.methods[target][method]:
+            self.tasks[request_id] = self.loop.create_task(
+                self._run(request_id, func, args, kwargs, message.get("priority", PRIORITY_USER)))
+            return
+        try:
+            self._reply(request_id, func(*args, **kwargs))
+        except Exception as e:
+            self.send({"id": request_id, "error": f"{type(e).__name__}: {e}"})
+
+    async def _run(self, request_id, func, args, kwargs, priority):
+        request_priority.set(priority)
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            return  # 界面进程已经放弃这次调用
+        except Exception as e:
+            self.send({"id": request_id, "error": f"{type(e).__name__}: {e}", "state": self._state()})
+            return
+        finally:
+            self.tasks.pop(request_id, None)
+        self._reply(request_id, result)
+
+    def _reply(self, request_id, result):
+        self.send({"id": request_id, "result": result, "stats": _stats_snapshot(), "state": self._state()})
+
+    async def _drain(self, timeout):
+        """退出前等待未完成的调用 (例如退出时的总结)，然后关闭连接池"""
+        from src.http_utils import aclose_all
+        current = asyncio.current_task()
+        tasks = [t for t in asyncio.all_tasks() if t is not current]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout) if timeout > 0 else (None, tasks)
+            for task in pending:
+                task.cancel()
+        await aclose_all()
+
+
+def serve(host="127.0.0.1", port=0):
+    """子进程入口：监听本机端口，把端口号告诉父进程，只接受一个连接"""
+    authkey = bytes.fromhex(os.environ.pop(BROKER_KEY_ENV))
+    with Listener((host, port), authkey=authkey) as listener:
+        print(f"{BROKER_READY_PREFIX}{listener.address[1]}", flush=True)
+        conn = listener.accept()
+    BrokerServer(conn).run()
+
+
+# --- 界面进程端 ---
+class LLMBroker:
+    """
+    管理 Broker 子进程：启动、转发调用、崩溃后在后台重启、退出时等待收尾。
+    异步调用在 LLMEngine 的事件循环上等待结果 (需要重启时在线程池里等)；
+    界面线程上的查询读 state 缓存，子进程不在时立即返回默认值。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.process = None
+        self.conn = None
+        self.methods = {}
+        self.pending = {}  # id -> (concurrent.futures.Future, on_delta)
+        self.remote_stats = None  # 子进程最近一次带回的统计
+        self.state = {}  # 子进程最近一次带回的 CACHED_STATE 值：{target: {方法名: 值}}
+        self.closing = False
+        self._next_restart = 0.0
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None and self.conn is not None
+
+    def start(self):
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        authkey = secrets.token_bytes(16)
+        env = dict(os.environ)
+        env[BROKER_KEY_ENV] = authkey.hex()
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [project_root, env.get("PYTHONPATH")]))
+        self.process = subprocess.Popen([sys.executable, "-u", "-m", "src.llm_broker"], env=env,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        text=True, encoding="utf-8", errors="replace")
+        port = self._wait_for_port()
+        try:
+            conn = Client(("127.0.0.1", port), authkey=authkey)
+            if not conn.poll(BROKER_START_TIMEOUT):
+                raise TimeoutError("LLM broker did not become ready")
+            ready = json.loads(conn.recv_bytes())
+        except Exception:
+            self.process.kill()
+            raise
+        self.methods, self.state = ready["ready"], ready.get("state") or {}
+        self.conn = conn
+        threading.Thread(target=self._reader, args=(conn,), name="BrokerClient", daemon=True).start()
+        print(f"[Broker] Started (pid {self.process.pid})")
+
+    def _wait_for_port(self):
+        """读取子进程输出直到拿到端口号；之后的输出转发到本进程的终端"""
+        result = concurrent.futures.Future()
+        process = self.process
+
+        def forward():
+            for line in process.stdout:
+                if not result.done() and line.startswith(BROKER_READY_PREFIX):
+                    result.set_result(int(line[len(BROKER_READY_PREFIX):]))
+                    continue
+                print(f"[Broker] {line.rstrip()}")
+            if not result.done():
+                result.set_exception(RuntimeError("LLM broker exited during startup"))
+
+        threading.Thread(target=forward, name="BrokerLog", daemon=True).start()
+        try:
+            return result.result(BROKER_START_TIMEOUT)
+        except Exception:
+            process.kill()
+            raise
+
+    def _ensure_started(self):
+        with self._lock:
+            if self.closing:
+                raise ConnectionError("LLM broker is shut down")
+            if not self.alive():
+                if self.process is not None:
+                    print("[Broker] Restarting")
+                self.start()
+
+    def restart_in_background(self):
+        """子进程不在时在后台线程上重启，立即返回；正在重启或刚失败过时什么也不做"""
+        if self.closing or self._lock.locked() or time.time() < self._next_restart:
+            return
+        threading.Thread(target=self._restart, name="BrokerRestart", daemon=True).start()
+
+    def _restart(self):
+        try:
+            self._ensure_started()
+        except Exception as e:
+            self._next_restart = time.time() + BROKER_RESTART_DELAY
+            print(f"[Broker] Restart failed: {e}")
+
+    def _send(self, message):
+        with self._send_lock:
+            self.conn.send_bytes(_encode(message))
+
+    def _reader(self, conn):
+        while True:
+            try:
+                message = json.loads(conn.recv_bytes())
+            except (EOFError, OSError):
+                break
+            if "state" in message:
+                self.state = message["state"]
+            if "stats" in message:
+                self._apply_stats(message["stats"])
+            entry = self.pending.get(message.get("id"))
+            if entry is None:
+                continue
+            future, on_delta = entry
+            if "delta" in message:
+                if on_delta:
+                    on_delta(message["delta"])
+                continue
+            self.pending.pop(message["id"], None)
+            if future.done():
+                continue
+            if "error" in message:
+                future.set_exception(RuntimeError(message["error"]))
+            else:
+                future.set_result(message.get("result"))
+
+        # 子进程退出或崩溃：进行中的调用全部以错误结束，缓存的状态作废，然后在后台重启
+        if conn is self.conn:
+            self.conn = None
+            self.state = {}
+            for future, _ in list(self.pending.values()):
+                if not future.done():
+                    future.set_exception(ConnectionError("LLM broker exited"))
+            self.pending.clear()
+            if self.process is not None and self.process.poll() is not None:
+                print(f"[Broker] Exited with code {self.process.returncode}")
+            self.restart_in_background()
+
+    def _apply_stats(self, stats):
+        from src.vlm_utils import apply_usage_snapshot
+        from src.action_infer_utils import get_action_engine
+        apply_usage_snapshot(stats.get("usage") or {})
+        get_action_engine().stats.update(stats.get("actions") or {})
+        self.remote_stats = stats
+
+    def refresh_stats(self):
+        """请求一份最新的统计 (不等待，结果到达后更新 remote_stats)"""
+        if self.alive():
+            try:
+                self._send({"stats": True})
+            except OSError:
+                pass
+
+    def _request(self, target, method, args, kwargs, on_delta=None):
+        request_id = next(self._ids)
+        future = concurrent.futures.Future()
+        self.pending[request_id] = (future, on_delta)
+        self._send({"id": request_id, "target": target, "method": method, "args": list(args), "kwargs": kwargs,
+                    "stream": on_delta is not None, "priority": request_priority.get()})
+        return request_id, future
+
+    async def call(self, target, method, args, kwargs):
+        """异步调用：在调用方的事件循环上等待；被取消时通知子进程一并取消"""
+        kwargs = dict(kwargs)
+        on_delta = kwargs.pop("on_delta", None)
+        if not self.alive():
+            await asyncio.to_thread(self._ensure_started)  # 重启可能要几十秒，不占用事件循环
+        request_id, future = self._request(target, method, args, kwargs, on_delta)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            self.pending.pop(request_id, None)
+            if self.alive():
+                self._send({"cancel": request_id})
+            raise
+
+    def _require_alive(self):
+        """同步调用不等待启动：子进程不在时安排后台重启并立即失败"""
+        if not self.alive():
+            self.restart_in_background()
+            raise ConnectionError("LLM broker is not running")
+
+    def call_sync(self, target, method, args, kwargs, timeout=BROKER_CALL_TIMEOUT):
+        self._require_alive()
+        request_id, future = self._request(target, method, args, kwargs)
+        try:
+            return future.result(timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def notify(self, target, method, args, kwargs):
+        """发送请求但不等待结果，失败时只打印错误"""
+        self._require_alive()
+        _, future = self._request(target, method, args, kwargs)
+
+        def report(done):
+            if done.exception() is not None:
+                print(f"[Broker] {target}.{method} failed: {done.exception()}")
+
+        future.add_done_callback(report)
+
+    def cached(self, target, name):
+        """CACHED_STATE 中的方法：返回子进程最近带回的值；子进程不在时安排后台重启并返回默认值"""
+        if not self.alive():
+            self.restart_in_background()
+            return UI_SAFE_DEFAULTS[name]
+        return self.state.get(target, {}).get(name, UI_SAFE_DEFAULTS[name])
+
+    def client(self, target):
+        self._ensure_started()
+        return RemoteClient(self, target)
+
+    def shutdown(self, timeout=5.0):
+        """让子进程等待未完成的调用 (最多 timeout 秒) 后退出，之后不再重启"""
+        self.closing = True
+        if self.process is None:
+            return
+        if self.alive():
+            try:
+                self._send({"shutdown": timeout})
+            except OSError:
+                pass
+        try:
+            self.process.wait(timeout + 2.0)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.process = None
+
+
+class RemoteClient:
+    """
+    LLMClient / CoderClient 在界面进程中的替身：方法调用转发给 Broker 子进程。
+    只支持方法，不支持直接读写属性。CACHED_STATE 中的方法读缓存，FIRE_AND_FORGET 中的方法不等待结果；
+    其余同步方法失败时抛出异常，UI_SAFE_DEFAULTS 中的方法 (界面线程上调用) 则打印错误并返回默认值。
+    """
+    def __init__(self, broker, target):
+        self._broker = broker
+        self._target = target
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        is_async = self._broker.methods.get(self._target, {}).get(name)
+        if is_async is None:
+            raise AttributeError(f"{self._target} client has no remote method '{name}'")
+        broker, target = self._broker, self._target
+        if is_async:
+            async def method(*args, **kwargs):
+                return await broker.call(target, name, args, kwargs)
+        else:
+            def method(*args, **kwargs):
+                if name in CACHED_STATE and not args and not kwargs:
+                    return broker.cached(target, name)
+                try:
+                    if name in FIRE_AND_FORGET:
+                        return broker.notify(target, name, args, kwargs)
+                    timeout = BROKER_UI_TIMEOUT if name == "peek_response" else BROKER_CALL_TIMEOUT
+                    return broker.call_sync(target, name, args, kwargs, timeout)
+                except Exception as e:
+                    if name not in UI_SAFE_DEFAULTS and name not in FIRE_AND_FORGET:
+                        raise
+                    print(f"[Broker] {target}.{name} failed: {e}")
+                    return UI_SAFE_DEFAULTS.get(name)
+        return method
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """启动 (或复用) Broker 子进程"""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = LLMBroker()
+        return _broker
+
+
+def get_remote_stats():
+    """
+    Broker 模式下子进程的统计 (排队数 "queue"、线路排名 "ranking" 等)，顺便请求下一份；
+    没有启用 Broker 或还没有收到时返回 None，调用方改用本进程的调度器与路由。
+    """
+    if _broker is None:
+        return None
+    _broker.refresh_stats()
+    return _broker.remote_stats
+
+
+def shutdown_broker(timeout=5.0):
+    """退出时调用；没有启用 Broker 时什么也不做"""
+    if _broker is not None:
+        _broker.shutdown(timeout)
+
+
+if __name__ == "__main__":
+    # 由 LLMBroker.start 拉起，authkey 通过环境变量传入
+    parser = argparse.ArgumentParser(description="VPetLM 的 LLM Broker 子进程")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+    serve(args.host, args.port)
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+
+from src.http_utils import aclose_all
+
+
+class LLMEngine:
+    """
+    进程内唯一的 asyncio 事件循环，运行在一个独立线程上。
+    所有 LLM 调用都以协程的形式提交到这里，可以并发执行，也可以随时取消，
+    不再为每个请求创建一个 QThread。
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="LLMEngine", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance.is_running():
+                cls._instance = cls()
+            return cls._instance
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def is_running(self):
+        return self._thread.is_alive() and not self.loop.is_closed()
+
+    def submit(self, coro):
+        """提交协程，返回 concurrent.futures.Future（可 cancel()）"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_sync(self, coro, timeout=None):
+        """阻塞等待协程结果（仅用于退出等必须同步的场合）"""
+        return self.submit(coro).result(timeout)
+
+    def pending_count(self):
+        """当前仍在运行的 LLM 调用数"""
+        tasks = asyncio.all_tasks(self.loop) if self.is_running() else set()
+        return len(tasks)
+
+    async def _drain(self, timeout):
+        current = asyncio.current_task()
+        tasks = [t for t in asyncio.all_tasks() if t is not current]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        await aclose_all()
+
+    def shutdown(self, timeout=5.0):
+        """等待未完成的调用（最多 timeout 秒，例如退出时的总结），然后停止事件循环"""
+        if not self.is_running():
+            return
+        try:
+            self.run_sync(self._drain(timeout), timeout + 2.0)
+        except Exception as e:
+            print(f"[LLMEngine] Shutdown error: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=2.0)
+
+
+def get_engine():
+    return LLMEngine.instance()
@@ -0,0 +1,188 @@
+import time
+import random
+import asyncio
+import threading
+
+from src.backend_utils import get_llm_client
+from src.llm_scheduler import _is_transient
+
+EWMA_ALPHA = 0.3           # 滚动平均中新样本的权重
+DEFAULT_LATENCY = 0.0      # 还没有样本的线路视为最快，先试一次才知道
+FAILURES_TO_COOLDOWN = 3   # 连续失败几次后暂停使用
+BASE_COOLDOWN = 30.0       # 第一次暂停的秒数，再次失败时翻倍
+MAX_COOLDOWN = 300.0
+REJOIN_STEP = 0.25         # 恢复期每次成功增加的流量比例
+
+
+class Endpoint:
+    """一条线路 (base_url + api_key) 及其滚动统计"""
+    def __init__(self, name, base_url, api_key, models):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.models = models  # {"chat": 模型名, "coder": 模型名}
+        self.latency = None   # 非流式调用的滚动平均耗时 (秒)
+        self.first_token = None  # 流式调用的滚动平均首字延迟 (秒)，整段读取耗时取决于回复长度，不可比
+        self.error_rate = 0.0
+        self.failures = 0     # 连续失败次数
+        self.cooldown = 0.0
+        self.cooldown_until = 0.0
+        self.trust = 1.0      # 恢复期逐步提高，1.0 表示完全恢复
+
+    def key(self):
+        return (self.base_url, self.api_key)
+
+    def model_for(self, role):
+        return self.models.get(role)
+
+    def cooling(self, now):
+        return now < self.cooldown_until
+
+    def score(self, stream=False):
+        """越小越好：耗时 (流式调用看首字延迟) 按错误率加权；对应的样本还没有时参考另一种"""
+        first, second = (self.first_token, self.latency) if stream else (self.latency, self.first_token)
+        latency = first if first is not None else second
+        latency = DEFAULT_LATENCY if latency is None else latency
+        return latency * (1 + 4 * self.error_rate)
+
+    def status(self, now):
+        if self.cooling(now):
+            return f"暂停 {self.cooldown_until - now:.0f}s"
+        if self.trust < 1.0:
+            return f"恢复中 {self.trust * 100:.0f}%"
+        return "正常"
+
+
+class ProviderRouter:
+    """
+    多线路路由：为每次调用 (persona / action / summary / coder) 选择最快的健康线路。
+    连续失败的线路暂停一段时间；恢复后先只分到一部分流量，成功后逐步加回。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = []
+        self.proxy_url = None
+        self.http2 = False
+
+    def configure(self, settings):
+        """主线路 (base_url / api_key / 模型) + settings["providers"] 中的额外线路；未变化的线路保留统计"""
+        endpoints = [Endpoint("默认", settings.get("base_url", ""), settings.get("api_key", ""),
+                              {"chat": settings.get("model_name", ""), "coder": settings.get("coder_model_name", "")})]
+        for index, provider in enumerate(settings.get("providers", [])):
+            if not provider.get("base_url"):
+                continue
+            endpoints.append(Endpoint(provider.get("name") or f"线路{index + 1}",
+                                      provider["base_url"],
+                                      provider.get("api_key") or settings.get("api_key", ""),
+                                      dict(provider.get("models", {}))))
+
+        with self._lock:
+            previous = {e.key(): e for e in self.endpoints}
+            for endpoint in endpoints:
+                old = previous.get(endpoint.key())
+                if old:
+                    endpoint.latency, endpoint.error_rate = old.latency, old.error_rate
+                    endpoint.first_token = old.first_token
+                    endpoint.failures, endpoint.cooldown = old.failures, old.cooldown
+                    endpoint.cooldown_until, endpoint.trust = old.cooldown_until, old.trust
+            self.endpoints = endpoints
+            self.proxy_url = settings.get("proxy_url", None)
+            self.http2 = settings.get("http2", False)
+
+    def choose(self, role, stream=False):
+        now = time.monotonic()
+        with self._lock:
+            capable = [e for e in self.endpoints if e.model_for(role)]
+            healthy = [e for e in capable if not e.cooling(now)]
+            if not healthy:
+                # 全部暂停时，选最早结束暂停的那条
+                return min(capable, key=lambda e: e.cooldown_until, default=None)
+            # 恢复期的线路分到 trust/2 的试探流量，成功后 trust 逐步加到 1
+            for endpoint in healthy:
+                if endpoint.trust < 1.0 and random.random() < endpoint.trust / 2:
+                    return endpoint
+            stable = [e for e in healthy if e.trust >= 1.0] or healthy
+            return min(stable, key=lambda e: e.score(stream))
+
+    @staticmethod
+    def _ewma(current, sample):
+        return sample if current is None else (1 - EWMA_ALPHA) * current + EWMA_ALPHA * sample
+
+    def record(self, endpoint, elapsed, ok, stream=False):
+        """elapsed: 非流式调用的耗时，流式调用的首字延迟"""
+        with self._lock:
+            endpoint.error_rate = (1 - EWMA_ALPHA) * endpoint.error_rate + EWMA_ALPHA * (0.0 if ok else 1.0)
+            if ok:
+                if stream:
+                    endpoint.first_token = self._ewma(endpoint.first_token, elapsed)
+                else:
+                    endpoint.latency = self._ewma(endpoint.latency, elapsed)
+                endpoint.failures = 0
+                endpoint.trust = min(1.0, endpoint.trust + REJOIN_STEP)
+                if endpoint.trust >= 1.0:
+                    endpoint.cooldown = 0.0
+                return
+
+            endpoint.failures += 1
+            # 恢复期内再次失败，或连续失败过多，都暂停 (每次翻倍)
+            if endpoint.trust < 1.0 or endpoint.failures >= FAILURES_TO_COOLDOWN:
+                endpoint.cooldown = min(MAX_COOLDOWN, endpoint.cooldown * 2 or BASE_COOLDOWN)
+                endpoint.cooldown_until = time.monotonic() + endpoint.cooldown
+                endpoint.trust = REJOIN_STEP
+                endpoint.failures = 0
+                print(f"[Router] {endpoint.name} paused for {endpoint.cooldown:.0f}s")
+
+    async def call(self, role, request, fallback_client, fallback_model, stream=False):
+        """
+        选线路后执行 request(client, model)，并记录耗时与成败。
+        stream=True 时执行 request(client, model, first_token)，调用方收到首字时调用 first_token()，
+        记录的是首字延迟 (没调用就按整段耗时)。
+        只有网络错误、超时、5xx 这类线路本身的问题计入失败，请求本身有误的 4xx 不影响线路统计。
+        没有可用线路时使用调用方自己的客户端。
+        """
+        endpoint = self.choose(role, stream)
+        start = time.monotonic()
+        first_token = []
+
+        def mark_first_token():
+            if not first_token:
+                first_token.append(time.monotonic() - start)
+
+        args = (mark_first_token,) if stream else ()
+        if endpoint is None:
+            return await request(fallback_client, fallback_model, *args)
+        client = self.client_for(endpoint)
+        try:
+            result = await request(client, endpoint.model_for(role), *args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if _is_transient(e):
+                self.record(endpoint, time.monotonic() - start, ok=False, stream=stream)
+            raise
+        elapsed = first_token[0] if first_token else time.monotonic() - start
+        self.record(endpoint, elapsed, ok=True, stream=stream)
+        return result
+
+    def client_for(self, endpoint):
+        """线路的客户端：与其他调用共享同一个连接池"""
+        return get_llm_client(endpoint.api_key, endpoint.base_url, self.proxy_url, self.http2)
+
+    def ranking(self):
+        """
+        设置界面显示用：[(名称, 平均耗时毫秒或 None, 平均首字延迟毫秒或 None, 错误率, 状态)]，
+        按当前优先顺序排列
+        """
+        now = time.monotonic()
+        to_ms = lambda seconds: None if seconds is None else seconds * 1000
+        with self._lock:
+            endpoints = sorted(self.endpoints, key=lambda e: (e.cooling(now), e.score()))
+            return [(e.name, to_ms(e.latency), to_ms(e.first_token), e.error_rate, e.status(now))
+                    for e in endpoints]
+
+
+_router = ProviderRouter()
+
+
+def get_router():
+    return _router
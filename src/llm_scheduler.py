@@ -0,0 +1,247 @@
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import contextvars
+from collections import deque
+from email.utils import parsedate_to_datetime
+try:
+    import httpx
+    from openai import APIConnectionError
+    TRANSIENT_ERRORS = (APIConnectionError, httpx.TransportError, asyncio.TimeoutError)
+except ImportError:
+    TRANSIENT_ERRORS = (asyncio.TimeoutError,)
+
+# --- 请求优先级 (数字越小越先执行) ---
+PRIORITY_USER = 0        # 用户正在等的回复：聊天、触摸、初见、告别
+PRIORITY_CODER = 1       # 编程模式
+PRIORITY_PROACTIVE = 2   # 主动搭话
+PRIORITY_BACKGROUND = 3  # 会话总结、历史压缩
+PRIORITY_NAMES = {PRIORITY_USER: "user", PRIORITY_CODER: "coder",
+                  PRIORITY_PROACTIVE: "proactive", PRIORITY_BACKGROUND: "background"}
+
+# 当前协程的优先级，由 LLMTask 在开始执行时设置，各个 LLM 调用点无需显式传递
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_USER)
+
+MAX_RATE_LIMIT_RETRIES = 3
+RETRY_BASE_DELAY = 0.5  # 第一次重试前的平均等待 (秒)，之后指数增长
+RETRY_MAX_DELAY = 8.0
+
+
+def _rate_limit_delay(error, attempt):
+    """429 错误返回应等待的秒数 (优先使用 Retry-After)，其他错误返回 None"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status != 429:
+        return None
+
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    retry_ms = headers.get("retry-after-ms")
+    if retry_ms:
+        try:
+            return float(retry_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except Exception:
+                pass
+    return 2.0 ** attempt
+
+
+def _is_transient(error):
+    """网络错误、超时和 5xx 值得重试；4xx (除 408/409) 重试也没用"""
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status >= 500 or status in (408, 409))
+
+
+def _backoff_delay(attempt):
+    """带随机抖动的指数退避，避免多个请求同时重试"""
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+
+class LatencyTracker:
+    """记录最近的首字延迟，用于决定何时发出对冲请求"""
+    MIN_SAMPLES = 5
+
+    def __init__(self, size=50):
+        self.samples = deque(maxlen=size)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p, default=None):
+        if len(self.samples) < self.MIN_SAMPLES:
+            return default
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+
+class TokenBucket:
+    """
+    令牌桶限速 (每分钟请求数)。收到 429 后暂停到 Retry-After 指定的时间并把速率减半，
+    之后每次成功请求慢慢恢复到配置值。
+    """
+    MIN_RATE = 2.0
+
+    def __init__(self, rate_per_minute):
+        self.blocked_until = 0.0
+        self.configured_rate = None
+        self.configure(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def configure(self, rate_per_minute):
+        """配置值没变时保持当前速率，保存设置不会抵消 429 之后的降速"""
+        rate = max(self.MIN_RATE, float(rate_per_minute))
+        if rate == self.configured_rate:
+            return
+        self.configured_rate = rate
+        self.rate = rate
+        self.capacity = max(1.0, rate / 6)  # 允许 10 秒内的突发
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * 60 / self.rate)
+
+    def on_rate_limited(self, retry_after):
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.rate = max(self.MIN_RATE, self.rate / 2)
+        self.tokens = 0
+        self.updated = now
+        print(f"[Scheduler] 429 received, pausing {retry_after:.1f}s, rate -> {self.rate:.0f}/min")
+
+    def on_success(self):
+        if self.rate < self.configured_rate:
+            self.rate = min(self.configured_rate, self.rate + 1)
+
+
+class LLMScheduler:
+    """
+    所有 LLM 请求的统一入口 (运行在 LLMEngine 的事件循环上)：
+    - 按优先级排队，同时进行的请求数不超过 max_concurrency
+    - 令牌桶限速，根据 429 / Retry-After 自动降速
+    - 网络错误与 5xx 按带抖动的指数退避重试
+    用户的回复不会被后台总结或主动搭话挤在后面。
+    """
+    def __init__(self, max_concurrency=2, rate_per_minute=60, max_retries=2):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.active = 0
+        self._waiters = []  # (priority, seq, future)
+        self._seq = itertools.count()
+        self.bucket = TokenBucket(rate_per_minute)
+
+    def configure(self, settings):
+        self.max_concurrency = max(1, int(settings.get("llm_max_concurrency", self.max_concurrency)))
+        self.bucket.configure(settings.get("llm_rate_limit", self.bucket.configured_rate))
+        self.max_retries = max(0, int(settings.get("llm_max_retries", self.max_retries)))
+
+    def queue_depth(self):
+        """各优先级排队中的请求数 (不含正在执行的)"""
+        depth = {}
+        for priority, _, future in list(self._waiters):
+            if not future.done():
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                depth[name] = depth.get(name, 0) + 1
+        return depth
+
+    async def _acquire(self, priority):
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._wake()
+        if future.done():
+            return
+        print(f"[Scheduler] Queued {PRIORITY_NAMES.get(priority, priority)} request, "
+              f"running={self.active} waiting={sum(self.queue_depth().values())}")
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 已经分到名额但随即被取消，要把名额还回去
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        """按优先级把空出的名额分给排队的请求 (跳过已取消的)"""
+        while self._waiters and self.active < self.max_concurrency:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    async def run(self, make_request, priority=None):
+        """
+        排队执行 make_request() 返回的协程 (整段流式读取也应放在里面，以免提前释放名额)。
+        429 会按 Retry-After 等待后重新排队，最多重试 MAX_RATE_LIMIT_RETRIES 次；
+        临时性错误退避后重试，最多 max_retries 次。退避期间不占用并发名额。
+        标记了 no_retry 的错误 (例如流式回复已经开始显示后断开) 不重试。
+        """
+        if priority is None:
+            priority = request_priority.get()
+        rate_limited = 0
+        failures = 0
+        while True:
+            backoff = 0.0
+            await self._acquire(priority)
+            try:
+                await self.bucket.acquire()
+                result = await make_request()
+                self.bucket.on_success()
+                return result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = _rate_limit_delay(e, rate_limited)
+                if delay is not None and rate_limited < MAX_RATE_LIMIT_RETRIES:
+                    self.bucket.on_rate_limited(delay)
+                    rate_limited += 1
+                elif delay is None and _is_transient(e) and not getattr(e, "no_retry", False) \
+                        and failures < self.max_retries:
+                    backoff = _backoff_delay(failures)
+                    failures += 1
+                    print(f"[Scheduler] {type(e).__name__}: {e}; retry {failures}/{self.max_retries} in {backoff:.1f}s")
+                else:
+                    raise
+            finally:
+                self._release()
+            if backoff:
+                await asyncio.sleep(backoff)
+
+
+_scheduler = LLMScheduler()
+
+
+def get_scheduler():
+    return _scheduler
@@ -2,6 +2,7 @@ import json
 import os
 import time
 import sys
+import tempfile
 
 # 尝试导入默认参数作为初始配置
 try:
@@ -18,6 +19,9 @@ MEMORY_FILE = os.path.join(DATA_DIR, "memory.json")
 RECENT_MEMORY_FILE = os.path.join(DATA_DIR, "recent_memory.json")
 STATUS_FILE = os.path.join(DATA_DIR, "current_status.json")
 SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
+RESPONSE_CACHE_FILE = os.path.join(DATA_DIR, "response_cache.json")
+JOBS_FILE = os.path.join(DATA_DIR, "jobs.json")
+MODEL_CACHE_FILE = os.path.join(DATA_DIR, "model_cache.json")
 
 # 默认人设文本
 DEFAULT_PERSONA_TEXT = """
@@ -33,8 +37,39 @@ DEFAULT_SETTINGS = {
     "action_probability": 0.02,      # 每秒自主行动概率
     "active_chat_probability": 0.2,  # 触发时主动搭话概率
     "active_chat_interval": 60,      # 主动搭话检查间隔(秒)
+    "active_prefetch_cap": 6,        # 预取的主动搭话/告别语每小时最多作废几次 (0=不预取)
     "persona": DEFAULT_PERSONA_TEXT,
     "smart_touch": True,             # 是否开启智能触摸互动
+    "llm_max_concurrency": 2,        # 同时进行的 LLM 请求上限 (超出的按优先级排队)
+    "llm_rate_limit": 60,            # 每分钟最多请求数 (收到 429 时自动降速)
+    "llm_max_retries": 2,            # 网络错误/5xx 的重试次数 (指数退避)
+    # 额外线路，每项: {"name": ..., "base_url": ..., "api_key": (留空用主 Key), "models": {"chat": ..., "coder": ...}}
+    # 与主线路一起按滚动耗时/错误率路由
+    "providers": [],
+    "hedge_base_url": "",            # 备用线路 Base URL，主线路出字过慢时同时请求 (留空关闭)
+    "hedge_api_key": "",             # 备用线路 API Key (留空使用主 Key)
+    "hedge_percentile": 90,          # 主线路首字延迟超过历史该分位时发出对冲请求
+    "touch_debounce_ms": 800,        # 连续触摸合并窗口(毫秒)，停手后才发出一次请求
+    "touch_llm_interval": 5,         # 智能触摸每 N 次才调用 LLM，其余走本地反应表 (1=每次都调用)
+    "exit_deadline": 8,              # 退出流程最长等待(秒)，超时直接道别关闭
+    "llm_backend": "openai",         # "openai": 真实接口; "stub": 进程内模拟 (离线); "local": 本机模拟服务器 (走 HTTP)
+    "stub_latency": 0.3,             # 模拟后端首字前的延迟(秒)
+    "stub_token_delay": 0.02,        # 模拟后端流式输出每块的间隔(秒)
+    "stream_reply": True,            # 回复逐字流式显示
+    "http2": False,                  # 启用 HTTP/2 (需要安装 h2)
+    "agent_mode": "dual",            # "dual": Persona + Action 两次调用; "single": 一次调用同时返回回复与动作; "local": 动作本地推断
+    "llm_broker": False,             # LLM 调用放在独立子进程中 (界面进程只负责渲染，重启后生效)
+    "structured_output": True,       # Action Agent 用 JSON Schema 约束输出 (线路不支持时自动退回 <ACTION> 标签)
+    "response_cache": True,          # 缓存自我介绍/告别/触摸反应等可重复的回复
+    "cache_variety": 0.3,            # 命中缓存时仍重新生成的概率 (0=总是复用, 1=从不复用)
+    "cache_ttl": 86400,              # 缓存有效期(秒)
+    "cache_max_entries": 200,        # 缓存条目上限 (LRU 淘汰)
+    "cache_persist": True,           # 缓存落盘到 data/response_cache.json
+    "context_token_budget": 4000,    # 聊天请求的 Token 预算 (含 system prompt)，0=按模型自动
+    "coder_context_token_budget": 0, # 编程模式的 Token 预算，0=按模型上下文长度自动
+    "coder_compact_threshold": 6000, # 编程历史超过该 Token 数时在后台压缩
+    "coder_routing": True,           # 编程模式按复杂度选择模型：闲聊用 Chat 模型，代码/报错/长输入用 Coder 模型
+    "verbose_llm_logs": False,       # 每次调用都打印上下文截取与 Token 用量 (排查问题用)
     
     # --- API Configuration ---
     "api_key": API_KEY,
@@ -81,11 +116,23 @@ class MemoryManager:
             return {}
 
     def _write_json(self, filepath, data):
+        """
+        先写同目录下的临时文件再 os.replace 替换：记忆与任务会在引擎线程 / Broker 进程中写入，
+        界面线程同时在读，原地截断重写会让读到一半的一方拿到空内容。
+        """
+        tmp_path = None
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(filepath) + ".", suffix=".tmp",
+                                            dir=os.path.dirname(filepath) or ".")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
                 json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, filepath)
+            tmp_path = None
         except Exception as e:
             safe_print(f"Error writing to {filepath}: {e}")
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     # --- 设置管理 (Settings) ---
     def load_settings(self):
@@ -151,11 +198,17 @@ class MemoryManager:
         data = self._read_json(RECENT_MEMORY_FILE)
         return data.get("recent_memories", [])
 
-    def add_recent_memory(self, summary):
+    def add_recent_memory(self, summary, entry_id=None):
+        """entry_id: 来源任务的 key，同一个任务重放时不会重复写入"""
         data = self._read_json(RECENT_MEMORY_FILE)
         memories = data.get("recent_memories", [])
+        if entry_id and any(m.get("id") == entry_id for m in memories):
+            safe_print(f"[Recent Memory] Already saved for {entry_id}, skipped.")
+            return
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
         entry = {"timestamp": timestamp, "summary": summary}
+        if entry_id:
+            entry["id"] = entry_id
         memories.append(entry)
         if len(memories) > 10:
             memories = memories[-10:]
@@ -168,6 +221,27 @@ class MemoryManager:
         self._write_json(RECENT_MEMORY_FILE, {"recent_memories": []})
         safe_print("[Memory] Recent memories cleared.")
 
+    # --- 回复缓存 (Response Cache) ---
+    def load_response_cache(self):
+        return self._read_json(RESPONSE_CACHE_FILE).get("entries", {})
+
+    def save_response_cache(self, entries):
+        self._write_json(RESPONSE_CACHE_FILE, {"entries": entries})
+
+    # --- 模型列表缓存 (Model List) ---
+    def load_model_cache(self):
+        return self._read_json(MODEL_CACHE_FILE).get("entries", {})
+
+    def save_model_cache(self, entries):
+        self._write_json(MODEL_CACHE_FILE, {"entries": entries})
+
+    # --- 后台任务 (Jobs) ---
+    def load_jobs(self):
+        return self._read_json(JOBS_FILE).get("jobs", {})
+
+    def save_jobs(self, jobs):
+        self._write_json(JOBS_FILE, {"jobs": jobs})
+
     # --- 状态数值 (Current Status) ---
     def load_status(self):
         return self._read_json(STATUS_FILE)
@@ -58,6 +58,45 @@ class ANIMATION_CONFIG:
     # 情绪状态
     CONFIG_EMOTION_SING = {"duration": 5, "loop": False, "fps": 5.0}
 
+# ======== 本地触摸反应表 ========
+# 智能触摸的快速通道：命中时直接播放动画并调整数值，不调用 LLM。
+# 键：(部位, 关系档位)；关系档位 low=陌生/敌对, mid=熟人/朋友, high=亲密
+# 值：(动画名, 基础数值变化)，实际变化再按触摸类型缩放。表里没有的组合交给 LLM。
+TOUCH_REACTIONS = {
+    ("脑袋", "low"): ("EMOTION_SING_BLUSH", {"mood": 0.02}),
+    ("脑袋", "mid"): ("EMOTION_SING_ENJOY", {"mood": 0.05}),
+    ("脑袋", "high"): ("EMOTION_SING_ENJOY", {"mood": 0.08, "boredom": -0.05}),
+    ("手", "low"): ("EMOTION_SING_HAPPY", {"mood": 0.02}),
+    ("手", "mid"): ("EMOTION_SING_HAPPY", {"mood": 0.05}),
+    ("手", "high"): ("EMOTION_SING_BLUSH", {"mood": 0.08}),
+    ("肚子", "low"): ("EMOTION_SING_DISGUST", {"mood": -0.03}),
+    ("肚子", "mid"): ("EMOTION_SING_HAPPY", {"mood": 0.05}),
+    ("肚子", "high"): ("EMOTION_SING_ENJOY", {"mood": 0.08}),
+    ("胸", "low"): ("EMOTION_SING_ANGRY", {"mood": -0.1}),
+    ("胸", "mid"): ("EMOTION_SING_BLUSH", {"mood": -0.05}),
+    ("胸", "high"): ("EMOTION_SING_BLUSH", {"mood": 0.03}),
+    ("大腿", "low"): ("EMOTION_SING_ANGRY", {"mood": -0.1}),
+    ("大腿", "mid"): ("EMOTION_SING_ANGRY", {"mood": -0.05}),
+    ("大腿", "high"): ("EMOTION_SING_BLUSH", {"mood": 0.0}),
+    ("脚", "low"): ("EMOTION_SING_ANGRY", {"mood": -0.1}),
+    ("脚", "mid"): ("EMOTION_SING_DISGUST", {"mood": -0.05}),
+    ("脚", "high"): ("EMOTION_SING_HAPPY", {"mood": 0.02}),
+}
+TOUCH_TYPE_SCALE = {"gentle": 1.0, "stroke": 1.5, "pat": 2.0}
+# 触摸类型在 Prompt 中的描述，例如 "*用户轻轻触摸了你的脑袋。*"
+TOUCH_TYPE_DESC = {"gentle": "轻轻触摸了", "stroke": "温柔抚摸了", "pat": "用力揉了揉"}
+
+# 预取的主动搭话：数值按这个步长分档，跨档才算“明显变化”而作废
+PREFETCH_STAT_STEP = 20
+PREFETCH_STAT_KEYS = ("hunger", "thirst", "fatigue", "boredom", "intimacy", "mood")
+# 离下一次搭话判定不到这么多秒时开始预取 (秒)
+PREFETCH_LEAD = 20
+# 预取失败后等待多久再试 (秒)，连续失败时翻倍
+PREFETCH_RETRY_BASE = 30
+PREFETCH_RETRY_MAX = 600
+# 告别语显示后停留多久再关闭 (毫秒)
+GOODBYE_LINGER_MS = 800
+
 API_KEY = ""
 BASE_URL = ""
 MODEL_NAME = ""
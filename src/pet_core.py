@@ -3,10 +3,15 @@ import time
 from datetime import datetime
 from PyQt6.QtCore import QObject, pyqtSignal, QTimer
 
-from src.vlm_utils import LLMClient, CoderClient
+from src.vlm_utils import LLMClient, CoderClient, ResponseCache
 from src.memory_utils import MemoryManager
-from src.parameters import ANIMATION_PATH, ANIMATION_CONFIG
-from src.pet_workers import ChatWorker, ActiveChatWorker, CoderWorker, SummaryWorker
+from src.parameters import (ANIMATION_PATH, ANIMATION_CONFIG, TOUCH_REACTIONS, TOUCH_TYPE_SCALE, TOUCH_TYPE_DESC,
+                            PREFETCH_STAT_STEP, PREFETCH_STAT_KEYS, PREFETCH_LEAD, GOODBYE_LINGER_MS)
+from src.pet_workers import (ChatWorker, ActiveChatWorker, CoderWorker, SummaryWorker, JobWorker, WarmUpWorker,
+                             PrefetchSlot)
+from src.llm_engine import get_engine
+from src.action_utils import PetAction
+from src.llm_broker import get_broker, shutdown_broker
 
 def safe_print(text):
     try:
@@ -14,6 +19,18 @@ def safe_print(text):
     except Exception:
         pass
 
+def touch_prompt(part, action_desc):
+    """单次触摸的 Prompt"""
+    return f"*用户{action_desc}你的{part}。*"
+
+def coalesced_touch_prompt(groups):
+    """合并后的触摸 Prompt，groups: [((部位, 描述), 次数)]"""
+    if len(groups) == 1 and groups[0][1] == 1:
+        part, action_desc = groups[0][0]
+        return touch_prompt(part, action_desc)
+    parts = [f"{desc}你的{part}" + (f"{count}次" if count > 1 else "") for (part, desc), count in groups]
+    return f"*用户连续{'、'.join(parts)}。*"
+
 class PetCore(QObject):
     """
     桌宠的核心数据与逻辑类。
@@ -24,6 +41,8 @@ class PetCore(QObject):
     stats_changed = pyqtSignal(dict)       # 数值变化时发出
     animation_requested = pyqtSignal(list, dict, object, bool) # 请求播放动画
     chat_reply_received = pyqtSignal(str)  # 收到回复文本
+    chat_partial_received = pyqtSignal(str)  # 流式回复中途的累积文本
+    chat_interrupted = pyqtSignal()        # 进行中的回复被取消或被新请求取代 (UI 需结束流式气泡)
     
     # 需要 UI 响应的事件
     show_chat_window_signal = pyqtSignal()
@@ -36,8 +55,7 @@ class PetCore(QObject):
         # 1. 初始化基础设施
         self.memory_manager = MemoryManager()
         self.settings = self.memory_manager.load_settings()
-        self.llm_client = LLMClient()
-        self.coder_client = CoderClient()
+        self.llm_client, self.coder_client = self._create_llm_clients()
 
         # 2. 加载或初始化状态
         default_stats = {
@@ -53,6 +71,7 @@ class PetCore(QObject):
         # 3. 运行时状态
         self.current_role_state = "idle"  # idle, working, sleeping, talking, walking, code
         self.tick_counter = 0
+        self.touch_counter = 0  # 智能触摸计数，用于决定哪一次交给 LLM
         
         # 新增：最后一次互动时间戳
         self.last_interaction_time = time.time()
@@ -66,18 +85,73 @@ class PetCore(QObject):
 
         # 5. 延迟检查初次见面
         QTimer.singleShot(1500, self.check_first_encounter)
+        # 6. 继续上次没做完的后台任务 (进程意外退出时的会话总结等)
+        self.job_worker = None
+        QTimer.singleShot(5000, self.resume_jobs)
+        # 7. 后台预热连接，第一条回复不用等握手
+        self.warm_up_worker = None
+        self.warm_up_connections()
 
         # Worker 引用
+        # 同一时间只有一个对话请求 (active_worker)，新请求会取消旧的；
+        # 旧请求晚到的回复通过 sender() 判断后直接丢弃
+        self.init_worker = None
         self.active_worker = None
+        self.active_kind = None  # "user", "touch", "active", "goodbye"
+        self.exit_finished = False
         self.summary_worker = None
 
+        # 连续触摸先攒起来，停手一小段时间后合并成一次请求
+        self.pending_touches = []
+        self.touch_timer = QTimer(self)
+        self.touch_timer.setSingleShot(True)
+        self.touch_timer.timeout.connect(self._flush_touches)
+
+        # 空闲时预先生成下一条主动搭话，判定触发时直接显示
+        # 告别语同样提前备好，退出时立即显示
+        prefetch_cap = self.settings.get("active_prefetch_cap", 6)
+        self.active_prefetch = PrefetchSlot("active", self._prefetch_fingerprint, prefetch_cap)
+        self.goodbye_prefetch = PrefetchSlot("goodbye", self._goodbye_fingerprint, prefetch_cap)
+
+    def _create_llm_clients(self):
+        """
+        开启 llm_broker 时 LLM 调用放在独立进程中，界面进程只负责渲染；子进程崩溃时在后台重启。
+        子进程起不来 (缺依赖、端口被占等) 时退回进程内的客户端，而不是让程序启动失败。
+        """
+        if self.settings.get("llm_broker", False):
+            try:
+                broker = get_broker()
+                return broker.client("chat"), broker.client("coder")
+            except Exception as e:
+                safe_print(f"[Core] LLM broker failed to start, using in-process clients: {e}")
+                shutdown_broker(timeout=0.0)
+        return LLMClient(), CoderClient()
+
     def reload_settings(self, new_settings):
         """重新加载设置"""
         self.settings = new_settings
+        self.active_prefetch.configure(new_settings.get("active_prefetch_cap", 6))
+        self.goodbye_prefetch.configure(new_settings.get("active_prefetch_cap", 6))
         self.llm_client.update_config(new_settings)
         self.coder_client.update_config(new_settings)
+        self.warm_up_connections()
         # 重新检查是否满足初次见面（比如刚配置好Key）
         self.check_first_encounter()
+        self.resume_jobs()
+
+    def warm_up_connections(self):
+        """线路或代理变化后 (以及启动时) 在后台预热连接"""
+        if self.llm_client.needs_warm_up():
+            self.warm_up_worker = WarmUpWorker(self.llm_client)
+            self.warm_up_worker.start()
+
+    def resume_jobs(self):
+        """在后台执行任务队列中的待办任务"""
+        if not self.llm_client.is_ready() or not self.llm_client.has_pending_jobs():
+            return
+        if self.job_worker is None or not self.job_worker.isRunning():
+            self.job_worker = JobWorker(self.llm_client)
+            self.job_worker.start()
 
     def _update_current_time(self):
         """更新当前时间字符串到 stats 中"""
@@ -85,12 +159,13 @@ class PetCore(QObject):
         self.stats['current_time'] = now_str
 
     def _get_time_aware_persona(self):
-        """获取带有时间信息的人设 Prompt"""
+        """
+        获取人设 Prompt，并刷新 stats 中的时间。
+        时间不再拼进人设（会破坏服务商的前缀缓存），而是随 stats 放在 Prompt 末尾。
+        """
         # 确保时间是最新的
         self._update_current_time()
-        base_persona = self.settings.get("persona", "")
-        # 将时间信息追加到 System Prompt 中
-        return f"{base_persona}\n现在是{self.stats['current_time']}。"
+        return self.settings.get("persona", "")
 
     def _reset_next_chat_check_time(self):
         """重置下一次主动搭话检查时间（在互动结束后的下一个周期）"""
@@ -111,11 +186,11 @@ class PetCore(QObject):
         self.current_role_state = "talking"
         self.animation_requested.emit(ANIMATION_PATH.ACTION_CONT_TALK, ANIMATION_CONFIG.CONFIG_ACTION_CONT, None, True)
         
-        # 初始化时使用带有时间的 Persona
+        # 刷新 stats 中的时间，自我介绍时随用户消息一起发出
         persona = self._get_time_aware_persona()
-        self.active_worker = ActiveChatWorker(self.llm_client, self.stats, persona, mode="intro")
-        self.active_worker.reply_signal.connect(self._on_init_reply)
-        self.active_worker.start()
+        self.init_worker = ActiveChatWorker(self.llm_client, self.stats, persona, mode="intro")
+        self.init_worker.reply_signal.connect(self._on_init_reply)
+        self.init_worker.start()
 
     def _on_init_reply(self, reply, action_data):
         safe_print(f"[Init Reply] {reply}")
@@ -147,19 +222,67 @@ class PetCore(QObject):
             prompt = f"用户填写了个人信息卡：{', '.join(added_info)}。请用礼貌的语气表示记住了，并问好。"
             self.start_chat(prompt)
 
-    def start_chat(self, text):
-        """开始一段对话"""
+    def _supersede_active_worker(self):
+        """取消仍在进行的对话请求（连同底层 HTTP 请求）"""
+        worker = self.active_worker
+        if worker is not None and worker.isRunning():
+            worker.cancel()
+            self.chat_interrupted.emit()
+            safe_print(f"[Core] Superseded pending {self.active_kind} request")
+
+    def cancel_chat(self):
+        """用户停止：取消进行中的回复 (连同 HTTP 请求) 和尚未发出的触摸。返回是否真的取消了请求"""
+        self.pending_touches = []
+        self.touch_timer.stop()
+        if self.active_kind == "goodbye" or self.active_worker is None or not self.active_worker.isRunning():
+            return False
+        self._supersede_active_worker()
+        self.active_worker = None
+        if self.current_role_state == "talking":
+            self.current_role_state = "idle"
+            self.reset_idle_animation()
+        return True
+
+    def _is_current_reply(self):
+        """回复是否来自当前的请求；被取代的请求晚到的回复返回 False"""
+        return self.sender() is self.active_worker
+
+    def start_chat(self, text, cacheable=False, kind="user"):
+        """开始一段对话 (cacheable: 可重复的输入，允许复用缓存的回复)"""
+        self._supersede_active_worker()
+        if kind == "user":
+            # 用户发言优先，尚未发出的触摸一并作废
+            self.pending_touches = []
+            self.touch_timer.stop()
+
         self.current_role_state = "talking"
         self.animation_requested.emit(ANIMATION_PATH.ACTION_CONT_TALK, ANIMATION_CONFIG.CONFIG_ACTION_CONT, None, True)
         
         # 普通对话使用带有时间的 Persona
         persona = self._get_time_aware_persona()
-        self.active_worker = ChatWorker(self.llm_client, text, self.stats, persona)
+        self.active_kind = kind
+        self.active_worker = ChatWorker(self.llm_client, text, self.stats, persona, cacheable=cacheable,
+                                        is_touch=kind == "touch")
+        self.active_worker.partial_signal.connect(self._on_chat_partial)
         self.active_worker.reply_signal.connect(self._on_chat_finished)
         self.active_worker.start()
 
+    def _on_chat_partial(self, partial_text):
+        """流式回复：先显示窗口，再把已到达的文本交给 UI 原地刷新"""
+        if not self._is_current_reply():
+            return
+        self.show_chat_window_signal.emit()
+        self.chat_partial_received.emit(partial_text)
+
     def _on_chat_finished(self, reply, action_data):
+        if not self._is_current_reply():
+            safe_print(f"[Chat Reply] Discarded superseded reply: {reply}")
+            return
+        self._show_reply(reply, action_data)
+
+    def _show_reply(self, reply, action_data):
         safe_print(f"[Chat Reply] {reply}")
+        get_engine().submit(self.llm_client.checkpoint_session())
         self.show_chat_window_signal.emit()
         self.chat_reply_received.emit(reply)
         self.process_llm_action(action_data)
@@ -172,13 +295,38 @@ class PetCore(QObject):
         self.last_interaction_time = time.time()
         self._reset_next_chat_check_time()
 
+    def _prefetch_fingerprint(self):
+        """预取结果依赖的状态：数值档位、关系、会话进度、当前小时"""
+        stats = tuple(int(self.stats.get(key, 0) // PREFETCH_STAT_STEP) for key in PREFETCH_STAT_KEYS)
+        relationship = self.memory_manager.load_long_term_memories()[0]
+        return stats + (relationship, self.llm_client.session_length(), datetime.now().hour)
+
+    def _goodbye_fingerprint(self):
+        """告别语只看心情、好感度、关系和时段 (早/晚)"""
+        stats = (int(self.stats.get("mood", 50) // PREFETCH_STAT_STEP), int(self.stats.get("intimacy", 0) // PREFETCH_STAT_STEP))
+        relationship = self.memory_manager.load_long_term_memories()[0]
+        return stats + (relationship, datetime.now().hour // 3)
+
     def start_active_chat(self):
-        """触发主动搭话"""
+        """触发主动搭话：有预取好的直接显示，否则现场请求"""
+        prefetched = self.active_prefetch.take()
+        if prefetched:
+            reply, action_data = prefetched
+            self._supersede_active_worker()
+            self.active_kind = "active"
+            self.active_worker = None
+            self.llm_client.remember_active_message(reply)
+            safe_print("[Core] Using prefetched proactive message")
+            self._show_reply(reply, action_data)
+            return
+
         self.current_role_state = "talking"
         self.animation_requested.emit(ANIMATION_PATH.ACTION_CONT_TALK, ANIMATION_CONFIG.CONFIG_ACTION_CONT, None, True)
         
         # 主动搭话也包含时间信息
         persona = self._get_time_aware_persona()
+        self._supersede_active_worker()
+        self.active_kind = "active"
         self.active_worker = ActiveChatWorker(self.llm_client, self.stats, persona, mode="active")
         self.active_worker.reply_signal.connect(self._on_chat_finished)
         self.active_worker.start()
@@ -190,21 +338,45 @@ class PetCore(QObject):
         self.current_role_state = "talking"
         self.animation_requested.emit(ANIMATION_PATH.ACTION_CONT_TALK, ANIMATION_CONFIG.CONFIG_ACTION_CONT, None, True)
         
-        # 1. 启动后台总结 (不阻塞)
-        self.summary_worker = SummaryWorker(self.llm_client)
-        self.summary_worker.start()
-        
-        # 2. 保存数值
+        # 1. 保存数值，会话记录先写进任务队列，总结没做完也不会丢
         self.memory_manager.save_status(self.stats)
+        get_engine().submit(self.llm_client.checkpoint_session())
 
-        # 3. 启动告别对话
+        # 2. 取消进行中的对话与触摸
         # 告别时通常也需要知道时间（比如“很晚了，早点睡”）
         persona = self._get_time_aware_persona()
+        self.cancel_chat()
+        if self.active_prefetch.running():
+            self.active_prefetch.discard("exiting")
+        self.active_kind = "goodbye"
+        self.exit_finished = False
+
+        # 3. 有预先备好的告别语就立即显示，总结与记忆更新在后台完成 (关闭连接前会等它保存)
+        prefetched = self.goodbye_prefetch.take()
+        if prefetched:
+            goodbye = prefetched[0]
+            self.summary_worker = SummaryWorker(self.llm_client, self.stats, persona, goodbye)
+            self.summary_worker.start()
+            self._on_goodbye_reply(goodbye, {})
+            return
+
+        # 否则一次调用完成 告别 + 总结 + 记忆更新
         self.active_worker = ActiveChatWorker(self.llm_client, self.stats, persona, mode="goodbye")
         self.active_worker.reply_signal.connect(self._on_goodbye_reply)
         self.active_worker.start()
 
+        # 4. 硬性截止：到点还没回复就直接道别退出，总结在关闭连接前仍会继续保存
+        QTimer.singleShot(int(self.settings.get("exit_deadline", 8) * 1000), self._on_exit_deadline)
+
+    def _on_exit_deadline(self):
+        if not self.exit_finished:
+            safe_print("[Core] Exit deadline reached, closing without waiting for goodbye.")
+            self._on_goodbye_reply("拜拜！下次见！", {})
+
     def _on_goodbye_reply(self, reply, action_data):
+        if self.exit_finished:
+            return
+        self.exit_finished = True
         safe_print(f"[Goodbye] {reply}")
         self.show_chat_window_signal.emit()
         self.chat_reply_received.emit(reply)
@@ -212,8 +384,8 @@ class PetCore(QObject):
         # 播放个动作
         self.animation_requested.emit(ANIMATION_PATH.ACTION_CONT_SLEEP, ANIMATION_CONFIG.CONFIG_ACTION_CONT, None, True)
         
-        # 延迟3秒后通知 UI 彻底关闭
-        QTimer.singleShot(2000, self.ready_to_exit_signal.emit)
+        # 稍作停留后通知 UI 彻底关闭
+        QTimer.singleShot(GOODBYE_LINGER_MS, self.ready_to_exit_signal.emit)
 
     def interact(self, action_type):
         """处理用户交互指令 (eat, sleep, etc.)"""
@@ -247,23 +419,22 @@ class PetCore(QObject):
         self._reset_next_chat_check_time()
 
     def process_llm_action(self, action_data):
-        """处理 LLM 返回的 JSON 指令"""
-        if not action_data: return
-        safe_print(f"[Core] Processing Action: {action_data}")
+        """处理 LLM 返回的行为指令 (dict 或 PetAction，统一经 PetAction 校验)"""
+        action = PetAction.from_dict(action_data)
+        if not action: return
+        safe_print(f"[Core] Processing Action: {action.to_dict()}")
         
-        if "adjust" in action_data:
-            for key, val in action_data["adjust"].items():
+        if action.adjust:
+            for key, val in action.adjust.items():
                 if key in self.stats:
                     self.stats[key] = max(0, min(100, self.stats[key] + val))
             self.stats_changed.emit(self.stats)
 
-        if "animate" in action_data:
-            anim_key = action_data["animate"]
-            if hasattr(ANIMATION_PATH, anim_key):
-                paths = getattr(ANIMATION_PATH, anim_key)
-                config = ANIMATION_CONFIG.CONFIG_EMOTION_SING
-                self.current_role_state = "emotion"
-                self.animation_requested.emit(paths, config, None, True)
+        if action.animate:
+            paths = getattr(ANIMATION_PATH, action.animate)
+            config = ANIMATION_CONFIG.CONFIG_EMOTION_SING
+            self.current_role_state = "emotion"
+            self.animation_requested.emit(paths, config, None, True)
 
     def process_touch(self, part, touch_type):
         """
@@ -273,16 +444,13 @@ class PetCore(QObject):
         smart_touch = self.settings.get("smart_touch", True)
         
         # 映射中文描述
-        type_map = {
-            "gentle": "轻轻触摸了",
-            "stroke": "温柔抚摸了",
-            "pat": "用力揉了揉"
-        }
-        action_desc = type_map.get(touch_type, "触摸了")
+        action_desc = TOUCH_TYPE_DESC.get(touch_type, "触摸了")
         
         if smart_touch:
-            prompt = f"*用户{action_desc}你的{part}。*"
-            self.start_chat(prompt)
+            prompt = touch_prompt(part, action_desc)
+            if not self._try_local_touch(part, touch_type, prompt):
+                self.pending_touches.append((part, action_desc))
+                self.touch_timer.start(self.settings.get("touch_debounce_ms", 800))
         else:
             # 普通逻辑（这里根据力度简单区分数值反馈）
             if part == "脑袋":
@@ -306,6 +474,71 @@ class PetCore(QObject):
         self.last_interaction_time = time.time()
         self._reset_next_chat_check_time()
 
+    def _relationship_band(self):
+        """把关系与好感度归为 low / mid / high 三档，用于查本地触摸反应表"""
+        relationship = self.memory_manager.load_long_term_memories()[0]
+        if "Enemy" in relationship:
+            return "low"
+        intimacy = self.stats.get("intimacy", 0)
+        if intimacy < 10:
+            return "low"
+        if intimacy < 50:
+            return "mid"
+        return "high"
+
+    def _try_local_touch(self, part, touch_type, prompt):
+        """
+        智能触摸的本地快速通道：每 touch_llm_interval 次触摸才调用一次 LLM，
+        其余时候查反应表，立即播放动画并调整数值。返回 True 表示已在本地处理。
+        """
+        interval = self.settings.get("touch_llm_interval", 5)
+        self.touch_counter += 1
+        if interval <= 1 or (self.touch_counter - 1) % interval == 0:
+            return False
+
+        reaction = TOUCH_REACTIONS.get((part, self._relationship_band()))
+        if not reaction:
+            return False
+
+        # 相同情境下 LLM 说过的话直接复用 (key 需在调整数值前计算，与 chat 中一致)
+        relationship = self.memory_manager.load_long_term_memories()[0]
+        cache_key = ResponseCache.make_key("chat", self._get_time_aware_persona(), prompt, self.stats, relationship)
+        cached = self.llm_client.peek_response(cache_key)
+
+        anim_key, base_adjust = reaction
+        scale = TOUCH_TYPE_SCALE.get(touch_type, 1.0)
+        self.process_llm_action({
+            "animate": anim_key,
+            "adjust": {k: round(v * scale, 3) for k, v in base_adjust.items()}
+        })
+        # 正在生成 (或流式显示) 回复时不显示缓存的台词，以免覆盖气泡；动画与数值照常
+        if cached and not (self.active_worker and self.active_worker.isRunning()):
+            self.show_chat_window_signal.emit()
+            self.chat_reply_received.emit(cached[0])
+        safe_print(f"[Core] Local touch reaction: {part}/{touch_type} -> {anim_key}")
+        return True
+
+    def _flush_touches(self):
+        """把攒下的触摸合并成一条 Prompt 发出，例如“用户连续轻轻触摸了你的脑袋2次、温柔抚摸了你的手”"""
+        if not self.pending_touches:
+            return
+        if self.active_kind == "user" and self.active_worker and self.active_worker.isRunning():
+            # 不打断用户的发言，等回复后再处理触摸
+            self.touch_timer.start(self.settings.get("touch_debounce_ms", 800))
+            return
+
+        # 只保留最近几次，相邻的相同触摸合并计数
+        touches = self.pending_touches[-5:]
+        self.pending_touches = []
+        groups = []
+        for touch in touches:
+            if groups and groups[-1][0] == touch:
+                groups[-1][1] += 1
+            else:
+                groups.append([touch, 1])
+
+        self.start_chat(coalesced_touch_prompt(groups), cacheable=True, kind="touch")
+
     def _on_logic_tick(self):
         """每秒执行一次的数值逻辑"""
         self.tick_counter += 1
@@ -342,8 +575,23 @@ class PetCore(QObject):
         chat_prob = self.settings.get("active_chat_probability", 0.2)
         interval = self.settings.get("active_chat_interval", 60)
         
+        # 快到判定时间时在后台预取，判定触发时可以直接显示
+        if self.tick_counter % 10 == 0:
+            self.active_prefetch.validate()
+            self.goodbye_prefetch.validate()
+        if (self.next_chat_check_time - current_time <= PREFETCH_LEAD and self.active_prefetch.can_prefetch()
+                and self.llm_client.is_ready() and not (self.active_worker and self.active_worker.isRunning())):
+            persona = self._get_time_aware_persona()
+            self.active_prefetch.start(ActiveChatWorker(self.llm_client, self.stats, persona, mode="prefetch"))
+        elif self.goodbye_prefetch.can_prefetch() and self.llm_client.is_ready() \
+                and not (self.active_worker and self.active_worker.isRunning()) and not self.active_prefetch.running():
+            persona = self._get_time_aware_persona()
+            self.goodbye_prefetch.start(ActiveChatWorker(self.llm_client, self.stats, persona, mode="prefetch_goodbye"))
+
         # 如果当前时间超过了下一次检查时间
         if current_time >= self.next_chat_check_time:
+            if self.active_prefetch.running():
+                return  # 预取马上就好，等它回来再判定
             # 尝试随机触发
             if random.random() < chat_prob:
                 self.start_active_chat()
@@ -360,4 +608,7 @@ class PetCore(QObject):
     def save_data(self):
         """保存数据 (仅用于非正常退出时的备份，正常退出走 start_exit_process)"""
         self.memory_manager.save_status(self.stats)
-        self.llm_client.summarize_session()
\ No newline at end of file
+        try:
+            get_engine().run_sync(self.llm_client.summarize_session(), timeout=30)
+        except Exception as e:
+            safe_print(f"[Core] Summary on save failed: {e}")
\ No newline at end of file
@@ -3,6 +3,7 @@ import html
 from PyQt6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, 
                              QPushButton, QLineEdit, QFrame, QFormLayout, QLabel, QSizeGrip)
 from PyQt6.QtCore import Qt, pyqtSignal, QSize
+from PyQt6.QtGui import QTextCursor
 
 class HorizontalGrip(QWidget):
     """自定义横向拉伸控制柄"""
@@ -44,6 +45,8 @@ class ChatWindow(QWidget):
         super().__init__()
         self.main_widget = parent_widget # 用于定位
         self.core = pet_core             # 用于逻辑调用
+        self.streaming_block = None      # 正在流式更新的回复气泡
+        self.streaming_text = ""
         self.init_ui()
 
     def init_ui(self):
@@ -116,8 +119,15 @@ class ChatWindow(QWidget):
         self.send_btn.setCursor(Qt.CursorShape.PointingHandCursor)
         self.send_btn.clicked.connect(self.send_message)
 
+        self.stop_btn = QPushButton("停止")
+        self.stop_btn.setCursor(Qt.CursorShape.PointingHandCursor)
+        self.stop_btn.setStyleSheet("background-color: #CD5C5C;")
+        self.stop_btn.clicked.connect(self.stop_reply)
+        self.stop_btn.hide()
+
         input_layout.addWidget(self.input_field)
         input_layout.addWidget(self.send_btn)
+        input_layout.addWidget(self.stop_btn)
         
         container_layout.addLayout(input_layout)
         layout.addWidget(self.container)
@@ -166,13 +176,56 @@ class ChatWindow(QWidget):
 
         # 调用 Core 发送消息
         self.core.start_chat(text)
+        self.stop_btn.show()
 
-    def receive_reply(self, reply):
+    def stop_reply(self):
+        """停止按钮：中止正在生成的回复"""
+        self.stop_btn.hide()
+        had_stream = self.streaming_block is not None
+        if self.core.cancel_chat() and not had_stream:
+            self.chat_history.append("<div style='color:#555555; font-style:italic; font-size:12px;'>已停止</div>")
+
+    def _reply_html(self, reply):
         # 获取桌宠称呼，默认为 "桌宠"
         pet_name = self.core.settings.get("pet_name", "桌宠")
-        
         display_text = self._format_text(reply)
-        self.chat_history.append(f"<div style='color:#000000; margin-bottom:10px; margin-top:5px;'><b>{pet_name}:</b> {display_text}</div>")
+        return f"<span style='color:#000000;'><b>{pet_name}:</b> {display_text}</span>"
+
+    def _rewrite_streaming_block(self, reply):
+        """替换流式气泡中的内容（保留气泡本身的段落格式）"""
+        block = self.streaming_block
+        cursor = QTextCursor(block)
+        cursor.setPosition(block.position() + block.length() - 1, QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+        cursor.insertHtml(self._reply_html(reply))
+
+    def update_streaming_reply(self, partial_text):
+        """流式回复：第一次创建气泡，之后在同一个气泡里原地更新"""
+        self.streaming_text = partial_text
+        if self.streaming_block is None:
+            self.chat_history.append(f"<div style='color:#000000; margin-bottom:10px; margin-top:5px;'>{self._reply_html(partial_text)}</div>")
+            self.streaming_block = self.chat_history.document().lastBlock()
+        else:
+            self._rewrite_streaming_block(partial_text)
+
+        sb = self.chat_history.verticalScrollBar()
+        sb.setValue(sb.maximum())
+
+    def end_streaming_reply(self):
+        """回复被取消或被新请求取代：保留已显示的半截内容并标记为中断，之后的回复另起气泡"""
+        self.stop_btn.hide()
+        if self.streaming_block is not None:
+            self._rewrite_streaming_block(f"{self.streaming_text} *（已中断）*")
+            self.streaming_block = None
+
+    def receive_reply(self, reply):
+        self.stop_btn.hide()
+        if self.streaming_block is not None:
+            # 流式结束：用最终文本定稿
+            self._rewrite_streaming_block(reply)
+            self.streaming_block = None
+        else:
+            self.chat_history.append(f"<div style='color:#000000; margin-bottom:10px; margin-top:5px;'>{self._reply_html(reply)}</div>")
         
         sb = self.chat_history.verticalScrollBar()
         sb.setValue(sb.maximum())
@@ -1,71 +1,282 @@
-from PyQt6.QtCore import QThread, pyqtSignal
+import time
+import asyncio
+from collections import deque
+from PyQt6.QtCore import QObject, pyqtSignal
 
-# --- 1. 常规聊天线程 ---
-class ChatWorker(QThread):
+from src.llm_engine import get_engine
+from src.llm_scheduler import (request_priority, PRIORITY_USER, PRIORITY_CODER,
+                               PRIORITY_PROACTIVE, PRIORITY_BACKGROUND)
+from src.parameters import PREFETCH_RETRY_BASE, PREFETCH_RETRY_MAX
+
+# --- 0. 任务基类 ---
+class LLMTask(QObject):
+    """
+    一次 LLM 调用。run() 是协程，在 LLMEngine 的事件循环上执行；
+    结果通过 Qt 信号发回（跨线程信号会自动排队到 UI 线程）。
+    priority 决定在 LLMScheduler 中的排队顺序。
+    """
+    priority = PRIORITY_USER
+
+    def __init__(self):
+        super().__init__()
+        self.future = None
+
+    def start(self):
+        self.future = get_engine().submit(self._guarded_run())
+
+    async def _guarded_run(self):
+        request_priority.set(self.priority)
+        try:
+            await self.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[{type(self).__name__}] Error: {e}")
+            self.on_error(e)
+
+    async def run(self):
+        raise NotImplementedError
+
+    def on_error(self, error):
+        """run() 抛出异常时调用；等待回复的任务在这里发出错误回复，界面不会一直卡在等待中"""
+        pass
+
+    def cancel(self):
+        """取消调用：底层 HTTP 请求会随协程一起中止"""
+        if self.future and not self.future.done():
+            self.future.cancel()
+
+    def isRunning(self):
+        return self.future is not None and not self.future.done()
+
+# --- 1. 常规聊天 ---
+class ChatWorker(LLMTask):
     reply_signal = pyqtSignal(str, dict)
+    partial_signal = pyqtSignal(str)  # 流式输出中累积的可见文本
 
-    def __init__(self, client, text, current_stats, persona):
+    def __init__(self, client, text, current_stats, persona, cacheable=False, is_touch=False):
         super().__init__()
         self.client = client
         self.text = text
         self.stats = current_stats
         self.persona = persona
+        self.cacheable = cacheable
+        self.is_touch = is_touch
 
-    def run(self):
+    async def run(self):
         if self.client and self.client.is_ready():
-            reply, action = self.client.chat(self.text, self.stats, self.persona)
+            reply, action = await self.client.chat(self.text, self.stats, self.persona,
+                                                   on_delta=self.partial_signal.emit,
+                                                   cacheable=self.cacheable, is_touch=self.is_touch)
             self.reply_signal.emit(reply, action)
         else:
             self.reply_signal.emit("请先在设置中配置 API Key 哦！", {})
 
-# --- 2. 主动聊天线程 ---
-class ActiveChatWorker(QThread):
+    def on_error(self, error):
+        self.reply_signal.emit(f"Error: {error}", {})
+
+# --- 2. 主动聊天 ---
+class ActiveChatWorker(LLMTask):
     reply_signal = pyqtSignal(str, dict)
+    failed_signal = pyqtSignal(str)  # 出错或回复为空 (预取据此退避，不会每个 tick 都重新请求)
 
     def __init__(self, client, current_stats, persona, mode="active"):
         super().__init__()
         self.client = client
         self.stats = current_stats
         self.persona = persona
-        self.mode = mode # 'active', 'intro', or 'goodbye'
+        self.mode = mode # 'active', 'prefetch', 'intro', 'goodbye', or 'prefetch_goodbye'
+        # 初见与告别是用户在等的；主动搭话可以让路，预取最后
+        self.priority = {"active": PRIORITY_PROACTIVE, "prefetch": PRIORITY_BACKGROUND,
+                         "prefetch_goodbye": PRIORITY_BACKGROUND}.get(mode, PRIORITY_USER)
 
-    def run(self):
+    async def run(self):
         if self.client and self.client.is_ready():
             reply, action = "", {}
-            
+
             if self.mode == "intro":
-                reply, action = self.client.get_self_introduction(self.persona)
+                reply, action = await self.client.get_self_introduction(self.persona, self.stats)
             elif self.mode == "goodbye":
-                reply, action = self.client.get_goodbye_message(self.persona, self.stats)
+                # 告别语、会话总结与最后的记忆更新合并为一次调用
+                reply, action = await self.client.finish_session(self.persona, self.stats)
+            elif self.mode == "prefetch":
+                # 只生成不入上下文，真正显示时再由 remember_active_message 记录
+                reply, action = await self.client.compose_active_message(self.stats, self.persona)
+            elif self.mode == "prefetch_goodbye":
+                reply = await self.client.compose_goodbye(self.persona, self.stats)
             else:
-                reply, action = self.client.initiate_conversation(self.stats, self.persona)
-            
-            if reply: 
+                reply, action = await self.client.initiate_conversation(self.stats, self.persona)
+
+            if reply:
                 self.reply_signal.emit(reply, action)
+            else:
+                # compose_active_message 出错时返回空回复，同样算失败
+                self.failed_signal.emit("empty reply")
+
+    def on_error(self, error):
+        self.failed_signal.emit(str(error))
 
-# --- 3. 编程聊天线程 ---
-class CoderWorker(QThread):
+# --- 3. 编程聊天 ---
+class CoderWorker(LLMTask):
     reply_signal = pyqtSignal(str, dict)
+    status_signal = pyqtSignal(str)  # 状态栏文本 (历史压缩等)
+    priority = PRIORITY_CODER
 
-    def __init__(self, client, text, stats, persona):
+    def __init__(self, client, text, stats, persona, role=None):
         super().__init__()
         self.client = client
         self.text = text
         self.stats = stats
         self.persona = persona
+        self.role = role  # 指定模型 ("chat" / "coder")，None 表示按复杂度路由
 
-    def run(self):
+    async def run(self):
         if self.client and self.client.is_ready():
-            reply, action = self.client.chat(self.text, self.stats, self.persona)
+            role, model, reason, text = self.client.route(self.text, self.role)
+            self.status_signal.emit(self.client.route_status(role, model, reason))
+            reply, action = await self.client.chat(text, self.stats, self.persona, role=role)
             self.reply_signal.emit(reply, action)
 
-# --- 4. 总结线程 (新增) ---
-class SummaryWorker(QThread):
-    """后台默默执行总结，不阻塞退出流程"""
-    def __init__(self, client):
+            # 回复已经显示，历史过长时再在后台压缩，不占用户等待时间
+            if self.client.needs_compaction():
+                self.status_signal.emit("正在压缩历史...")
+                request_priority.set(PRIORITY_BACKGROUND)
+                result = await self.client.compact_history()
+                if result:
+                    self.status_signal.emit(f"历史已压缩: {result[0]} → {result[1]} tokens")
+        else:
+            self.reply_signal.emit("请先在设置中配置 API Key 哦！", {})
+
+    def on_error(self, error):
+        self.reply_signal.emit(f"代码生成出错: {error}", {})
+
+# --- 4. 总结 ---
+class SummaryWorker(LLMTask):
+    """告别语已经显示后，在后台完成会话总结与记忆更新，不阻塞退出流程"""
+    priority = PRIORITY_BACKGROUND
+
+    def __init__(self, client, current_stats, persona, goodbye):
         super().__init__()
         self.client = client
+        self.stats = current_stats
+        self.persona = persona
+        self.goodbye = goodbye
 
-    def run(self):
+    async def run(self):
         if self.client and self.client.is_ready():
-            self.client.summarize_session()
\ No newline at end of file
+            await self.client.finish_session(self.persona, self.stats, goodbye=self.goodbye)
+
+# --- 5. 持久化的后台任务 ---
+class JobWorker(LLMTask):
+    """执行任务队列中的待办任务 (上次没做完的会话总结等)"""
+    priority = PRIORITY_BACKGROUND
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    async def run(self):
+        await self.client.run_jobs()
+
+# --- 6. 连接预热 ---
+class WarmUpWorker(LLMTask):
+    """启动或更换线路后预热连接池，第一条回复不再等握手"""
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    async def run(self):
+        await self.client.warm_up()
+
+# --- 7. 预取 ---
+class PrefetchSlot(QObject):
+    """
+    空闲时预先生成一条回复，需要时直接拿出来显示。
+    生成时记下当时的指纹 (数值档位、关系、上下文等)，指纹变了结果就作废；
+    每小时作废的次数有上限，超过后暂停预取，退回到需要时现场请求。
+    生成失败同样计入上限，并按 PREFETCH_RETRY_BASE 起指数退避，避免每个 tick 都重新请求。
+    """
+    def __init__(self, name, fingerprint, hourly_cap=6):
+        super().__init__()
+        self.name = name
+        self.fingerprint = fingerprint  # 无参函数，返回可比较的指纹
+        self.hourly_cap = hourly_cap    # 0 表示关闭预取
+        self.worker = None
+        self.worker_print = None
+        self.result = None              # (reply, action, 指纹)
+        self.discards = deque()         # 作废 (及失败) 时间戳
+        self.failures = 0               # 连续失败次数
+        self.retry_after = 0.0          # 失败后在这个时间之前不再预取
+
+    def configure(self, hourly_cap):
+        self.hourly_cap = hourly_cap
+
+    def running(self):
+        return self.worker is not None and self.worker.isRunning()
+
+    def _discards_last_hour(self):
+        cutoff = time.time() - 3600
+        while self.discards and self.discards[0] < cutoff:
+            self.discards.popleft()
+        return len(self.discards)
+
+    def can_prefetch(self):
+        return (self.hourly_cap > 0 and self.result is None and not self.running()
+                and time.time() >= self.retry_after and self._discards_last_hour() < self.hourly_cap)
+
+    def start(self, worker):
+        self.worker = worker
+        self.worker_print = self.fingerprint()
+        worker.reply_signal.connect(self._on_reply)
+        worker.failed_signal.connect(self._on_failed)
+        worker.start()
+
+    def _on_failed(self, reason):
+        if self.sender() is not self.worker:
+            return
+        self.worker = None
+        self.failures += 1
+        delay = min(PREFETCH_RETRY_MAX, PREFETCH_RETRY_BASE * 2 ** (self.failures - 1))
+        self.retry_after = time.time() + delay
+        self.discards.append(time.time())
+        print(f"[Prefetch:{self.name}] Failed ({reason}), retry in {delay:.0f}s, "
+              f"{self._discards_last_hour()}/{self.hourly_cap} this hour")
+
+    def _on_reply(self, reply, action_data):
+        if self.sender() is not self.worker:
+            return
+        self.worker = None
+        self.failures = 0
+        if self.fingerprint() != self.worker_print:
+            self.discard("context changed while generating")
+            return
+        self.result = (reply, action_data, self.worker_print)
+        print(f"[Prefetch:{self.name}] Ready: {reply}")
+
+    def discard(self, reason):
+        """作废进行中的预取或已有结果，计入每小时上限"""
+        if self.running():
+            self.worker.cancel()
+        self.worker = None
+        self.result = None
+        self.discards.append(time.time())
+        print(f"[Prefetch:{self.name}] Discarded ({reason}), {self._discards_last_hour()}/{self.hourly_cap} this hour")
+
+    def validate(self):
+        """指纹变化时作废；返回当前是否仍有可用的结果"""
+        if self.result is None and not self.running():
+            return False
+        current = self.fingerprint()
+        stored = self.result[2] if self.result else self.worker_print
+        if current != stored:
+            self.discard("context changed")
+            return False
+        return self.result is not None
+
+    def take(self):
+        """取出仍然有效的结果 (reply, action)，没有则返回 None"""
+        if not self.validate():
+            return None
+        reply, action_data, _ = self.result
+        self.result = None
+        return reply, action_data
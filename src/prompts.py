@@ -9,7 +9,19 @@
 # ==========================================
 # Part 2: 状态构建函数
 # ==========================================
-def _build_state_section(current_stats, memories, recent_memories=None):
+# 为了命中服务商的前缀缓存 (prefix caching)，Prompt 按“越稳定越靠前”排列：
+#   人设 -> 规则 -> 关系与记忆 (一次会话内基本不变)  ||  时间 -> 数值 -> 最近几轮对话 (每次都变)
+# 易变的部分只出现在最后，前面的长前缀在多次请求之间逐字相同。
+
+def _fmt_stat(value):
+    """数值保留两位小数，避免 12.340000001 这样的浮点噪声"""
+    try:
+        return round(float(value), 2)
+    except (TypeError, ValueError):
+        return value
+
+def _build_memory_section(memories, recent_memories=None):
+    """关系与记忆：一次会话中很少变化，放在 Prompt 前部"""
     relationship_status = memories[0] if memories else "Relationship: Stranger"
     other_memories = memories[1:] if len(memories) > 1 else []
     
@@ -21,16 +33,12 @@ def _build_state_section(current_stats, memories, recent_memories=None):
     else:
         recent_text = "（暂无近期互动记录）"
 
-    state_section = f"""
-【当前状态与记忆】
+    return f"""
+【记忆与关系】
 
 [核心关系状态]
 >>> {relationship_status} <<<
 
-[数值状态] (0-100)
-- 生理: 饥饿={current_stats.get('hunger', 0)} | 口渴={current_stats.get('thirst', 0)} | 疲劳={current_stats.get('fatigue', 0)}
-- 心理: 无聊={current_stats.get('boredom', 0)} | 心情={current_stats.get('mood', 50)} | 好感度={current_stats.get('intimacy', 0)}
-
 [记忆库]
 <近期对话>
 {recent_text}
@@ -38,30 +46,46 @@ def _build_state_section(current_stats, memories, recent_memories=None):
 <长期记忆>
 {long_term_text}
 """
-    return state_section
 
-# ==========================================
-# Part 3: Agent 1 - 角色扮演 Prompt
-# ==========================================
-def get_persona_prompt(current_stats, memories, recent_memories, persona_text):
+def _build_volatile_section(current_stats):
+    """时间与数值：每次请求都可能不同，只能放在 Prompt 末尾"""
+    time_line = f"现在是{current_stats['current_time']}。\n" if current_stats.get('current_time') else ""
+    return f"""【当前状态】
+{time_line}[数值状态] (0-100)
+- 生理: 饥饿={_fmt_stat(current_stats.get('hunger', 0))} | 口渴={_fmt_stat(current_stats.get('thirst', 0))} | 疲劳={_fmt_stat(current_stats.get('fatigue', 0))}
+- 心理: 无聊={_fmt_stat(current_stats.get('boredom', 0))} | 心情={_fmt_stat(current_stats.get('mood', 50))} | 好感度={_fmt_stat(current_stats.get('intimacy', 0))}
+"""
+
+def get_turn_context(current_stats, user_input):
     """
-    负责生成纯文本回复，专注于人设和情感。
+    带历史的对话中，易变状态不放进 system prompt，而是附在本轮用户消息前面，
+    这样 system prompt 与之前的对话历史可以整体命中缓存。
     """
-    state_section = _build_state_section(current_stats, memories, recent_memories)
-    
-    return f"""
-{persona_text}
+    return f"""{_build_volatile_section(current_stats)}
+【用户输入】
+{user_input}"""
 
-{state_section}
-
-【对话任务】
-请根据你的当前状态、记忆以及与用户的关系，回复用户的输入。
+# ==========================================
+# Part 3: 共用规则片段
+# ==========================================
+PURE_TEXT_RULE = "**纯文本**：**严禁**输出任何 <ACTION>、JSON 或 XML 标签。只输出你想说的话。"
+WITH_ACTION_RULE = "**输出顺序**：先输出你想说的话（不要包含 JSON），然后另起一行输出一个 <ACTION>...</ACTION> 块。"
 
-【准则】
+ACTION_JSON_EXAMPLE = """{
+    "animate": "EMOTION_SING_HAPPY",
+    "adjust": { "mood": 0.1 }
+}"""
+ACTION_OUTPUT_FORMAT = f"""<ACTION>
+{ACTION_JSON_EXAMPLE}
+</ACTION>"""
+
+def _build_persona_rules(output_rule):
+    """角色扮演准则，output_rule 决定是否允许附带 <ACTION> 块"""
+    return f"""【准则】
 1. **完全沉浸**：忘记你是一个程序，你就是角色扮演要求你扮演的角色，和用户生动交流。
 2. **语气**：简短、口语化、符合人物设定（50字以内）。
 3. **状态反应**：如果你很饿或很累，可以在语气中表现出来或者略作抱怨，但不要直接报数值。
-4. **纯文本**：**严禁**输出任何 <ACTION>、JSON 或 XML 标签。只输出你想说的话。
+4. {output_rule}
 5. **互动性**：你可以用*包裹做出的动作，但不要使用表情符号。例如：*伸了个懒腰*。
 6. **好感度与关系**：根据好感度的不同，你也应该调整说话的亲密程度和内容。如果好感度和关系很高，那么用户提出的任何邀请都没必要拒绝。
    例子：
@@ -73,30 +97,9 @@ def get_persona_prompt(current_stats, memories, recent_memories, persona_text):
    - 好感度 100：今天也可以陪陪我吗？
 """
 
-# ==========================================
-# Part 4: Agent 2 - 工程/行为 Prompt
-# ==========================================
-def get_action_agent_prompt(current_stats, memories, user_input, assistant_reply):
-    """
-    负责分析对话并生成控制指令 (Action)。
-    此 Prompt 相对固定，不需要动态人设，因为它是一个逻辑后台 Agent。
-    """
-    state_section = _build_state_section(current_stats, memories)
-    other_memories = memories[1:] if len(memories) > 1 else []
-    
-    return f"""
-你是一个后台逻辑Agent，负责驱动虚拟桌宠的行为系统。
-你的任务是根据【用户输入】和【桌宠的文本回复】，判断桌宠应该执行什么动作、调整什么数值或存储什么记忆。
-【当前对话场景】
-用户说: "{user_input}"
-桌宠回复: "{assistant_reply}"
-
-{state_section}
-
-【任务目标】
-分析上述对话，输出一个 <ACTION>...</ACTION> JSON 块。
-
-【工程规则】
+def _build_action_rules(other_memories):
+    """行为指令 (Action) 的工程规则，Action Agent 与单次调用模式共用"""
+    return f"""【工程规则】
 1. **数值调整 ("adjust")**：
    - 根据对话情感微调：mood (心情), boredom (无聊), intimacy (好感度), fatigue (疲劳)。
    - 规则：对话愉快 mood+0.5~1；深度共鸣 intimacy+0.05；争吵 mood-2。
@@ -123,46 +126,131 @@ def get_action_agent_prompt(current_stats, memories, user_input, assistant_reply
    - 但是关系的调整不仅基于好感度。必须在好感度达标的基础上，还要有非常重大的事件发生（比如求婚、吵架分手、立下誓言等）。
 
 5. **特殊要求**：纯粹的触摸互动（*用户触摸了你的...*）不改变亲密度，对其他数值的调整也应该小于等于0.1。纯粹的触摸互动在任何情况下**不应加入长期记忆**。
+"""
 
+# ==========================================
+# Part 4: Agent 1 - 角色扮演 Prompt
+# ==========================================
+def get_persona_prompt(memories, recent_memories, persona_text):
+    """
+    负责生成纯文本回复，专注于人设和情感。
+    只包含稳定内容；时间和数值由 get_turn_context 附在用户消息中。
+    """
+    memory_section = _build_memory_section(memories, recent_memories)
+    
+    return f"""
+{persona_text}
+
+【对话任务】
+请根据你的当前状态、记忆以及与用户的关系，回复用户的输入。（当前状态附在每条用户消息的开头）
+
+{_build_persona_rules(PURE_TEXT_RULE)}
+{memory_section}"""
+
+# ==========================================
+# Part 5: Agent 2 - 工程/行为 Prompt
+# ==========================================
+def get_action_agent_prompt(current_stats, memories, user_input, assistant_reply, structured=False):
+    """
+    负责分析对话并生成控制指令 (Action)。
+    此 Prompt 相对固定，不需要动态人设，因为它是一个逻辑后台 Agent。
+    固定的规则在前，本轮对话与数值在最后。
+    structured: 请求带有 JSON Schema (response_format) 时，直接输出 JSON 对象，不需要标签。
+    """
+    memory_section = _build_memory_section(memories)
+    other_memories = memories[1:] if len(memories) > 1 else []
+    if structured:
+        target = "输出一个 JSON 对象。"
+        output_format = f"直接输出符合 schema 的 JSON 对象，不要任何包裹或废话。\n示例：\n{ACTION_JSON_EXAMPLE}"
+    else:
+        target = "输出一个 <ACTION>...</ACTION> JSON 块。"
+        output_format = f"严格输出 XML 包裹的 JSON，无其他废话。\n示例：\n{ACTION_OUTPUT_FORMAT}"
+    
+    return f"""
+你是一个后台逻辑Agent，负责驱动虚拟桌宠的行为系统。
+你的任务是根据【用户输入】和【桌宠的文本回复】，判断桌宠应该执行什么动作、调整什么数值或存储什么记忆。
+
+【任务目标】
+分析最后给出的对话，{target}
+
+{_build_action_rules(other_memories)}
 【输出格式】
-严格输出 XML 包裹的 JSON，无其他废话。
-示例：
-<ACTION>
-{{
-    "animate": "EMOTION_SING_HAPPY",
-    "adjust": {{ "mood": 0.1 }}
-}}
-</ACTION>
+{output_format}
+{memory_section}
+{_build_volatile_section(current_stats)}
+【当前对话场景】
+用户说: "{user_input}"
+桌宠回复: "{assistant_reply}"
 """
 
 # ==========================================
-# Part 5: 其他 Prompt
+# Part 6: 单次调用模式 - 回复与行为合并 Prompt
 # ==========================================
+def get_single_agent_prompt(memories, recent_memories, persona_text):
+    """
+    一次补全同时产出回复文本与 <ACTION> 块，省去单独的 Action Agent 调用。
+    与 get_persona_prompt 一样只包含稳定内容。
+    """
+    memory_section = _build_memory_section(memories, recent_memories)
+    other_memories = memories[1:] if len(memories) > 1 else []
+
+    return f"""
+{persona_text}
+
+【对话任务】
+请根据你的当前状态、记忆以及与用户的关系，回复用户的输入。（当前状态附在每条用户消息的开头）
+回复之后，再以后台逻辑的视角（你的回复即【桌宠回复】）给出桌宠应执行的动作、数值调整或需要存储的记忆。
 
-def get_active_initiation_prompt(current_stats, memories, recent_history_text, persona_text):
-    """主动搭话 - 仅生成文本"""
+{_build_persona_rules(WITH_ACTION_RULE)}
+{_build_action_rules(other_memories)}
+【输出格式】
+你想说的话
+{ACTION_OUTPUT_FORMAT}
+{memory_section}"""
+
+# ==========================================
+# Part 7: 其他 Prompt
+# ==========================================
+
+def get_active_initiation_prompt(current_stats, memories, recent_history_text, persona_text, with_action=False):
+    """主动搭话 - 默认仅生成文本；with_action 为 True 时（单次调用模式）附带 <ACTION> 块"""
     relationship = memories[0] if memories else "Relationship: Stranger"
     
+    output_requirement = "只输出文本，**不要**包含动作标签。"
+    if with_action:
+        output_requirement = "先输出文本，然后另起一行输出一个 <ACTION>...</ACTION> 块。"
+    
     prompt = f"""
 {persona_text}
 
-【当前状态】
-关系：{relationship} | 饥饿：{current_stats.get('hunger', 0)} | 口渴：{current_stats.get('thirst', 0)} | 心情：{current_stats.get('mood', 50)} | 无聊：{current_stats.get('boredom', 30)}
+【任务】
+用户正在发呆，请主动发起一个话题。
+要求：简短（30字以内），有趣，符合当前关系。{output_requirement}
+"""
+    if with_action:
+        prompt += f"""
+【行为指令】
+根据你说的话选择动画 ("animate") 和数值微调 ("adjust")。主动搭话不写入记忆、不变更关系，忽略下面第 3、4 条。
+{_build_action_rules([])}
+【输出格式】
+你想说的话
+{ACTION_OUTPUT_FORMAT}
+"""
+    prompt += f"""
+【关系】
+{relationship}
 
+{_build_volatile_section(current_stats)}
 【最近氛围】
 {recent_history_text}
-
-【任务】
-用户正在发呆，请主动发起一个话题。
-要求：简短（30字以内），有趣，符合当前关系。只输出文本，**不要**包含动作标签。
 """
     return prompt
 
-def get_coder_system_prompt(current_stats, memories, persona_text):
-    """编程模式"""
+def get_coder_system_prompt(current_stats, memories, persona_text, history_summary=""):
+    """编程模式 (history_summary: 较早对话压缩后的摘要与最终代码)；时间与数值由 get_turn_context 附在用户消息中"""
     relationship_status = memories[0] if memories else "Relationship: Stranger"
     
-    return f"""
+    prompt = f"""
 {persona_text}
 
 你现在进入了【编程协作模式】。你和用户的关系：{relationship_status}。
@@ -171,6 +259,29 @@ def get_coder_system_prompt(current_stats, memories, persona_text):
 1. 专业、精确，代码无误。
 2. 保持人物设定中语气。
 3. 代码使用 Markdown 代码块包裹。
+"""
+    if history_summary:
+        prompt += f"""
+【之前的对话（已压缩）】
+{history_summary}
+"""
+    return prompt
+
+def get_coder_compaction_prompt(previous_summary, transcript):
+    """编程对话压缩：只总结决策与进展，代码由程序原样保留"""
+    return f"""
+任务：把一段编程协作对话压缩成简短的要点（300字以内），供后续对话参考。
+要求：
+1. 记录用户的目标、已经做出的决定（技术选型、接口、命名、约束）、已解决和未解决的问题。
+2. 不要复述代码，代码的最终版本会单独保留。
+3. 被后来推翻的方案只需一句话说明放弃的原因。
+4. 使用要点列表，不要寒暄。
+
+【之前的摘要】
+{previous_summary or "（无）"}
+
+【需要压缩的对话（代码块已移除）】
+{transcript}
 """
 
 def get_summary_prompt(chat_history_text, memories):
@@ -217,12 +328,55 @@ def get_goodbye_prompt(persona_text, current_stats):
 【场景】
 用户准备离开了。
 
-【当前状态】
-- 生理: 饥饿={current_stats.get('hunger', 0)} | 口渴={current_stats.get('thirst', 0)} | 疲劳={current_stats.get('fatigue', 0)}
-- 心理: 无聊={current_stats.get('boredom', 0)} | 心情={current_stats.get('mood', 50)} | 好感度={current_stats.get('intimacy', 0)}
-
 【任务】
 请和用户做一个简短的道别（20字以内）。
 语气要符合当前的好感度和关系，表现出不舍或期待下次再见。
 只输出文本。
-"""
\ No newline at end of file
+
+{_build_volatile_section(current_stats)}"""
+
+
+# ==========================================
+# Part 8: 退出流程 - 告别、总结与记忆合并为一次调用
+# ==========================================
+EXIT_OUTPUT_FORMAT = """<EXIT>
+{
+    "goodbye": "今天也辛苦啦，明天见~",
+    "summary": "我注意到用户今天工作很忙，但聊天时心情不错。",
+    "memorize": "",
+    "update_relationship": ""
+}
+</EXIT>"""
+
+def get_exit_prompt(persona_text, current_stats, memories, chat_history_text):
+    """
+    退出时一次性产出：告别语 + 本次会话摘要 + 最后的记忆/关系变更。
+    稳定的人设与规则在前，数值与本次对话在最后。
+    """
+    relationship_status = memories[0] if memories else "Relationship: Stranger"
+    other_memories = memories[1:] if len(memories) > 1 else []
+    return f"""
+{persona_text}
+
+【场景】
+用户准备离开了，你需要同时完成以下几件事，并按格式一次性输出。
+
+【任务】
+1. "goodbye"：和用户做一个简短的道别（20字以内）。语气要符合当前的好感度和关系，表现出不舍或期待下次再见。
+2. "summary"：将本次对话总结为简短摘要（100字内）。第一人称，从你的视角出发；记录重点信息和情绪变化；不要提及自己是桌宠。
+   可以参考关系和长期记忆里已有的基本事实（比如用户的称呼），但不要照抄长期记忆。本次没有对话时留空。
+3. "memorize"：本次对话中出现、但长期记忆里还没有的关键信息（10个字以内，第一人称）。没有就留空，不要重复已有内容，触摸互动不算。
+4. "update_relationship"：只有在好感度达标且发生了里程碑事件时才填写新的关系，否则留空。
+
+【输出格式】
+严格输出 XML 包裹的 JSON，无其他废话：
+{EXIT_OUTPUT_FORMAT}
+
+【关系与记忆】
+关系：{relationship_status}
+长期记忆：{other_memories}
+
+{_build_volatile_section(current_stats)}
+【本次对话】
+{chat_history_text or "（无）"}
+"""
@@ -13,12 +13,16 @@ try:
     from src.pet_windows import ChatWindow, InitSetupWindow
     from src.coding_utils import CodingWindow 
     from src.settings_ui import SettingsWindow 
+    from src.llm_engine import get_engine
+    from src.llm_broker import shutdown_broker
 except ImportError:
     from parameters import ANIMATION_PATH, ANIMATION_CONFIG
     from pet_core import PetCore
     from pet_windows import ChatWindow, InitSetupWindow
     from coding_utils import CodingWindow
     from settings_ui import SettingsWindow
+    from llm_engine import get_engine
+    from llm_broker import shutdown_broker
 
 class DesktopPet(QWidget):
     def __init__(self, target_size=(320, 320), parent=None):
@@ -31,6 +35,8 @@ class DesktopPet(QWidget):
         self.core.stats_changed.connect(self.on_stats_changed)
         self.core.animation_requested.connect(self.play_animation)
         self.core.chat_reply_received.connect(self.on_chat_reply)
+        self.core.chat_partial_received.connect(self.on_chat_partial)
+        self.core.chat_interrupted.connect(self.on_chat_interrupted)
         self.core.show_chat_window_signal.connect(self.show_chat_window)
         self.core.show_init_window_signal.connect(self.show_init_window)
         self.core.ready_to_exit_signal.connect(self.force_quit) # 新增：彻底退出
@@ -97,6 +103,14 @@ class DesktopPet(QWidget):
         if self.chat_window:
             self.chat_window.receive_reply(reply)
 
+    def on_chat_partial(self, partial_text):
+        if self.chat_window:
+            self.chat_window.update_streaming_reply(partial_text)
+
+    def on_chat_interrupted(self):
+        if self.chat_window:
+            self.chat_window.end_streaming_reply()
+
     def _ensure_chat_window_created(self):
         if self.chat_window is None:
             self.chat_window = ChatWindow(self, self.core)
@@ -326,6 +340,8 @@ class DesktopPet(QWidget):
     def toggle_chat_window(self):
         self._ensure_chat_window_created()
         if self.chat_window.isVisible():
+            # 收起聊天窗口即放弃正在等待的回复
+            self.core.cancel_chat()
             self.chat_window.hide()
         else: 
             self.chat_window.show()
@@ -386,9 +402,19 @@ class DesktopPet(QWidget):
         """
         if self.is_exiting:
             event.accept()
+            # 先把窗口收起来，看起来已经退出；再给未完成的总结一点时间，然后关闭事件循环和连接池
+            self.hide()
+            for window in (self.chat_window, self.coding_window):
+                if window:
+                    window.hide()
+            get_engine().shutdown(timeout=5.0)
+            shutdown_broker(timeout=5.0)
             # 确保子线程退出
             QApplication.quit()
         else:
             event.ignore()
+            # 编程窗口里未完成的请求直接中止，聊天请求由 start_exit_process 取消
+            if self.coding_window:
+                self.coding_window.cancel_request()
             # 启动退出流程
             self.core.start_exit_process()
\ No newline at end of file
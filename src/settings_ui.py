@@ -1,81 +1,48 @@
 import re
+import json
 from PyQt6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, 
                              QLabel, QPushButton, QDoubleSpinBox, QSpinBox, 
-                             QFormLayout, QFrame, QSizePolicy, QCheckBox, QGroupBox, QLineEdit, QMessageBox, QScrollArea)
-from PyQt6.QtCore import Qt, pyqtSignal, QThread
+                             QFormLayout, QFrame, QSizePolicy, QCheckBox, QGroupBox, QLineEdit, QMessageBox, QScrollArea,
+                             QComboBox, QCompleter)
+from PyQt6.QtCore import Qt, pyqtSignal, QTimer, QStringListModel
 from PyQt6.QtGui import QFont, QIcon
 
 try:
-    from src.vlm_utils import get_total_usage
+    from src.vlm_utils import get_total_usage, get_cache_stats, get_first_reply_stats
+    from src.http_utils import get_async_http_client
+    from src.llm_scheduler import get_scheduler
+    from src.llm_router import get_router
+    from src.pet_workers import LLMTask
+    from src.api_check_utils import ModelListCache, run_api_checks, PROBES, PROBE_LABELS
+    from src.action_infer_utils import get_action_engine
+    from src.llm_broker import get_remote_stats
 except ImportError:
-    from vlm_utils import get_total_usage
-
-# 尝试导入 OpenAI 用于检测
-try:
-    from openai import OpenAI
-except ImportError:
-    OpenAI = None
-
-class ApiCheckWorker(QThread):
-    """后台线程：检查 API 连接状态"""
-    result_signal = pyqtSignal(str, str) # msg, color
-
-    def __init__(self, api_key, base_url, model_name, check_type="connection", proxy=None):
+    from vlm_utils import get_total_usage, get_cache_stats, get_first_reply_stats
+    from http_utils import get_async_http_client
+    from llm_scheduler import get_scheduler
+    from llm_router import get_router
+    from pet_workers import LLMTask
+    from api_check_utils import ModelListCache, run_api_checks, PROBES, PROBE_LABELS
+    from action_infer_utils import get_action_engine
+    from llm_broker import get_remote_stats
+
+class ApiCheckWorker(LLMTask):
+    """在 LLMEngine 上并发执行 API 检测 (共用同一个客户端)"""
+    result_signal = pyqtSignal(list)  # [{"probe", "ok", "message", "latency_ms"}]
+
+    def __init__(self, api_key, base_url, proxy, http2, chat_model, coder_model, probes, backend, cache,
+                 refresh_models=True):
         super().__init__()
-        self.api_key = api_key
-        self.base_url = base_url
-        self.model_name = model_name
-        self.check_type = check_type
-        self.proxy = proxy
-
-    def run(self):
-        if not OpenAI:
-            self.result_signal.emit("错误: 未安装 openai 库", "red")
-            return
-        
-        try:
-            # 构建 httpx 客户端参数
-            import httpx
-            http_client = None
-            if self.proxy:
-                http_client = httpx.Client(proxy=self.proxy)
-            
-            client = OpenAI(
-                api_key=self.api_key, 
-                base_url=self.base_url,
-                http_client=http_client
-            )
-            
-            if self.check_type == "connection":
-                models = client.models.list()
-                self.result_signal.emit(f"Base URL 连接成功 (模型数: {len(models.data)})", "green")
-            
-            elif self.check_type == "chat":
-                client.chat.completions.create(
-                    model=self.model_name,
-                    messages=[{"role": "user", "content": "Hi"}],
-                    max_tokens=5
-                )
-                self.result_signal.emit(f"Chat 模型 '{self.model_name}' 可用", "green")
-            
-            elif self.check_type == "coder":
-                client.chat.completions.create(
-                    model=self.model_name,
-                    messages=[{"role": "user", "content": "print('hello')"}],
-                    max_tokens=5
-                )
-                self.result_signal.emit(f"Coder 模型 '{self.model_name}' 可用", "green")
+        self.args = (api_key, base_url, proxy, http2, chat_model, coder_model)
+        self.probes = probes
+        self.backend = backend
+        self.cache = cache
+        self.refresh_models = refresh_models
 
-        except Exception as e:
-            error_msg = str(e)
-            if "401" in error_msg:
-                self.result_signal.emit("401 Unauthorized (Key错误)", "red")
-            elif "404" in error_msg:
-                self.result_signal.emit(f"404: 模型 '{self.model_name}' 不存在", "red")
-            elif "proxy" in error_msg.lower() or "connect" in error_msg.lower():
-                self.result_signal.emit(f"代理连接失败", "red")
-            else:
-                self.result_signal.emit(f"错误: {error_msg[:30]}...", "red")
+    async def run(self):
+        results = await run_api_checks(*self.args, probes=self.probes, backend=self.backend, cache=self.cache,
+                                       refresh_models=self.refresh_models)
+        self.result_signal.emit(results)
 
 class SettingsWindow(QWidget):
     settings_saved = pyqtSignal(dict) 
@@ -85,6 +52,9 @@ class SettingsWindow(QWidget):
         self.settings = current_settings.copy()
         self.pet = parent_pet 
         self.api_worker = None
+        self.model_refresh_worker = None
+        self.model_cache = ModelListCache()
+        self.model_list_model = QStringListModel()
         self.init_ui()
 
     def init_ui(self):
@@ -116,7 +86,7 @@ class SettingsWindow(QWidget):
                 background-color: #f0f0f0;
                 color: #999;
             }
-            QDoubleSpinBox, QSpinBox {
+            QDoubleSpinBox, QSpinBox, QComboBox {
                 padding: 5px;
                 border: 1px solid #87CEEB;
                 border-radius: 5px;
@@ -212,6 +182,20 @@ class SettingsWindow(QWidget):
         api_layout = QFormLayout(api_group)
         api_layout.setSpacing(8)
 
+        backend_layout = QHBoxLayout()
+        self.backend_combo = QComboBox()
+        self.backend_combo.addItem("OpenAI 兼容接口", "openai")
+        self.backend_combo.addItem("本地模拟 (离线，无需 Key)", "stub")
+        self.backend_combo.addItem("本地模拟服务器 (HTTP)", "local")
+        backend_index = self.backend_combo.findData(self.settings.get("llm_backend", "openai"))
+        self.backend_combo.setCurrentIndex(max(0, backend_index))
+        self.stub_latency_spin = QDoubleSpinBox()
+        self.stub_latency_spin.setRange(0.0, 30.0); self.stub_latency_spin.setSingleStep(0.1); self.stub_latency_spin.setSuffix("s")
+        self.stub_latency_spin.setValue(self.settings.get("stub_latency", 0.3))
+        self.stub_latency_spin.setToolTip("模拟后端首字前的延迟")
+        backend_layout.addWidget(self.backend_combo); backend_layout.addWidget(QLabel("模拟延迟:")); backend_layout.addWidget(self.stub_latency_spin)
+        api_layout.addRow("后端:", backend_layout)
+
         self.api_key_edit = QLineEdit(self.settings.get("api_key", ""))
         self.api_key_edit.setEchoMode(QLineEdit.EchoMode.Password)
         self.api_key_edit.setPlaceholderText("sk-...")
@@ -244,6 +228,18 @@ class SettingsWindow(QWidget):
         coder_layout.addWidget(btn_check_coder)
         api_layout.addRow("Coder Model:", coder_layout)
 
+        btn_check_all = QPushButton("全部检测 (连接 + Chat + Coder)")
+        btn_check_all.clicked.connect(lambda: self.check_api("all"))
+        api_layout.addRow(btn_check_all)
+
+        # 模型输入框按缓存的模型列表自动补全
+        for edit in (self.model_name_edit, self.coder_model_edit):
+            completer = QCompleter(self.model_list_model, self)
+            completer.setCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+            completer.setFilterMode(Qt.MatchFlag.MatchContains)
+            edit.setCompleter(completer)
+        self.base_url_edit.editingFinished.connect(self.refresh_model_completer)
+
         # 代理设置
         proxy_section_label = QLabel("网络代理")
         proxy_section_label.setObjectName("section_title")
@@ -264,6 +260,59 @@ class SettingsWindow(QWidget):
         proxy_url_layout.addWidget(self.proxy_url_edit)
         proxy_url_layout.addWidget(btn_check_proxy)
         api_layout.addRow("代理地址:", proxy_url_layout)
+
+        self.http2_check = QCheckBox("启用 HTTP/2 (需要安装 h2)")
+        self.http2_check.setChecked(self.settings.get("http2", False))
+        api_layout.addRow(self.http2_check)
+        self.refresh_model_completer()  # 需要代理与 HTTP/2 控件，放在它们之后
+
+        # 多线路路由
+        providers_section_label = QLabel("多线路")
+        providers_section_label.setObjectName("section_title")
+        api_layout.addRow(providers_section_label)
+
+        self.providers_edit = QTextEdit()
+        self.providers_edit.setPlaceholderText('[{"name": "线路2", "base_url": "https://...", "api_key": "", '
+                                               '"models": {"chat": "gpt-4o-mini", "coder": "gpt-4o"}}]')
+        providers = self.settings.get("providers", [])
+        self.providers_edit.setPlainText(json.dumps(providers, ensure_ascii=False, indent=2) if providers else "")
+        self.providers_edit.setMaximumHeight(90)
+        api_layout.addRow("额外线路:", self.providers_edit)
+
+        self.ranking_label = QLabel("")
+        self.ranking_label.setStyleSheet("color: #666; font-size: 11px;")
+        self.ranking_label.setWordWrap(True)
+        api_layout.addRow("线路排名:", self.ranking_label)
+
+        # 备用线路 (对冲请求)
+        hedge_section_label = QLabel("备用线路")
+        hedge_section_label.setObjectName("section_title")
+        api_layout.addRow(hedge_section_label)
+
+        self.hedge_base_url_edit = QLineEdit(self.settings.get("hedge_base_url", ""))
+        self.hedge_base_url_edit.setPlaceholderText("留空关闭；主线路出字过慢时同时请求这里")
+        api_layout.addRow("Base URL:", self.hedge_base_url_edit)
+
+        self.hedge_api_key_edit = QLineEdit(self.settings.get("hedge_api_key", ""))
+        self.hedge_api_key_edit.setEchoMode(QLineEdit.EchoMode.Password)
+        self.hedge_api_key_edit.setPlaceholderText("留空使用主 API Key")
+        api_layout.addRow("API Key:", self.hedge_api_key_edit)
+
+        retry_layout = QHBoxLayout()
+        self.hedge_percentile_spin = QSpinBox()
+        self.hedge_percentile_spin.setRange(50, 99); self.hedge_percentile_spin.setSuffix("%")
+        self.hedge_percentile_spin.setValue(self.settings.get("hedge_percentile", 90))
+        self.hedge_percentile_spin.setToolTip("主线路首字延迟超过历史该分位时发出对冲请求")
+        self.max_retries_spin = QSpinBox()
+        self.max_retries_spin.setRange(0, 5); self.max_retries_spin.setValue(self.settings.get("llm_max_retries", 2))
+        retry_layout.addWidget(QLabel("对冲分位:")); retry_layout.addWidget(self.hedge_percentile_spin)
+        retry_layout.addWidget(QLabel("失败重试:")); retry_layout.addWidget(self.max_retries_spin)
+        self.exit_deadline_spin = QSpinBox()
+        self.exit_deadline_spin.setRange(2, 30); self.exit_deadline_spin.setSuffix("s")
+        self.exit_deadline_spin.setValue(self.settings.get("exit_deadline", 8))
+        self.exit_deadline_spin.setToolTip("退出时最多等待告别语的时间，超时直接关闭 (总结仍会在后台保存)")
+        retry_layout.addWidget(QLabel("退出等待:")); retry_layout.addWidget(self.exit_deadline_spin)
+        api_layout.addRow(retry_layout)
         
         self.api_status_label = QLabel("Ready")
         self.api_status_label.setStyleSheet("color: gray; font-size: 11px;")
@@ -299,12 +348,84 @@ class SettingsWindow(QWidget):
         self.active_chat_prob_spin.setValue(self.settings.get("active_chat_probability", 0.2))
         self.active_chat_interval_spin = QSpinBox()
         self.active_chat_interval_spin.setRange(10, 3600); self.active_chat_interval_spin.setValue(self.settings.get("active_chat_interval", 60))
+        self.active_prefetch_spin = QSpinBox()
+        self.active_prefetch_spin.setRange(0, 60); self.active_prefetch_spin.setValue(self.settings.get("active_prefetch_cap", 6))
+        self.active_prefetch_spin.setToolTip("空闲时预先生成主动搭话与告别语；状态变化会作废预取结果，这里限制每小时作废次数 (0=不预取)")
         chat_layout.addWidget(self.active_chat_prob_spin); chat_layout.addWidget(QLabel("间隔(s):")); chat_layout.addWidget(self.active_chat_interval_spin)
+        chat_layout.addWidget(QLabel("预取作废/h:")); chat_layout.addWidget(self.active_prefetch_spin)
         form_layout.addRow("主动搭话:", chat_layout)
 
+        touch_layout = QHBoxLayout()
         self.smart_touch_check = QCheckBox("启用智能触摸互动 (消耗Token)")
         self.smart_touch_check.setChecked(self.settings.get("smart_touch", True))
-        form_layout.addRow("互动:", self.smart_touch_check)
+        self.touch_interval_spin = QSpinBox()
+        self.touch_interval_spin.setRange(1, 50); self.touch_interval_spin.setValue(self.settings.get("touch_llm_interval", 5))
+        self.touch_interval_spin.setToolTip("每 N 次触摸调用一次 LLM，其余使用本地反应")
+        self.touch_debounce_spin = QSpinBox()
+        self.touch_debounce_spin.setRange(0, 5000); self.touch_debounce_spin.setSingleStep(100); self.touch_debounce_spin.setValue(self.settings.get("touch_debounce_ms", 800))
+        self.touch_debounce_spin.setToolTip("连续触摸在这段时间内合并为一次请求")
+        touch_layout.addWidget(self.smart_touch_check); touch_layout.addWidget(QLabel("每N次:")); touch_layout.addWidget(self.touch_interval_spin)
+        touch_layout.addWidget(QLabel("合并(ms):")); touch_layout.addWidget(self.touch_debounce_spin)
+        form_layout.addRow("互动:", touch_layout)
+
+        self.stream_reply_check = QCheckBox("回复逐字显示 (流式输出)")
+        self.stream_reply_check.setChecked(self.settings.get("stream_reply", True))
+        form_layout.addRow("显示:", self.stream_reply_check)
+
+        self.llm_broker_check = QCheckBox("LLM 调用放在独立进程中 (界面更流畅，重启后生效)")
+        self.llm_broker_check.setChecked(self.settings.get("llm_broker", False))
+        self.llm_broker_check.setToolTip("网络请求、Prompt 组装和回复解析都在子进程中完成，子进程出错时自动重启")
+        form_layout.addRow("进程:", self.llm_broker_check)
+
+        self.agent_mode_combo = QComboBox()
+        self.agent_mode_combo.addItem("双 Agent (回复 + 动作分两次调用)", "dual")
+        self.agent_mode_combo.addItem("单次调用 (省 Token，更快)", "single")
+        self.agent_mode_combo.addItem("本地动作 (仅在需要记忆时调用动作 Agent)", "local")
+        mode_index = self.agent_mode_combo.findData(self.settings.get("agent_mode", "dual"))
+        self.agent_mode_combo.setCurrentIndex(max(0, mode_index))
+        form_layout.addRow("对话模式:", self.agent_mode_combo)
+
+        self.structured_output_check = QCheckBox("动作使用结构化输出 (JSON Schema，不支持时自动退回)")
+        self.structured_output_check.setChecked(self.settings.get("structured_output", True))
+        form_layout.addRow("", self.structured_output_check)
+
+        cache_layout = QHBoxLayout()
+        self.response_cache_check = QCheckBox("缓存重复回复")
+        self.response_cache_check.setChecked(self.settings.get("response_cache", True))
+        self.cache_variety_spin = QDoubleSpinBox()
+        self.cache_variety_spin.setRange(0.0, 1.0); self.cache_variety_spin.setSingleStep(0.1)
+        self.cache_variety_spin.setValue(self.settings.get("cache_variety", 0.3))
+        cache_layout.addWidget(self.response_cache_check); cache_layout.addWidget(QLabel("多样性:")); cache_layout.addWidget(self.cache_variety_spin)
+        form_layout.addRow("缓存:", cache_layout)
+
+        budget_layout = QHBoxLayout()
+        self.context_budget_spin = QSpinBox()
+        self.context_budget_spin.setRange(0, 1000000); self.context_budget_spin.setSingleStep(500)
+        self.context_budget_spin.setValue(self.settings.get("context_token_budget", 4000))
+        self.coder_budget_spin = QSpinBox()
+        self.coder_budget_spin.setRange(0, 1000000); self.coder_budget_spin.setSingleStep(1000)
+        self.coder_budget_spin.setValue(self.settings.get("coder_context_token_budget", 0))
+        budget_layout.addWidget(QLabel("聊天:")); budget_layout.addWidget(self.context_budget_spin)
+        budget_layout.addWidget(QLabel("编程:")); budget_layout.addWidget(self.coder_budget_spin)
+        form_layout.addRow("Token预算(0=自动):", budget_layout)
+
+        self.coder_routing_check = QCheckBox("编程模式按复杂度选模型 (闲聊用 Chat 模型)")
+        self.coder_routing_check.setChecked(self.settings.get("coder_routing", True))
+        self.coder_routing_check.setToolTip("代码块、报错堆栈、长输入仍使用 Coder 模型；消息以 /coder 或 /chat 开头可手动指定")
+        form_layout.addRow("编程:", self.coder_routing_check)
+
+        self.verbose_logs_check = QCheckBox("每次调用打印上下文与 Token 用量")
+        self.verbose_logs_check.setChecked(self.settings.get("verbose_llm_logs", False))
+        form_layout.addRow("详细日志:", self.verbose_logs_check)
+
+        sched_layout = QHBoxLayout()
+        self.concurrency_spin = QSpinBox()
+        self.concurrency_spin.setRange(1, 10); self.concurrency_spin.setValue(self.settings.get("llm_max_concurrency", 2))
+        self.rate_limit_spin = QSpinBox()
+        self.rate_limit_spin.setRange(2, 1000); self.rate_limit_spin.setValue(self.settings.get("llm_rate_limit", 60))
+        sched_layout.addWidget(QLabel("并发:")); sched_layout.addWidget(self.concurrency_spin)
+        sched_layout.addWidget(QLabel("每分钟:")); sched_layout.addWidget(self.rate_limit_spin)
+        form_layout.addRow("请求限制:", sched_layout)
 
         scroll_layout.addWidget(settings_container)
 
@@ -357,6 +478,15 @@ class SettingsWindow(QWidget):
         main_layout.addWidget(self.frame)
         self.update_usage_display()
 
+        # 窗口打开时定时刷新线路排名与排队数
+        self.live_timer = QTimer(self)
+        self.live_timer.timeout.connect(self._refresh_live_stats)
+        self.live_timer.start(2000)
+
+    def _refresh_live_stats(self):
+        if self.isVisible():
+            self.update_usage_display()
+
     def on_proxy_toggle(self, state):
         """代理开关切换"""
         enabled = state == Qt.CheckState.Checked.value
@@ -393,7 +523,26 @@ class SettingsWindow(QWidget):
     def update_usage_display(self):
         tokens = get_total_usage()
         cost = (tokens / 1_000_000) * 3.0
-        self.usage_label.setText(f"本次消耗: {tokens:,} tokens | 预估: ${cost:.4f}")
+        prompt_tokens, cached_tokens = get_cache_stats()
+        cache_rate = (cached_tokens / prompt_tokens * 100) if prompt_tokens else 0.0
+        # Broker 模式下调度器与路由在子进程中，显示它带回的统计
+        remote = get_remote_stats()
+        queued = sum((remote["queue"] if remote else get_scheduler().queue_depth()).values())
+        first_reply = get_first_reply_stats()
+        first_text = " / ".join(f"{label} {'-' if first_reply[kind] is None else f'{first_reply[kind] * 1000:.0f}ms'}"
+                                for kind, label in (("cold", "冷"), ("warm", "热")))
+        agreement = get_action_engine().agreement()
+        agreement_text = "" if agreement is None else f" | 本地动作一致率: {agreement * 100:.0f}%"
+        self.usage_label.setText(f"本次消耗: {tokens:,} tokens | 预估: ${cost:.4f} | 缓存命中: {cache_rate:.0f}% | 排队: {queued}"
+                                 f" | 首条回复: {first_text}{agreement_text}")
+
+        lines = []
+        ranking = remote["ranking"] if remote else get_router().ranking()
+        for rank, (name, latency_ms, first_token_ms, error_rate, status) in enumerate(ranking, 1):
+            latency_text = "未测" if latency_ms is None else f"{latency_ms:.0f}ms"
+            first_text = "未测" if first_token_ms is None else f"{first_token_ms:.0f}ms"
+            lines.append(f"{rank}. {name}  耗时 {latency_text}  首字 {first_text}  错误率 {error_rate * 100:.0f}%  {status}")
+        self.ranking_label.setText("\n".join(lines))
 
     def get_current_proxy(self):
         """获取当前配置的代理地址"""
@@ -402,22 +551,63 @@ class SettingsWindow(QWidget):
             return proxy if proxy else None
         return None
 
+    def refresh_model_completer(self):
+        """先用缓存 (过期的也先用着) 补全；缓存过期或没有时在后台重新获取模型列表"""
+        base = self.base_url_edit.text().strip()
+        backend = self.backend_combo.currentData()
+        models = self.model_cache.get(base, allow_stale=True, backend=backend) or []
+        self.model_list_model.setStringList(models)
+
+        key = self.api_key_edit.text().strip()
+        if not self.model_cache.is_stale(base, backend) or (backend == "openai" and not key):
+            return
+        if self.model_refresh_worker is not None and self.model_refresh_worker.isRunning():
+            return
+        self.model_refresh_worker = ApiCheckWorker(key, base, self.get_current_proxy(), self.http2_check.isChecked(),
+                                                   "", "", ("connection",), backend, self.model_cache)
+        self.model_refresh_worker.result_signal.connect(self._on_models_refreshed)
+        self.model_refresh_worker.start()
+
+    def _on_models_refreshed(self, results):
+        if self.sender() is not self.model_refresh_worker:
+            return
+        if results and results[0]["ok"]:
+            models = self.model_cache.get(self.base_url_edit.text().strip(), allow_stale=True,
+                                          backend=self.backend_combo.currentData()) or []
+            self.model_list_model.setStringList(models)
+
     def check_api(self, check_type):
+        """check_type: "connection" / "chat" / "coder"，或 "all" 同时检测三项"""
         key = self.api_key_edit.text().strip()
         base = self.base_url_edit.text().strip()
-        model = self.model_name_edit.text().strip() if check_type == "chat" else self.coder_model_edit.text().strip()
         proxy = self.get_current_proxy()
+        probes = PROBES if check_type == "all" else (check_type,)
         
-        status_text = f"正在检查 {check_type}..."
+        status_text = f"正在检查 {' / '.join(PROBE_LABELS[p] for p in probes)}..."
         if proxy:
             status_text += " (使用代理)"
         self.api_status_label.setText(status_text)
         self.api_status_label.setStyleSheet("color: blue;")
         
-        self.api_worker = ApiCheckWorker(key, base, model, check_type, proxy)
-        self.api_worker.result_signal.connect(self.on_api_check_result)
+        if self.api_worker is not None:
+            self.api_worker.cancel()
+        self.api_worker = ApiCheckWorker(key, base, proxy, self.http2_check.isChecked(),
+                                         self.model_name_edit.text().strip(), self.coder_model_edit.text().strip(),
+                                         probes, self.backend_combo.currentData(), self.model_cache,
+                                         refresh_models=check_type == "connection")
+        self.api_worker.result_signal.connect(self.on_api_checks_finished)
         self.api_worker.start()
 
+    def on_api_checks_finished(self, results):
+        if self.sender() is not self.api_worker:
+            return
+        lines = [f"{PROBE_LABELS[r['probe']]} {'✓' if r['ok'] else '✗'} {r['message']} ({r['latency_ms']:.0f}ms)"
+                 for r in results]
+        passed = sum(r["ok"] for r in results)
+        color = "green" if passed == len(results) else ("red" if passed == 0 else "orange")
+        self.on_api_check_result("\n".join(lines), color)
+        self.refresh_model_completer()
+
     def on_api_check_result(self, msg, color):
         self.api_status_label.setText(msg)
         self.api_status_label.setStyleSheet(f"color: {color};")
@@ -459,6 +649,15 @@ class SettingsWindow(QWidget):
             QMessageBox.warning(self, "无效输入", "桌宠称呼过长！\n请限制在8个中文字符或12个英文字符以内。")
             return
 
+        providers_text = self.providers_edit.toPlainText().strip()
+        try:
+            providers = json.loads(providers_text) if providers_text else []
+            if not isinstance(providers, list):
+                raise ValueError
+        except ValueError:
+            QMessageBox.warning(self, "无效输入", "额外线路需要是 JSON 数组格式！")
+            return
+
         persona_text = self.persona_edit.toPlainText().strip()
         
         # [逻辑] 如果称呼不为空，且 Persona 第一句不是“你是[称呼]”，则强制覆盖/添加
@@ -471,44 +670,67 @@ class SettingsWindow(QWidget):
         new_settings = {
             "pet_name": pet_name,
             "persona": persona_text,
+            "llm_backend": self.backend_combo.currentData(),
+            "stub_latency": self.stub_latency_spin.value(),
             "api_key": self.api_key_edit.text().strip(),
             "base_url": self.base_url_edit.text().strip(),
             "model_name": self.model_name_edit.text().strip(),
             "coder_model_name": self.coder_model_edit.text().strip(),
             "proxy_enabled": self.proxy_enabled_check.isChecked(),
             "proxy_url": self.proxy_url_edit.text().strip(),
+            "http2": self.http2_check.isChecked(),
+            "providers": providers,
+            "hedge_base_url": self.hedge_base_url_edit.text().strip(),
+            "hedge_api_key": self.hedge_api_key_edit.text().strip(),
+            "hedge_percentile": self.hedge_percentile_spin.value(),
+            "llm_max_retries": self.max_retries_spin.value(),
+            "exit_deadline": self.exit_deadline_spin.value(),
             "pet_size": [self.width_spin.value(), self.height_spin.value()],
             "action_probability": self.action_prob_spin.value(),
             "active_chat_probability": self.active_chat_prob_spin.value(),
             "active_chat_interval": self.active_chat_interval_spin.value(),
-            "smart_touch": self.smart_touch_check.isChecked()
+            "active_prefetch_cap": self.active_prefetch_spin.value(),
+            "smart_touch": self.smart_touch_check.isChecked(),
+            "touch_llm_interval": self.touch_interval_spin.value(),
+            "touch_debounce_ms": self.touch_debounce_spin.value(),
+            "llm_max_concurrency": self.concurrency_spin.value(),
+            "llm_rate_limit": self.rate_limit_spin.value(),
+            "stream_reply": self.stream_reply_check.isChecked(),
+            "llm_broker": self.llm_broker_check.isChecked(),
+            "agent_mode": self.agent_mode_combo.currentData(),
+            "structured_output": self.structured_output_check.isChecked(),
+            "response_cache": self.response_cache_check.isChecked(),
+            "cache_variety": self.cache_variety_spin.value(),
+            "context_token_budget": self.context_budget_spin.value(),
+            "coder_context_token_budget": self.coder_budget_spin.value(),
+            "coder_routing": self.coder_routing_check.isChecked(),
+            "verbose_llm_logs": self.verbose_logs_check.isChecked()
         }
         self.settings_saved.emit(new_settings)
         self.hide()
 
 
-class ProxyTestWorker(QThread):
-    """后台线程：测试代理连接"""
+class ProxyTestWorker(LLMTask):
+    """在 LLMEngine 上测试代理连接 (与 LLM 请求共用连接池)"""
     result_signal = pyqtSignal(str, str)
 
     def __init__(self, proxy_url):
         super().__init__()
         self.proxy_url = proxy_url
 
-    def run(self):
+    async def run(self):
+        client = get_async_http_client("https://httpbin.org", self.proxy_url)
+        if client is None:
+            self.result_signal.emit("错误: 未安装 httpx 库", "red")
+            return
         try:
-            import httpx
-            
             # 尝试通过代理访问一个可靠的测试端点
-            with httpx.Client(proxy=self.proxy_url, timeout=10) as client:
-                response = client.get("https://httpbin.org/ip")
-                if response.status_code == 200:
-                    ip_info = response.json().get("origin", "Unknown")
-                    self.result_signal.emit(f"代理连接成功 (IP: {ip_info})", "green")
-                else:
-                    self.result_signal.emit(f"代理响应异常: {response.status_code}", "orange")
-        except ImportError:
-            self.result_signal.emit("错误: 未安装 httpx 库", "red")
+            response = await client.get("https://httpbin.org/ip", timeout=10)
+            if response.status_code == 200:
+                ip_info = response.json().get("origin", "Unknown")
+                self.result_signal.emit(f"代理连接成功 (IP: {ip_info})", "green")
+            else:
+                self.result_signal.emit(f"代理响应异常: {response.status_code}", "orange")
         except Exception as e:
             error_msg = str(e)
             if "proxy" in error_msg.lower():
@@ -0,0 +1,135 @@
+import re
+
+# tiktoken 是可选依赖 (pip install tiktoken)，没有时使用字符数估算
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 常见模型的上下文长度 (按模型名前缀匹配，越具体的放越前面)
+MODEL_CONTEXT_LIMITS = [
+    ("gpt-3.5-turbo", 16385),
+    ("gpt-4o", 128000),
+    ("gpt-4.1", 1000000),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4-32k", 32768),
+    ("gpt-4", 8192),
+    ("gpt-5", 400000),
+    ("o1", 200000),
+    ("o3", 200000),
+    ("o4", 200000),
+    ("claude", 200000),
+    ("deepseek", 64000),
+    ("qwen", 32768),
+    ("glm", 128000),
+    ("moonshot", 128000),
+    ("kimi", 128000),
+    ("gemini", 1000000),
+]
+DEFAULT_CONTEXT_LIMIT = 8192
+
+MESSAGE_OVERHEAD = 4  # 每条消息的角色/分隔符开销
+REPLY_RESERVE = 1024  # 给模型回复预留的 Token
+
+_encodings = {}
+_verbose = False  # 每次调用都打印上下文截取与 Token 用量 (设置中的 "详细日志")
+
+
+def set_verbose(enabled):
+    global _verbose
+    _verbose = bool(enabled)
+
+
+def is_verbose():
+    return _verbose
+
+
+def get_context_limit(model_name):
+    name = (model_name or "").lower()
+    for prefix, limit in MODEL_CONTEXT_LIMITS:
+        if name.startswith(prefix) or f"/{prefix}" in name:
+            return limit
+    return DEFAULT_CONTEXT_LIMIT
+
+
+def _get_encoding(model_name):
+    if not tiktoken:
+        return None
+    if model_name not in _encodings:
+        try:
+            _encodings[model_name] = tiktoken.encoding_for_model(model_name)
+        except Exception:
+            try:
+                _encodings[model_name] = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                _encodings[model_name] = None
+    return _encodings[model_name]
+
+
+def count_tokens(text, model_name=""):
+    """计算文本 Token 数。没有 tiktoken 时：中日韩字符按 1 个、其余按 4 字符 1 个估算"""
+    if not text:
+        return 0
+    encoding = _get_encoding(model_name)
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(re.findall(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages, model_name=""):
+    return sum(count_tokens(m.get("content") or "", model_name) + MESSAGE_OVERHEAD for m in messages)
+
+
+class TokenBudgetWindow:
+    """
+    按 Token 预算截取对话历史：固定部分 (system prompt + 本轮输入) 必须发送，
+    剩余预算从最新的历史往前装，装不下就停。
+    budget 为 0 时按模型上下文长度自动计算。
+    """
+    def __init__(self, label, model_name, budget=0):
+        self.label = label
+        self.last_prompt_tokens = 0
+        self.configure(model_name, budget)
+
+    def configure(self, model_name, budget=0):
+        self.model_name = model_name
+        limit = get_context_limit(model_name) - REPLY_RESERVE
+        self.budget = min(budget, limit) if budget else limit
+
+    def fit(self, history, fixed_messages):
+        """返回 (能放下的最新历史, 预计的整个请求 Token 数)"""
+        used = count_message_tokens(fixed_messages, self.model_name)
+        kept = []
+        for message in reversed(history):
+            cost = count_tokens(message.get("content") or "", self.model_name) + MESSAGE_OVERHEAD
+            if used + cost > self.budget:
+                break
+            kept.append(message)
+            used += cost
+        kept.reverse()
+
+        self.last_prompt_tokens = used
+        dropped = len(history) - len(kept)
+        if _verbose:
+            print(f"[Context:{self.label}] ~{used} / {self.budget} tokens, history {len(kept)} kept, {dropped} dropped")
+        return kept, used
+
+    def build(self, system_prompt, history, user_content):
+        """组装 system + 截取后的历史 + 本轮输入，返回 (messages, 截取后的历史)"""
+        system = {"role": "system", "content": system_prompt}
+        user = {"role": "user", "content": user_content}
+        kept, _ = self.fit(history, [system, user])
+        return [system] + kept + [user], kept
+
+    def trim(self, history):
+        """只按历史本身截取 (不打印)，用于限制内存中保存的历史长度"""
+        used = 0
+        kept = []
+        for message in reversed(history):
+            used += count_tokens(message.get("content") or "", self.model_name) + MESSAGE_OVERHEAD
+            if used > self.budget:
+                break
+            kept.append(message)
+        kept.reverse()
+        return kept
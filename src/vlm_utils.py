@@ -2,6 +2,13 @@ import sys
 import os
 import re
 import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
 try:
     from openai import OpenAI
     import httpx
@@ -14,40 +21,197 @@ from src.parameters import API_KEY as DEFAULT_API_KEY # 保留作为最后的 fa
 from src.prompts import (
     get_persona_prompt, 
     get_action_agent_prompt, 
+    get_single_agent_prompt, 
+    get_turn_context, 
     get_active_initiation_prompt, 
     get_summary_prompt, 
     get_coder_system_prompt,
+    get_coder_compaction_prompt,
     get_self_intro_prompt,
-    get_goodbye_prompt
+    get_goodbye_prompt,
+    get_exit_prompt
 )
 from src.memory_utils import MemoryManager
+from src.backend_utils import get_llm_client, configure_backend, requires_api_key
+from src.token_utils import TokenBudgetWindow, count_message_tokens, count_tokens, set_verbose, is_verbose
+from src.llm_scheduler import get_scheduler, LatencyTracker, request_priority, PRIORITY_BACKGROUND
+from src.llm_router import get_router
+from src.job_utils import get_job_queue
+from src.action_utils import TagStreamParser, PetAction, split_reply, parse_tag_json, ACTION_RESPONSE_FORMAT
+from src.action_infer_utils import get_action_engine
 
 # --- 全局 Token 统计 ---
 TOTAL_TOKEN_USAGE = 0
+TOTAL_PROMPT_TOKENS = 0
+TOTAL_CACHED_TOKENS = 0  # 服务商前缀缓存命中的输入 Token
 
 def get_total_usage():
     """获取当前会话的总 Token 消耗"""
     return TOTAL_TOKEN_USAGE
 
+def get_cache_stats():
+    """获取 (输入 Token 总数, 其中命中缓存的 Token 数)"""
+    return TOTAL_PROMPT_TOKENS, TOTAL_CACHED_TOKENS
+
+# --- 首次回复延迟 (启动或更换线路后的第一条回复) ---
+# cold: 连接还没预热好就发出的；warm: 预热完成后发出的
+FIRST_REPLY_LATENCY = {"cold": [], "warm": []}
+WARM_UP_TIMEOUT = 15.0
+
+def get_first_reply_stats():
+    """获取 {"cold": 平均秒数或 None, "warm": 平均秒数或 None}"""
+    return {kind: (sum(values) / len(values) if values else None) for kind, values in FIRST_REPLY_LATENCY.items()}
+
+def usage_snapshot():
+    """统计的快照 (LLM Broker 子进程随回复带回界面进程)"""
+    return {"total": TOTAL_TOKEN_USAGE, "prompt": TOTAL_PROMPT_TOKENS, "cached": TOTAL_CACHED_TOKENS,
+            "first_reply": FIRST_REPLY_LATENCY}
+
+def apply_usage_snapshot(snapshot):
+    global TOTAL_TOKEN_USAGE, TOTAL_PROMPT_TOKENS, TOTAL_CACHED_TOKENS
+    TOTAL_TOKEN_USAGE = snapshot.get("total", TOTAL_TOKEN_USAGE)
+    TOTAL_PROMPT_TOKENS = snapshot.get("prompt", TOTAL_PROMPT_TOKENS)
+    TOTAL_CACHED_TOKENS = snapshot.get("cached", TOTAL_CACHED_TOKENS)
+    FIRST_REPLY_LATENCY.update(snapshot.get("first_reply") or {})
+
 def _record_usage(usage_obj):
     """累加 Token 用量"""
-    global TOTAL_TOKEN_USAGE
+    global TOTAL_TOKEN_USAGE, TOTAL_PROMPT_TOKENS, TOTAL_CACHED_TOKENS
     if usage_obj:
         TOTAL_TOKEN_USAGE += usage_obj.total_tokens
+        TOTAL_PROMPT_TOKENS += getattr(usage_obj, "prompt_tokens", 0) or 0
+        # OpenAI 兼容接口把缓存命中数放在 prompt_tokens_details.cached_tokens
+        details = getattr(usage_obj, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", 0) if details else 0
+        TOTAL_CACHED_TOKENS += cached or 0
+        if is_verbose():
+            print(f"[Usage] prompt={getattr(usage_obj, 'prompt_tokens', 0)} (cached {cached or 0}) "
+                  f"completion={getattr(usage_obj, 'completion_tokens', 0)}")
 
 
-def _create_http_client(proxy_url=None):
-    """创建带代理支持的 httpx 客户端"""
-    if not httpx:
-        return None
-    
-    if proxy_url:
-        # 支持 http/https/socks5 代理
-        return httpx.Client(
-            proxy=proxy_url,
-            timeout=httpx.Timeout(60.0, connect=10.0)
-        )
-    return None
+async def _create_completion(role, client, model, **kwargs):
+    """
+    经 LLMScheduler 排队 (优先级 / 并发上限 / 限速) 后请求补全。
+    每次尝试 (包括重试) 都由 ProviderRouter 按 role ("chat" / "coder") 选择线路与模型，
+    没有可用线路时使用 client / model。
+    """
+    return await get_scheduler().run(lambda: get_router().call(
+        role, lambda c, m: c.chat.completions.create(model=m, **kwargs), client, model))
+
+HEDGE_DEFAULT_DELAY = 3.0  # 样本不足时，主线路等待多久再发对冲请求 (秒)
+
+# 不支持 response_format=json_schema 的线路 (base_url)，之后的 Action Agent 改用 <ACTION> 标签
+_STRUCTURED_UNSUPPORTED = set()
+
+def _is_structured_unsupported(error):
+    status = getattr(error, "status_code", None)
+    text = str(error).lower()
+    return status in (400, 422) and ("response_format" in text or "json_schema" in text or "schema" in text)
+
+
+class ResponseCache:
+    """
+    可重复调用的回复缓存（自我介绍、告别、触摸反应等）。
+    键是归一化后的 Prompt 指纹：数值按区间分桶，而不是精确匹配。
+    内存中按 LRU + TTL 淘汰，可选落盘到 data/response_cache.json。
+    variety 控制命中后仍重新生成的概率，同一个键最多保留 MAX_VARIANTS 个不同回复轮流使用。
+    """
+    STAT_BUCKET = 20       # 数值分桶宽度 (0-100 分成 5 档)
+    MAX_VARIANTS = 3
+    BUCKETED_STATS = ("hunger", "thirst", "fatigue", "boredom", "mood", "intimacy")
+
+    def __init__(self, memory_manager, settings):
+        self.memory_manager = memory_manager
+        self.entries = OrderedDict()  # key -> {"updated": ts, "variants": [[reply, action], ...]}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.configure(settings)
+        if self.persist:
+            self._load()
+
+    def configure(self, settings):
+        self.enabled = settings.get("response_cache", True)
+        self.variety = settings.get("cache_variety", 0.3)
+        self.ttl = settings.get("cache_ttl", 86400)
+        self.max_entries = settings.get("cache_max_entries", 200)
+        self.persist = settings.get("cache_persist", True)
+
+    @classmethod
+    def make_key(cls, kind, persona_text, text="", current_stats=None, relationship=""):
+        """生成归一化指纹：去掉多余空白，数值分桶，时间只保留时段"""
+        current_stats = current_stats or {}
+        buckets = {k: int(float(current_stats.get(k, 0)) // cls.STAT_BUCKET) for k in cls.BUCKETED_STATS}
+        fingerprint = {
+            "kind": kind,
+            "persona": hashlib.sha1((persona_text or "").strip().encode("utf-8")).hexdigest(),
+            "text": re.sub(r"\s+", " ", text or "").strip(),
+            "relationship": (relationship or "").strip(),
+            "stats": buckets,
+            "period": time.localtime().tm_hour // 6,  # 凌晨/上午/下午/晚上
+        }
+        raw = json.dumps(fingerprint, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _load(self):
+        now = time.time()
+        data = self.memory_manager.load_response_cache()
+        items = sorted(data.items(), key=lambda kv: kv[1].get("updated", 0))
+        for key, entry in items:
+            if now - entry.get("updated", 0) <= self.ttl and entry.get("variants"):
+                self.entries[key] = entry
+        self._evict()
+
+    def _save(self):
+        if self.persist:
+            self.memory_manager.save_response_cache(dict(self.entries))
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def lookup(self, key):
+        """返回 (reply, action) 或 None。按 variety 概率故意不命中，以便积累新的说法"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry["updated"] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if not entry or random.random() < self.variety:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            reply, action = random.choice(entry["variants"])
+        print(f"[ResponseCache] Hit ({self.hits} hits / {self.misses} misses)")
+        return reply, dict(action)
+
+    def peek(self, key):
+        """只读查询：不受 variety 影响，也不计入命中统计"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self.entries.get(key)
+            if not entry or time.time() - entry["updated"] > self.ttl:
+                return None
+            reply, action = random.choice(entry["variants"])
+        return reply, dict(action)
+
+    def store(self, key, reply, action=None):
+        if not self.enabled or not reply:
+            return
+        with self._lock:
+            entry = self.entries.get(key) or {"updated": 0, "variants": []}
+            if [reply, action or {}] not in entry["variants"]:
+                entry["variants"].append([reply, action or {}])
+                entry["variants"] = entry["variants"][-self.MAX_VARIANTS:]
+            entry["updated"] = time.time()
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._evict()
+            self._save()
 
 
 class LLMClient:
@@ -60,144 +224,420 @@ class LLMClient:
         self.base_url = settings.get("base_url", "https://api.openai.com/v1")
         self.model_name = settings.get("model_name", "gpt-3.5-turbo")
         self.proxy_url = settings.get("proxy_url", None)  # 新增代理配置
+        self.http2 = settings.get("http2", False)
+        self.stream_reply = settings.get("stream_reply", True)  # 流式显示回复
+        # "dual": Persona + Action 两次调用; "single": 单次调用; "local": 动作本地推断，必要时才调用 Action Agent
+        self.agent_mode = settings.get("agent_mode", "dual")
+        self.structured_output = settings.get("structured_output", True)  # Action Agent 使用 JSON Schema 输出
+        # 对冲请求：主线路迟迟不出字时，向备用线路发出同样的请求
+        self.hedge_base_url = settings.get("hedge_base_url", "")
+        self.hedge_api_key = settings.get("hedge_api_key", "")
+        self.hedge_percentile = settings.get("hedge_percentile", 90)
+        # 流式调用记录首字延迟，非流式调用记录整段耗时，两者分开统计各自的对冲时机
+        self.latency = {"stream": LatencyTracker(), "complete": LatencyTracker()}
         
+        configure_backend(settings)
+        set_verbose(settings.get("verbose_llm_logs", False))
         self._init_client()
+        get_scheduler().configure(settings)
+        get_router().configure(settings)
+        self.response_cache = ResponseCache(self.memory_manager, settings)
         self.session_raw_history = [] 
+        self.session_id = uuid.uuid4().hex
+        self._checkpointed = None  # 上次写进任务队列时的 (会话, 条数)
+        # 会话总结与记忆写入走持久化任务队列，进程意外退出后下次启动补做
+        get_job_queue().register("session_summary", self.summarize_history)
+        get_job_queue().register("memory_write", self.apply_memory_write)
         self.context_window = [] 
+        # 按 Token 预算截取历史，而不是固定条数
+        self.context_budget = TokenBudgetWindow("chat", self.model_name, settings.get("context_token_budget", 4000))
+        self.last_first_token_latency = None  # 最近一次流式回复的首字延迟 (秒)
+        # 连接预热：None 未预热 / "warming" / "warm" / "failed" (网络不通) / "rejected" (Key 被拒绝)
+        self.warm_state = None
+        self.first_reply_pending = True
+        self._audits = set()  # 后台进行中的一致率对照
+        self._memory_writes = set()  # 后台进行中的记忆写入
+
+    def _connection_key(self):
+        providers = tuple(endpoint.key() for endpoint in get_router().endpoints)
+        return (requires_api_key(), self.base_url, self.api_key, self.proxy_url, self.http2, self.hedge_base_url,
+                providers)
+
+    def needs_warm_up(self):
+        return self.client is not None and self.warm_state is None
+
+    async def warm_up(self):
+        """
+        预热连接池：发一个很轻的带鉴权请求 (models.list)，把 DNS / TCP / TLS / 代理握手提前做掉。
+        主线路、对冲线路和路由中的额外线路一起预热；只有主线路的结果作为 is_ready 的依据 (Key 被拒绝时不再发起对话)，
+        额外线路的结果只打印出来，出错由路由的失败统计处理。
+        """
+        if self.client is None:
+            return
+        key = self._connection_key()
+        self.warm_state = "warming"
+        start = time.monotonic()
+
+        async def probe(client):
+            try:
+                await asyncio.wait_for(client.models.list(), WARM_UP_TIMEOUT)
+                return "warm"
+            except Exception as e:
+                status = getattr(e, "status_code", None)
+                if status in (401, 403):
+                    return "rejected"
+                # 其他 HTTP 错误 (比如不支持 models 接口) 说明连接已经建立
+                return "warm" if status is not None else "failed"
+
+        router = get_router()
+        clients = {"主线路": self.client}
+        if self.hedge_client:
+            clients["对冲线路"] = self.hedge_client
+        for endpoint in router.endpoints:
+            client = router.client_for(endpoint)
+            if all(client is not known for known in clients.values()):
+                clients[endpoint.name] = client
+        states = dict(zip(clients, await asyncio.gather(*(probe(c) for c in clients.values()))))
+        if key != self._connection_key():
+            return  # 预热期间配置又变了，等新的预热
+        self.warm_state = states.pop("主线路")
+        print(f"[LLMClient] Warm-up {self.warm_state} in {(time.monotonic() - start) * 1000:.0f}ms")
+        for name, state in states.items():
+            if state != "warm":
+                print(f"[LLMClient] Warm-up of {name}: {state}")
+
+    def _note_first_reply(self, seconds):
+        """记录启动 (或更换线路) 后第一条回复的延迟，按是否已经预热分开统计"""
+        if not self.first_reply_pending:
+            return
+        self.first_reply_pending = False
+        kind = "warm" if self.warm_state == "warm" else "cold"
+        FIRST_REPLY_LATENCY[kind].append(seconds)
+        print(f"[LLMClient] First reply ({kind} connection) in {seconds:.2f}s")
 
     def _init_client(self):
-        if not OpenAI:
+        if not OpenAI and requires_api_key():
             self.client = None
+            self.hedge_client = None
             return
         try:
-            # 构建客户端参数
-            client_kwargs = {
-                "api_key": self.api_key,
-                "base_url": self.base_url
-            }
-            
-            # 如果配置了代理，创建带代理的 http_client
+            # 共享连接池：base_url / 代理不变时复用已有连接；模拟后端下返回本地客户端
+            self.client = get_llm_client(self.api_key, self.base_url, self.proxy_url, self.http2)
+            self.hedge_client = None
+            if self.hedge_base_url:
+                self.hedge_client = get_llm_client(self.hedge_api_key or self.api_key, self.hedge_base_url,
+                                                   self.proxy_url, self.http2)
             if self.proxy_url:
-                http_client = _create_http_client(self.proxy_url)
-                if http_client:
-                    client_kwargs["http_client"] = http_client
-                    print(f"[LLMClient] Using proxy: {self.proxy_url}")
-            
-            self.client = OpenAI(**client_kwargs)
+                print(f"[LLMClient] Using proxy: {self.proxy_url}")
         except Exception as e:
             print(f"Error initializing OpenAI client: {e}")
             self.client = None
+            self.hedge_client = None
 
     def update_config(self, settings):
         """更新 API 配置"""
+        old_connection = self._connection_key()
         self.api_key = settings.get("api_key", self.api_key)
         self.base_url = settings.get("base_url", self.base_url)
         self.model_name = settings.get("model_name", self.model_name)
         self.proxy_url = settings.get("proxy_url", self.proxy_url)  # 新增
+        self.http2 = settings.get("http2", self.http2)
+        self.stream_reply = settings.get("stream_reply", self.stream_reply)
+        self.agent_mode = settings.get("agent_mode", self.agent_mode)
+        self.structured_output = settings.get("structured_output", self.structured_output)
+        self.hedge_base_url = settings.get("hedge_base_url", self.hedge_base_url)
+        self.hedge_api_key = settings.get("hedge_api_key", self.hedge_api_key)
+        self.hedge_percentile = settings.get("hedge_percentile", self.hedge_percentile)
+        self.response_cache.configure(settings)
+        get_scheduler().configure(settings)
+        get_router().configure(settings)
+        configure_backend(settings)
+        set_verbose(settings.get("verbose_llm_logs", False))
+        self.context_budget.configure(self.model_name, settings.get("context_token_budget", self.context_budget.budget))
         self._init_client()
+        if self._connection_key() != old_connection:
+            # 线路或代理变了，需要重新预热
+            self.warm_state = None
+            self.first_reply_pending = True
         print(f"[LLMClient] Config updated. Model: {self.model_name}")
 
     def is_ready(self):
-        """检查 API 客户端是否已准备就绪"""
-        return self.client is not None and self.api_key and len(self.api_key) > 5
+        """检查 API 客户端是否已准备就绪 (预热时 Key 被拒绝也视为未就绪)"""
+        if not requires_api_key():
+            return self.client is not None
+        return self.client is not None and self.api_key and len(self.api_key) > 5 and self.warm_state != "rejected"
+
+    async def _stream_completion(self, messages, temperature, on_delta):
+        """
+        流式请求补全。每收到新的可见文本，就把累积的可见文本交给 on_delta。
+        返回完整的原始文本。整段读取都占用调度器的一个名额。
+        """
+        return await self._hedged(lambda hedge, claim: get_scheduler().run(
+            lambda: self._route(hedge, lambda client, model, first_token: self._read_stream(
+                client, model, messages, temperature, on_delta, claim, first_token), stream=True)), stream=True)
 
-    def _repair_json(self, json_str):
+    def _route(self, hedge, request, stream=False):
+        """主线路由 ProviderRouter 选择 (stream=True 时记录首字延迟)；对冲请求固定发往备用线路"""
+        if hedge:
+            return request(self.hedge_client, self.model_name, *((lambda: None,) if stream else ()))
+        return get_router().call("chat", request, self.client, self.model_name, stream=stream)
+
+    async def _read_stream(self, client, model, messages, temperature, on_delta, claim, first_token):
+        start_time = time.time()
+        first_token_time = None
+        pieces = []
+        parser = TagStreamParser()
+        last_visible = ""
+
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
         try:
-            return json.loads(json_str)
-        except json.JSONDecodeError:
-            fixed_str = re.sub(r',\s*([\]}])', r'\1', json_str)
-            try:
-                return json.loads(fixed_str)
-            except json.JSONDecodeError:
-                return {}
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    _record_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                pieces.append(delta)
 
-    def _extract_action_block(self, text):
-        action_pattern = r'<ACTION>(.*?)</ACTION>'
-        match = re.search(action_pattern, text, re.DOTALL)
-        if match:
-            json_str = match.group(1).strip()
-            return self._repair_json(json_str)
-        return {}
+                visible = parser.feed(delta)
+                if not visible or visible == last_visible:
+                    continue
+                last_visible = visible
+                if first_token_time is None:
+                    if not claim():
+                        return ""  # 另一路已经先出字
+                    first_token_time = time.time()
+                    first_token()
+                    self.last_first_token_latency = first_token_time - start_time
+                    print(f"[LLMClient] First visible token in {self.last_first_token_latency:.2f}s")
+                    self._note_first_reply(self.last_first_token_latency)
+                on_delta(visible)
+        except Exception as e:
+            if first_token_time is not None:
+                e.no_retry = True  # 回复已经开始显示，重试会让气泡从头再来一遍
+            raise
 
-    def chat(self, user_input, current_stats, persona_text):
-        if not self.client: return "OpenAI未安装", {}
+        return "".join(pieces)
 
-        memories = self.memory_manager.load_long_term_memories()
-        recent_memories = self.memory_manager.load_recent_memories()
+    async def _hedged(self, make_attempt, stream=False):
+        """
+        对冲请求：主线路超过历史延迟 (流式看首字，非流式看整段) 的 hedge_percentile 分位
+        还没出字，就向备用 base_url 发出同样的请求，谁先出字用谁，另一路取消。
+        make_attempt(hedge, claim) 返回协程；claim() 在收到首个 Token 时调用，返回 False 表示已输给另一路。
+        主线路在等待期间就已经结束 (包括重试用尽后失败) 时不对冲，结果或错误照常交给调用方。
+        """
+        tracker = self.latency["stream" if stream else "complete"]
+        start = time.time()
+        tasks = {}
+        winner = []
 
-        # === Step 1: Persona Agent ===
-        persona_prompt = get_persona_prompt(current_stats, memories, recent_memories, persona_text)
-        persona_messages = [{"role": "system", "content": persona_prompt}]
-        persona_messages.extend(self.context_window)
-        persona_messages.append({"role": "user", "content": user_input})
+        def claim(tag):
+            if not winner:
+                winner.append(tag)
+                # 输给备用线路时，主线路的延迟只知道下界，同样记录
+                tracker.record(time.time() - start)
+                for other, task in tasks.items():
+                    if other != tag:
+                        task.cancel()
+            return winner[0] == tag
 
+        primary = tasks["primary"] = asyncio.ensure_future(make_attempt(False, lambda: claim("primary")))
         try:
-            completion = self.client.chat.completions.create(
-                model=self.model_name, # 使用动态配置的模型名
-                messages=persona_messages, 
-                temperature=0.8
-            )
-            text_reply = completion.choices[0].message.content.strip()
-            _record_usage(completion.usage)
-            
-            text_reply = re.sub(r'<ACTION>.*?</ACTION>', '', text_reply, flags=re.DOTALL).strip()
-            text_reply = re.sub(r'<REASONING>.*?</REASONING>', '', text_reply, flags=re.DOTALL).strip()
+            delay = None
+            if self.hedge_client:
+                delay = tracker.percentile(self.hedge_percentile, HEDGE_DEFAULT_DELAY)
+            await asyncio.wait([primary], timeout=delay)
+            # 只有主线路还在等第一个 Token 时才对冲
+            if not self.hedge_client or winner or primary.done():
+                result = await primary
+                claim("primary")
+                return result
 
-        except Exception as e:
-            print(f"Persona Agent Error: {e}")
-            return f"Error: {str(e)}", {}
+            print(f"[LLMClient] Primary still waiting after {delay:.1f}s, hedging to {self.hedge_base_url}")
+            tasks["hedge"] = asyncio.ensure_future(make_attempt(True, lambda: claim("hedge")))
+            pending = set(tasks.values())
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    tag = "primary" if task is primary else "hedge"
+                    if claim(tag):
+                        if tag == "hedge":
+                            print("[LLMClient] Hedged request won")
+                        return task.result()
+            raise error or asyncio.CancelledError()
+        finally:
+            for task in tasks.values():
+                task.cancel()
 
-        # === Step 2: Action Agent ===
-        action_data = {}
+    async def _run_action_agent(self, current_stats, memories, user_input, text_reply):
+        """第二次调用：根据对话生成 Action JSON (线路支持时用 JSON Schema 约束输出，省去标签)"""
+        structured = self.structured_output and self.base_url not in _STRUCTURED_UNSUPPORTED
         try:
-            action_prompt = get_action_agent_prompt(current_stats, memories, user_input, text_reply)
-            action_messages = [{"role": "system", "content": action_prompt}]
-            
-            action_completion = self.client.chat.completions.create(
-                model=self.model_name, # Action Agent 使用相同的模型
-                messages=action_messages, 
-                temperature=0.3
-            )
+            try:
+                action_completion = await self._request_action(current_stats, memories, user_input, text_reply, structured)
+            except Exception as e:
+                if not (structured and _is_structured_unsupported(e)):
+                    raise
+                print(f"[Action Agent] Structured output unsupported by {self.base_url}, falling back to tags")
+                _STRUCTURED_UNSUPPORTED.add(self.base_url)
+                action_completion = await self._request_action(current_stats, memories, user_input, text_reply, False)
             _record_usage(action_completion.usage)
-            
-            raw_action_response = action_completion.choices[0].message.content
-            action_data = self._extract_action_block(raw_action_response)
-            if action_data:
-                print(f"[Action Agent]: {action_data}")
 
+            _, action = split_reply(action_completion.choices[0].message.content or "")
+            if action:
+                print(f"[Action Agent]: {action.to_dict()}")
+            return action
         except Exception as e:
             print(f"Action Agent Error: {e}")
-            pass
+            return PetAction()
 
-        # === Step 3: Update ===
+    async def _infer_action(self, current_stats, memories, user_input, text_reply, is_touch=False):
+        """
+        本地模式：动画与数值本地推断，立即返回；输入里有记忆或关系线索时才请求 Action Agent。
+        没有线索的回合按比例在后台请求一次，用来统计一致率 (并补上被漏掉的记忆)。
+        """
+        engine = get_action_engine()
+        local = engine.infer(user_input, text_reply, current_stats, is_touch=is_touch)
+        if engine.needs_remote(user_input, current_stats, is_touch=is_touch):
+            remote = await self._run_action_agent(current_stats, memories, user_input, text_reply)
+            engine.compare(local, remote, flagged=True)
+            return remote if remote else local
+        print(f"[Action (local)]: {local.to_dict()}")
+        if engine.should_audit():
+            task = asyncio.create_task(self._audit_action(local, current_stats, memories, user_input, text_reply))
+            self._audits.add(task)
+            task.add_done_callback(self._audits.discard)
+        return local
+
+    async def _audit_action(self, local, current_stats, memories, user_input, text_reply):
+        request_priority.set(PRIORITY_BACKGROUND)
+        remote = await self._run_action_agent(current_stats, memories, user_input, text_reply)
+        get_action_engine().compare(local, remote, flagged=False)
+        self._save_memories(memorize=remote.memorize, relationship=remote.update_relationship)
+
+    def _request_action(self, current_stats, memories, user_input, text_reply, structured):
+        action_prompt = get_action_agent_prompt(current_stats, memories, user_input, text_reply, structured=structured)
+        kwargs = {"response_format": ACTION_RESPONSE_FORMAT} if structured else {}
+        return _create_completion("chat", self.client, self.model_name,  # Action Agent 使用相同的模型
+            messages=[{"role": "system", "content": action_prompt}],
+            temperature=0.3,
+            **kwargs
+        )
+
+    def _remember_turn(self, user_input, text_reply):
         self.context_window.append({"role": "user", "content": user_input})
         self.context_window.append({"role": "assistant", "content": text_reply})
-        if len(self.context_window) > 10: self.context_window = self.context_window[-10:]
+        self.context_window = self.context_budget.trim(self.context_window)
         
         self.session_raw_history.append(f"User: {user_input}")
         self.session_raw_history.append(f"Pet: {text_reply}")
 
-        if "memorize" in action_data and action_data["memorize"]:
-            self.memory_manager.add_memory(action_data["memorize"])
-        if "update_relationship" in action_data and action_data["update_relationship"]:
-            self.memory_manager.update_relationship(action_data["update_relationship"])
+    async def chat(self, user_input, current_stats, persona_text, on_delta=None, cacheable=False, is_touch=False):
+        """
+        on_delta: 可选回调，开启流式显示时会以累积的可见文本被反复调用。
+        Action Agent 在流式输出结束后才开始。
+        cacheable: 可重复的输入（如触摸），允许复用 ResponseCache 中相同情境下的回复。
+        is_touch: 纯触摸互动 (本地动作推断按触摸规则处理，不请求记忆)。
+        """
+        if not self.client: return "OpenAI未安装", {}
 
-        return text_reply, action_data
+        memories = self.memory_manager.load_long_term_memories()
+        recent_memories = self.memory_manager.load_recent_memories()
+
+        cache_key = None
+        if cacheable:
+            cache_key = ResponseCache.make_key("chat", persona_text, user_input, current_stats, memories[0])
+            cached = self.response_cache.lookup(cache_key)
+            if cached:
+                text_reply, action_data = cached
+                if on_delta: on_delta(text_reply)
+                self._remember_turn(user_input, text_reply)
+                return text_reply, action_data
+
+        single_mode = self.agent_mode == "single"
+
+        # === Step 1: Persona Agent (单次调用模式下同时输出 <ACTION>) ===
+        if single_mode:
+            persona_prompt = get_single_agent_prompt(memories, recent_memories, persona_text)
+        else:
+            persona_prompt = get_persona_prompt(memories, recent_memories, persona_text)
+        # 稳定的 system prompt + 历史在前，时间与数值只附在本轮用户消息里 (历史中仍保存原始输入)
+        persona_messages, _ = self.context_budget.build(persona_prompt, self.context_window,
+                                                        get_turn_context(current_stats, user_input))
+
+        try:
+            if self.stream_reply and on_delta:
+                raw_reply = (await self._stream_completion(persona_messages, 0.8, on_delta)).strip()
+            else:
+                start_time = time.time()
+                completion = await self._hedged(lambda hedge, claim: get_scheduler().run(
+                    lambda: self._route(hedge, lambda client, model: client.chat.completions.create(
+                        model=model,
+                        messages=persona_messages,
+                        temperature=0.8
+                    ))))
+                raw_reply = completion.choices[0].message.content.strip()
+                _record_usage(completion.usage)
+                self._note_first_reply(time.time() - start_time)
+            
+            text_reply, action = split_reply(raw_reply)
+
+        except Exception as e:
+            print(f"Persona Agent Error: {e}")
+            return f"Error: {str(e)}", {}
+
+        # === Step 2: Action Agent ===
+        # 单次调用模式下直接使用回复中的 <ACTION>；模型没有给出时退回 Action Agent
+        if single_mode and action:
+            print(f"[Action (single)]: {action.to_dict()}")
+        elif self.agent_mode == "local":
+            action = await self._infer_action(current_stats, memories, user_input, text_reply, is_touch)
+        else:
+            action = await self._run_action_agent(current_stats, memories, user_input, text_reply)
+
+        # === Step 3: Update ===
+        self._remember_turn(user_input, text_reply)
+        if cache_key:
+            # 缓存只保留表现层的动作，记忆与关系变更不重放
+            self.response_cache.store(cache_key, text_reply, action.presentation().to_dict())
 
-    def get_self_introduction(self, persona_text):
-        """生成初次见面的自我介绍"""
+        self._save_memories(memorize=action.memorize, relationship=action.update_relationship)
+
+        return text_reply, action.to_dict()
+
+    async def get_self_introduction(self, persona_text, current_stats=None):
+        """生成初次见面的自我介绍 (时间与数值随用户消息发出，和聊天一样不进 system prompt)"""
         if not self.client: return "你好呀！我是你的桌面伙伴。（API未连接）", {}
         
+        cache_key = ResponseCache.make_key("intro", persona_text, current_stats=current_stats)
         prompt = get_self_intro_prompt(persona_text)
         try:
-            completion = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[{"role": "system", "content": prompt}, {"role": "user", "content": "Start Intro"}],
-                temperature=0.9,
-            )
-            text_reply = completion.choices[0].message.content.strip()
-            _record_usage(completion.usage)
-            text_reply = re.sub(r'<ACTION>.*?</ACTION>', '', text_reply, flags=re.DOTALL).strip()
+            cached = self.response_cache.lookup(cache_key)
+            if cached:
+                text_reply = cached[0]
+            else:
+                completion = await _create_completion("chat", self.client, self.model_name,
+                    messages=[{"role": "system", "content": prompt},
+                              {"role": "user", "content": get_turn_context(current_stats or {}, "Start Intro")}],
+                    temperature=0.9,
+                )
+                _record_usage(completion.usage)
+                text_reply, _ = split_reply(completion.choices[0].message.content or "")
+                self.response_cache.store(cache_key, text_reply)
             
             self.context_window.append({"role": "assistant", "content": text_reply})
             self.session_raw_history.append(f"Pet (Intro): {text_reply}")
@@ -207,81 +647,304 @@ class LLMClient:
             print(f"Self Intro Error: {e}")
             return "你好！很高兴见到你！", {}
 
-    def get_goodbye_message(self, persona_text, current_stats):
+    async def get_goodbye_message(self, persona_text, current_stats):
         """生成告别语"""
         if not self.client: return "再见啦！", {}
-        
-        prompt = get_goodbye_prompt(persona_text, current_stats)
         try:
-            completion = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[{"role": "system", "content": prompt}],
-                temperature=0.9,
-            )
-            text_reply = completion.choices[0].message.content.strip()
-            _record_usage(completion.usage)
-            text_reply = re.sub(r'<ACTION>.*?</ACTION>', '', text_reply, flags=re.DOTALL).strip()
-            
-            self.context_window.append({"role": "assistant", "content": text_reply})
-            self.session_raw_history.append(f"Pet (Goodbye): {text_reply}")
-            
-            return text_reply, {}
+            text_reply = await self.compose_goodbye(persona_text, current_stats)
         except Exception as e:
             print(f"Goodbye Error: {e}")
             return "拜拜！下次见！", {}
+        self.remember_goodbye(text_reply)
+        return text_reply, {}
+
+    async def compose_goodbye(self, persona_text, current_stats):
+        """生成告别语，不写入上下文 (可用于预取)"""
+        relationship = self.memory_manager.load_long_term_memories()[0]
+        cache_key = ResponseCache.make_key("goodbye", persona_text, "", current_stats, relationship)
+        prompt = get_goodbye_prompt(persona_text, current_stats)
+        cached = self.response_cache.lookup(cache_key)
+        if cached:
+            return cached[0]
+        completion = await _create_completion("chat", self.client, self.model_name,
+            messages=[{"role": "system", "content": prompt}],
+            temperature=0.9,
+        )
+        _record_usage(completion.usage)
+        text_reply, _ = split_reply(completion.choices[0].message.content or "")
+        self.response_cache.store(cache_key, text_reply)
+        return text_reply
+
+    def remember_goodbye(self, text_reply):
+        self.context_window.append({"role": "assistant", "content": text_reply})
+        self.session_raw_history.append(f"Pet (Goodbye): {text_reply}")
 
-    def initiate_conversation(self, current_stats, persona_text):
+    async def initiate_conversation(self, current_stats, persona_text):
+        text_reply, action_data = await self.compose_active_message(current_stats, persona_text)
+        if text_reply:
+            self.remember_active_message(text_reply)
+        return text_reply, action_data
+
+    async def compose_active_message(self, current_stats, persona_text):
+        """生成一条主动搭话，不写入上下文 (可用于预取)"""
         if not self.client: return "...", {}
         memories = self.memory_manager.load_long_term_memories()
         recent_history_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in self.context_window[-4:]])
         
-        system_prompt = get_active_initiation_prompt(current_stats, memories, recent_history_text, persona_text)
+        single_mode = self.agent_mode == "single"
+        
+        system_prompt = get_active_initiation_prompt(current_stats, memories, recent_history_text, persona_text,
+                                                     with_action=single_mode)
         try:
-            completion = self.client.chat.completions.create(
-                model=self.model_name,
+            completion = await _create_completion("chat", self.client, self.model_name,
                 messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": "Start"}],
                 temperature=0.9,
             )
-            text_reply = completion.choices[0].message.content.strip()
             _record_usage(completion.usage)
-            text_reply = re.sub(r'<ACTION>.*?</ACTION>', '', text_reply, flags=re.DOTALL).strip()
-        except: return "", {}
+            text_reply, action = split_reply(completion.choices[0].message.content or "")
+        except Exception: return "", {}
+
+        if self.agent_mode == "local":
+            action = get_action_engine().infer("(系统触发主动搭话)", text_reply, current_stats)
+        elif not (single_mode and action):
+            action = await self._run_action_agent(current_stats, memories, "(系统触发主动搭话)", text_reply)
+
+        # 主动搭话不修改记忆与关系
+        return text_reply, action.presentation().to_dict()
 
-        action_data = {}
+    def remember_active_message(self, text_reply):
+        """主动搭话真正显示后才记入上下文"""
+        self.context_window.append({"role": "assistant", "content": text_reply})
+        self.session_raw_history.append(f"Pet (Active): {text_reply}")
+        self.context_window = self.context_budget.trim(self.context_window)
+
+    async def finish_session(self, persona_text, current_stats, goodbye=None):
+        """
+        退出流程：一次调用同时得到告别语、会话摘要和最后的记忆/关系变更，拿到后立即保存。
+        本次没有对话时只需要告别语，走 get_goodbye_message (可以命中缓存)。
+        goodbye: 已经预取并显示的告别语，此时只需要总结与记忆更新。
+        """
+        if not self.client: return goodbye or "再见啦！", {}
+        if not self.session_raw_history:
+            if goodbye:
+                self.remember_goodbye(goodbye)
+                return goodbye, {}
+            return await self.get_goodbye_message(persona_text, current_stats)
+
+        memories = self.memory_manager.load_long_term_memories()
+        prompt = get_exit_prompt(persona_text, current_stats, memories, "\n".join(self.session_raw_history))
         try:
-            action_prompt = get_action_agent_prompt(current_stats, memories, "(系统触发主动搭话)", text_reply)
-            action_completion = self.client.chat.completions.create(
-                model=self.model_name, messages=[{"role": "system", "content": action_prompt}], temperature=0.3
+            completion = await _create_completion("chat", self.client, self.model_name,
+                messages=[{"role": "system", "content": prompt}],
+                temperature=0.7,
             )
-            _record_usage(action_completion.usage) 
-            action_data = self._extract_action_block(action_completion.choices[0].message.content)
-            
-            if "update_relationship" in action_data: del action_data["update_relationship"]
-            if "memorize" in action_data: del action_data["memorize"]
-        except: pass
+            _record_usage(completion.usage)
+            result = parse_tag_json(completion.choices[0].message.content or "", "EXIT")
+        except Exception as e:
+            print(f"Exit Pipeline Error: {e}")
+            result = {}
+
+        if not result.get("summary"):
+            # 合并调用失败时退回单独总结；再失败的话任务留在队列里，下次启动补做
+            await self.summarize_session()
+        else:
+            # 先把记忆写入任务落盘，再移除会话任务：中途退出时只会补写记忆，不会重复总结
+            self._save_memories(summary=result["summary"], memorize=result.get("memorize"),
+                                relationship=result.get("update_relationship"))
+            self._end_session()
 
+        text_reply = goodbye or (result.get("goodbye") or "").strip() or "拜拜！下次见！"
         self.context_window.append({"role": "assistant", "content": text_reply})
-        self.session_raw_history.append(f"Pet (Active): {text_reply}")
-        if len(self.context_window) > 10: self.context_window = self.context_window[-10:]
+        return text_reply, {}
 
-        return text_reply, action_data
+    def session_length(self):
+        """本次会话的对话条数 (预取指纹用)"""
+        return len(self.session_raw_history)
+
+    def peek_response(self, cache_key):
+        """查看缓存的回复但不计入命中 (本地触摸反应用)"""
+        return self.response_cache.peek(cache_key)
+
+    def has_pending_jobs(self):
+        return bool(get_job_queue().pending())
 
-    def summarize_session(self):
+    async def run_jobs(self):
+        """执行任务队列中的待办任务 (上次没做完的会话总结等)"""
+        await get_job_queue().run_pending()
+
+    def _session_key(self):
+        return f"session:{self.session_id}"
+
+    async def checkpoint_session(self):
+        """
+        把本次会话的原始记录写进任务队列 (暂不执行)；进程意外退出时下次启动会补做总结。
+        在引擎线程上运行 (与修改会话记录的协程同一线程)，会话没有新内容时不重写 jobs.json。
+        """
+        mark = (self.session_id, len(self.session_raw_history))
+        if not self.session_raw_history or mark == self._checkpointed:
+            return
+        get_job_queue().put("session_summary", self._session_key(),
+                            {"id": self._session_key(), "history": list(self.session_raw_history)}, hold=True)
+        self._checkpointed = mark
+
+    def _end_session(self):
+        """本次会话已经总结，移除任务并开始新的会话"""
+        get_job_queue().complete(self._session_key())
+        self.session_raw_history = []
+        self.session_id = uuid.uuid4().hex
+
+    async def summarize_session(self):
         if not self.client or not self.session_raw_history: return
-        history_text = "\n".join(self.session_raw_history)
+        queue = get_job_queue()
+        queue.put("session_summary", self._session_key(),
+                  {"id": self._session_key(), "history": list(self.session_raw_history)})
+        if await queue.run(self._session_key()):
+            self._end_session()
+
+    def _save_memories(self, summary=None, memorize=None, relationship=None):
+        """
+        写入中期记忆摘要 / 长期记忆 / 关系变更。任务先落盘再在后台执行，
+        不阻塞当前回复；进程在写完之前退出时，下次启动补写。
+        """
+        payload = {name: value.strip() for name, value in
+                   (("summary", summary), ("memorize", memorize), ("relationship", relationship))
+                   if isinstance(value, str) and value.strip()}
+        if not payload:
+            return None
+        key = f"memory:{uuid.uuid4().hex}"
+        payload["id"] = key
+        queue = get_job_queue()
+        queue.put("memory_write", key, payload)
+        task = asyncio.create_task(queue.run(key))
+        self._memory_writes.add(task)
+        task.add_done_callback(self._memory_writes.discard)
+        return task
+
+    async def apply_memory_write(self, payload):
+        """任务队列的处理函数：重放也不会写重 (摘要按任务 key 去重，其余两项本身幂等)"""
+        if payload.get("summary"):
+            self.memory_manager.add_recent_memory(payload["summary"], entry_id=payload.get("id"))
+        if payload.get("memorize"):
+            self.memory_manager.add_memory(payload["memorize"])
+        if payload.get("relationship"):
+            self.memory_manager.update_relationship(payload["relationship"])
+
+    async def summarize_history(self, payload):
+        """任务队列的处理函数：总结一段会话记录并写入中期记忆，失败时抛出异常"""
+        if not self.client:
+            raise RuntimeError("LLM client not ready")
+        history_text = "\n".join(payload["history"])
         memories = self.memory_manager.load_long_term_memories()
         prompt = get_summary_prompt(history_text, memories)
-        try:
-            completion = self.client.chat.completions.create(
-                model=self.model_name, messages=[{"role": "user", "content": prompt}], temperature=0.5
-            )
-            _record_usage(completion.usage) 
-            self.memory_manager.add_recent_memory(completion.choices[0].message.content.strip())
-        except Exception as e: print(f"Summary Error: {e}")
+        completion = await _create_completion("chat", self.client, self.model_name,
+            messages=[{"role": "user", "content": prompt}], temperature=0.5
+        )
+        _record_usage(completion.usage)
+        self.memory_manager.add_recent_memory(completion.choices[0].message.content.strip(),
+                                              entry_id=payload.get("id"))
+
+
+# --- 编程历史压缩 ---
+CODE_BLOCK_PATTERN = re.compile(r'(?m)^```(\w*)\n([\s\S]*?)\n```')
+SYMBOL_PATTERN = re.compile(r'(?m)^\s*(?:export\s+)?(?:async\s+)?(?:def|class|function|func|fn|interface|struct)\s+(\w+)')
+FILENAME_PATTERN = re.compile(r'([\w./-]+\.(?:py|js|ts|tsx|jsx|java|c|cc|cpp|h|hpp|go|rs|rb|php|cs|kt|swift|sh|html|css|json|yaml|yml|toml|md|sql))\b')
+KEEP_UNNAMED_BLOCKS = 3
+
+def _code_block_keys(lang, code, preceding_text):
+    """代码块的身份：文件名 (代码第一行注释或紧挨着的说明文字) 或定义的函数/类名"""
+    first_line = code.split("\n", 1)[0]
+    tail = preceding_text.strip().split("\n")[-1] if preceding_text.strip() else ""
+    for source in (first_line, tail):
+        match = FILENAME_PATTERN.search(source)
+        if match:
+            return {f"file:{match.group(1)}"}
+    return {f"sym:{name}" for name in SYMBOL_PATTERN.findall(code)}
+
+def _split_code_blocks(messages):
+    """把消息拆成 (去掉代码后的对话文本, 按出现顺序的代码块列表)"""
+    lines = []
+    blocks = []
+    for msg in messages:
+        text = msg.get("content") or ""
+        last_end = 0
+        for match in CODE_BLOCK_PATTERN.finditer(text):
+            lang, code = match.group(1) or "", match.group(2)
+            blocks.append({"lang": lang, "code": code,
+                           "keys": sorted(_code_block_keys(lang, code, text[last_end:match.start()]))})
+            last_end = match.end()
+        prose = CODE_BLOCK_PATTERN.sub("[代码块]", text).strip()
+        if len(prose) > 600:
+            prose = prose[:600] + "..."
+        lines.append(f"{msg.get('role')}: {prose}")
+    return "\n".join(lines), blocks
+
+def _prune_superseded_blocks(blocks, later_blocks=()):
+    """
+    去掉被后来的版本取代的代码块：一个代码块定义的所有文件/符号都在之后重新出现，就认为它已过时。
+    没有可识别名字的片段只保留最近的几个。
+    """
+    kept = []
+    seen = set()
+    for block in later_blocks:
+        seen.update(block["keys"])
+    unnamed = 0
+    for block in reversed(blocks):
+        keys = set(block["keys"])
+        if keys:
+            if keys <= seen:
+                continue
+            seen.update(keys)
+        else:
+            unnamed += 1
+            if unnamed > KEEP_UNNAMED_BLOCKS:
+                continue
+        kept.append(block)
+    kept.reverse()
+    return kept
+
+
+# --- 编程模式的模型路由 ---
+# 闲聊与简单问题走便宜的 Chat 模型；带代码、报错堆栈或较长的输入走 Coder 模型。
+# 输入以 /coder 或 /chat 开头时按前缀指定，不做判断。
+CODER_ROUTE_OVERRIDES = {"/coder": "coder", "/chat": "chat"}
+# 前缀必须是独立的词："/chatty"、"/coderX" 不算
+_ROUTE_OVERRIDE_PATTERN = re.compile(r"/(coder|chat)(\s|$)", re.I)
+CODER_ROUTE_LONG_CHARS = 300
+CODER_ROUTE_LONG_LINES = 8
+_TRACEBACK_PATTERN = re.compile(
+    r'Traceback \(most recent call last\)|^\s*File ".*", line \d+|^\s*at [\w.$<>]+\(.*\)'
+    r'|\b\w+(?:Error|Exception)\b:|panicked at|Segmentation fault', re.M)
+_CODE_LINE_PATTERN = re.compile(
+    r'^\s*(?:def |class |import |from \S+ import |function |const |let |var |public |private |#include|return\b)'
+    r'|[A-Za-z0-9_)\]]\s*[{;]\s*$|^\s*}\s*$|=>|[A-Za-z_][\w.]*\(.*\)\s*[:{;]?\s*$', re.M)
+_CODING_TASK_PATTERN = re.compile(
+    r'代码|函数|脚本|算法|正则|报错|调试|重构|实现|编译|部署|接口|数据库|bug|debug|sql|api|regex|refactor', re.I)
+
+
+def route_coder_turn(user_input):
+    """判断一轮编程对话该用哪个模型，返回 (role, 原因, 去掉路由前缀后的输入)"""
+    text = user_input.strip()
+    override = _ROUTE_OVERRIDE_PATTERN.match(text)
+    if override:
+        role = CODER_ROUTE_OVERRIDES["/" + override.group(1).lower()]
+        return role, "手动指定", text[override.end():].strip() or text
+    if "```" in text:
+        return "coder", "代码块", text
+    if _TRACEBACK_PATTERN.search(text):
+        return "coder", "报错堆栈", text
+    if len(text) > CODER_ROUTE_LONG_CHARS or text.count("\n") >= CODER_ROUTE_LONG_LINES:
+        return "coder", "长输入", text
+    if _CODE_LINE_PATTERN.search(text):
+        return "coder", "代码片段", text
+    if _CODING_TASK_PATTERN.search(text):
+        return "coder", "编程任务", text
+    return "chat", "闲聊", text
 
 
 class CoderClient:
     """编程模式专用的 LLM 客户端"""
+    KEEP_RECENT_MESSAGES = 6  # 压缩时原样保留的最近消息数 (3 轮)
+
     def __init__(self):
         self.memory_manager = MemoryManager()
         
@@ -290,29 +953,33 @@ class CoderClient:
         self.base_url = settings.get("base_url", "https://api.openai.com/v1")
         self.model_name = settings.get("coder_model_name", "gpt-4-turbo") # 默认为 coder model
         self.proxy_url = settings.get("proxy_url", None)  # 新增代理配置
+        self.http2 = settings.get("http2", False)
+
+        self.summary_model_name = settings.get("model_name", self.model_name)  # 压缩摘要用便宜的聊天模型
+        self.compact_threshold = settings.get("coder_compact_threshold", 6000)
+        self.routing = settings.get("coder_routing", True)  # 按复杂度在 Chat / Coder 模型之间选择
+        self.route_counts = {"chat": 0, "coder": 0}
 
+        configure_backend(settings)
+        set_verbose(settings.get("verbose_llm_logs", False))
         self._init_client()
         self.coder_history = [] 
+        # 编程模式默认按模型上下文长度自动计算预算，避免长会话超出上限被拒绝
+        self.context_budget = TokenBudgetWindow("coder", self.model_name, settings.get("coder_context_token_budget", 0))
+        self.chat_budget = TokenBudgetWindow("coder-chat", self.summary_model_name, settings.get("coder_context_token_budget", 0))
+        # 滚动压缩：较早的轮次变成 决策摘要 + 最终版本代码，最近几轮原样保留
+        self.summary_text = ""
+        self.summary_blocks = []
+        self.compacting = False
 
     def _init_client(self):
-        if not OpenAI:
+        if not OpenAI and requires_api_key():
             self.client = None
             return
         try:
-            # 构建客户端参数
-            client_kwargs = {
-                "api_key": self.api_key,
-                "base_url": self.base_url
-            }
-            
-            # 如果配置了代理，创建带代理的 http_client
+            self.client = get_llm_client(self.api_key, self.base_url, self.proxy_url, self.http2)
             if self.proxy_url:
-                http_client = _create_http_client(self.proxy_url)
-                if http_client:
-                    client_kwargs["http_client"] = http_client
-                    print(f"[CoderClient] Using proxy: {self.proxy_url}")
-            
-            self.client = OpenAI(**client_kwargs)
+                print(f"[CoderClient] Using proxy: {self.proxy_url}")
         except Exception as e:
             print(f"Error initializing CoderClient: {e}")
             self.client = None
@@ -322,47 +989,127 @@ class CoderClient:
         self.base_url = settings.get("base_url", self.base_url)
         self.model_name = settings.get("coder_model_name", self.model_name)
         self.proxy_url = settings.get("proxy_url", self.proxy_url)  # 新增
+        self.http2 = settings.get("http2", self.http2)
+        self.summary_model_name = settings.get("model_name", self.summary_model_name)
+        self.compact_threshold = settings.get("coder_compact_threshold", self.compact_threshold)
+        self.routing = settings.get("coder_routing", self.routing)
+        self.context_budget.configure(self.model_name, settings.get("coder_context_token_budget", 0))
+        self.chat_budget.configure(self.summary_model_name, settings.get("coder_context_token_budget", 0))
+        configure_backend(settings)
+        set_verbose(settings.get("verbose_llm_logs", False))
         self._init_client()
         print(f"[CoderClient] Config updated. Model: {self.model_name}")
 
-    def _extract_action_block(self, text):
-        action_pattern = r'<ACTION>(.*?)</ACTION>'
-        match = re.search(action_pattern, text, re.DOTALL)
-        if match:
-            json_str = match.group(1).strip()
-            json_str = re.sub(r',\s*([\]}])', r'\1', json_str)
+    def is_ready(self):
+        """检查 API 客户端是否已准备就绪"""
+        if not requires_api_key():
+            return self.client is not None
+        return self.client is not None and self.api_key and len(self.api_key) > 5
+
+    def get_history_summary(self):
+        """压缩摘要的文本形式：决策要点 + 每个文件/函数的最终版本"""
+        if not self.summary_text and not self.summary_blocks:
+            return ""
+        parts = [self.summary_text or "（无）"]
+        if self.summary_blocks:
+            parts.append("【当前最终代码】")
+            for block in self.summary_blocks:
+                parts.append(f"```{block['lang']}\n{block['code']}\n```")
+        return "\n\n".join(parts)
+
+    def history_tokens(self):
+        return count_message_tokens(self.coder_history, self.model_name) + count_tokens(self.get_history_summary(), self.model_name)
+
+    def needs_compaction(self):
+        return (not self.compacting
+                and len(self.coder_history) > self.KEEP_RECENT_MESSAGES
+                and self.history_tokens() > self.compact_threshold)
+
+    async def compact_history(self):
+        """
+        把较早的对话压缩进摘要，返回 (压缩前 Token, 压缩后 Token)。
+        压缩期间新增的轮次不受影响：只替换开始时切下的那一段。
+        """
+        if self.compacting:
+            return None
+        self.compacting = True
+        try:
+            cut = len(self.coder_history) - self.KEEP_RECENT_MESSAGES
+            if cut <= 0:
+                return None
+            before = self.history_tokens()
+            old_messages = self.coder_history[:cut]
+            transcript, new_blocks = _split_code_blocks(old_messages)
+            _, recent_blocks = _split_code_blocks(self.coder_history[cut:])
+
+            summary_text = self.summary_text
             try:
-                return json.loads(json_str)
-            except: pass
-        return {}
+                prompt = get_coder_compaction_prompt(self.summary_text, transcript)
+                completion = await _create_completion("chat", self.client, self.summary_model_name,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.3,
+                )
+                _record_usage(completion.usage)
+                summary_text = completion.choices[0].message.content.strip()
+            except Exception as e:
+                # 摘要失败时退回纯本地压缩：保留对话提纲，代码照常去重
+                print(f"Coder Compaction Error: {e}")
+                summary_text = "\n".join(filter(None, [self.summary_text, transcript[-2000:]]))
 
-    def chat(self, user_input, current_stats, persona_text):
+            self.summary_blocks = _prune_superseded_blocks(self.summary_blocks + new_blocks, recent_blocks)
+            self.summary_text = summary_text
+            self.coder_history = self.coder_history[cut:]
+            after = self.history_tokens()
+            print(f"[CoderClient] History compacted: {before} -> {after} tokens")
+            return before, after
+        finally:
+            self.compacting = False
+
+    def route(self, user_input, role=None):
+        """
+        选择本轮使用的模型，返回 (role, 模型名, 原因, 去掉路由前缀后的输入)。
+        role: 调用方指定 (例如开场招呼)，输入中的 /coder、/chat 前缀优先。
+        """
+        routed_role, reason, text = route_coder_turn(user_input)
+        if reason != "手动指定":
+            if role:
+                routed_role, reason = role, "固定"
+            elif not self.routing:
+                routed_role, reason = "coder", "路由关闭"
+        model = self.model_name if routed_role == "coder" else self.summary_model_name
+        self.route_counts[routed_role] += 1
+        return routed_role, model, reason, text
+
+    def route_status(self, role, model, reason):
+        """状态栏中的路由说明"""
+        return (f"路由 → {role} 模型 {model or '(默认)'} ({reason}) | "
+                f"本次 chat {self.route_counts['chat']} / coder {self.route_counts['coder']}")
+
+    async def chat(self, user_input, current_stats, persona_text, role="coder"):
+        """role: "coder" 用 Coder 模型，"chat" 用便宜的聊天模型 (由 route 决定)"""
         if not self.client: return "OpenAI未安装", {}
 
         memories = self.memory_manager.load_long_term_memories()
-        system_prompt = get_coder_system_prompt(current_stats, memories, persona_text)
+        system_prompt = get_coder_system_prompt(current_stats, memories, persona_text, self.get_history_summary())
 
-        messages = [{"role": "system", "content": system_prompt}]
-        messages.extend(self.coder_history)
-        messages.append({"role": "user", "content": user_input})
+        model = self.model_name if role == "coder" else self.summary_model_name
+        budget = self.context_budget if role == "coder" else self.chat_budget
+        # 与聊天相同：时间与数值附在本轮用户消息里，历史中只保存原始输入
+        messages, _ = budget.build(system_prompt, self.coder_history, get_turn_context(current_stats, user_input))
 
         try:
-            completion = self.client.chat.completions.create(
-                model=self.model_name,
+            completion = await _create_completion(role, self.client, model,
                 messages=messages,
                 temperature=0.5,
             )
             _record_usage(completion.usage)
             
-            raw_reply = completion.choices[0].message.content
-            
-            action_data = self._extract_action_block(raw_reply)
-            text_reply = re.sub(r'<ACTION>.*?</ACTION>', '', raw_reply, flags=re.DOTALL).strip()
+            text_reply, action = split_reply(completion.choices[0].message.content or "")
             
             self.coder_history.append({"role": "user", "content": user_input})
             self.coder_history.append({"role": "assistant", "content": text_reply})
 
-            return text_reply, action_data
+            return text_reply, action.to_dict()
 
         except Exception as e:
             print(f"Coder LLM Error: {e}")
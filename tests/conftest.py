@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+
+@pytest.fixture(autouse=True)
+def isolated_data_dir(tmp_path, monkeypatch):
+    """MemoryManager 使用相对路径 data/，每个测试在临时目录中运行，不碰真实存档"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def fresh_job_queue(isolated_data_dir, monkeypatch):
+    """任务队列是进程级单例，每个测试从新的 (临时目录里的) 队列开始"""
+    from src import job_utils
+    monkeypatch.setattr(job_utils, "_job_queue", None)
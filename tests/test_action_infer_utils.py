@@ -0,0 +1,72 @@
+import pytest
+
+from src.action_utils import PetAction
+from src.action_infer_utils import LocalActionEngine, TOUCH_LIMIT, MOOD_PLEASANT, BOREDOM_ENGAGED
+from src.parameters import TOUCH_REACTIONS, TOUCH_TYPE_DESC
+from src.pet_core import touch_prompt, coalesced_touch_prompt
+
+TOUCH_PARTS = sorted({part for part, _ in TOUCH_REACTIONS})
+
+
+def _all_touch_prompts():
+    prompts = [touch_prompt(part, desc) for part in TOUCH_PARTS for desc in TOUCH_TYPE_DESC.values()]
+    descs = list(TOUCH_TYPE_DESC.values())
+    prompts.append(coalesced_touch_prompt([((TOUCH_PARTS[0], descs[0]), 3)]))
+    prompts.append(coalesced_touch_prompt([((part, descs[i % len(descs)]), 1) for i, part in enumerate(TOUCH_PARTS)]))
+    return prompts
+
+
+@pytest.fixture
+def engine():
+    return LocalActionEngine()
+
+
+@pytest.mark.parametrize("prompt", _all_touch_prompts())
+def test_touch_prompts_are_recognised(engine, prompt):
+    assert engine.is_touch(prompt)
+    assert not engine.needs_remote(prompt)
+    action = engine.infer(prompt, "哈哈好开心，被你发现啦~")
+    assert all(abs(v) <= TOUCH_LIMIT for v in action.adjust.values())
+    assert "boredom" not in action.adjust
+
+
+def test_explicit_touch_flag(engine):
+    assert engine.is_touch("随便什么", is_touch=True)
+    assert not engine.needs_remote("我叫小明", is_touch=True)
+    assert engine.infer("我叫小明，今天真开心呀哈哈", "哈哈", is_touch=True).adjust == {"mood": TOUCH_LIMIT}
+
+
+@pytest.mark.parametrize("text", ["我叫小明", "我在北京上班", "记住我的生日是五月", "我喜欢你", "明天要考试了"])
+def test_memory_and_relationship_cues(engine, text):
+    assert engine.needs_remote(text)
+
+
+@pytest.mark.parametrize("text", ["你好呀", "今天天气不错", "我是说算了", "(系统触发主动搭话)"])
+def test_small_talk_stays_local(engine, text):
+    assert not engine.needs_remote(text)
+
+
+def test_infer_rules(engine):
+    action = engine.infer("你好", "哈哈，好开心~")
+    assert action.animate == "EMOTION_SING_HAPPY"
+    assert action.adjust == {"mood": MOOD_PLEASANT}
+    assert engine.infer("今天上班遇到了好多好多麻烦的事情啊", "唔……").adjust == {"boredom": BOREDOM_ENGAGED}
+    assert not engine.infer("嗯", "好的")
+    assert engine.infer("你这个笨蛋", "哼！生气了！").adjust["mood"] < 0
+
+
+def test_classifier_override_and_fallback(engine):
+    engine.set_classifier(lambda user_input, reply: {"animate": "EMOTION_SING_SAD", "memorize": "ignored"})
+    assert engine.infer("x", "y").to_dict() == {"animate": "EMOTION_SING_SAD"}
+    engine.set_classifier(lambda user_input, reply: 1 / 0)
+    assert engine.infer("x", "哈哈").animate == "EMOTION_SING_HAPPY"
+
+
+def test_agreement_stats(engine):
+    assert engine.agreement() is None
+    engine.compare(PetAction("EMOTION_SING_HAPPY", {"mood": 0.5}), PetAction("EMOTION_SING_HAPPY", {"mood": 1}), flagged=False)
+    engine.compare(PetAction(), PetAction("EMOTION_SING_SAD", memorize="m"), flagged=False)
+    engine.compare(PetAction(), PetAction(memorize="m"), flagged=True)
+    assert engine.agreement() == pytest.approx(2 / 3)
+    assert engine.stats["missed"] == 1 and engine.stats["audits"] == 2
+    assert engine.stats["flagged_used"] == 1
@@ -0,0 +1,88 @@
+import pytest
+
+from src.action_utils import (TagStreamParser, PetAction, load_json, split_reply, parse_tag_json,
+                              ADJUST_LIMITS)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"animate": "EMOTION_SING_HAPPY"}', {"animate": "EMOTION_SING_HAPPY"}),
+    ('{"memorize": "用户喜欢{括号"}', {"memorize": "用户喜欢{括号"}),
+    ('{"memorize": "右括号}在字符串里"}', {"memorize": "右括号}在字符串里"}),
+    ('{"a": 1} trailing }', {"a": 1}),
+    ('```json\n{"a": 1}\n```', {"a": 1}),
+    ('前面的废话 {"a": 1, } 后面的废话', {"a": 1}),
+    ('{"a": {"b": 1', {"a": {"b": 1}}),
+    ('{"a": 1,', {"a": 1}),
+])
+def test_load_json_accepts_valid_and_repairable(text, expected):
+    assert load_json(text) == expected
+
+
+@pytest.mark.parametrize("text", ["", "   ", "[1, 2]", "no json here", '{"a": tru'])
+def test_load_json_rejects(text):
+    assert load_json(text) is None
+
+
+def test_stream_parser_hides_tags_split_across_chunks():
+    parser = TagStreamParser()
+    visible = [parser.feed(chunk) for chunk in ["你好", "呀<AC", "TION>{\"animate\":", "\"EMOTION_SING_SAD\"}</ACT", "ION>"]]
+    assert visible == ["你好", "你好呀", "你好呀", "你好呀", "你好呀"]
+    assert parser.action().animate == "EMOTION_SING_SAD"
+
+
+def test_stream_parser_keeps_plain_angle_brackets():
+    parser = TagStreamParser()
+    assert parser.feed("a < b") == "a < b"
+    assert parser.feed(" <div>") == "a < b <div>"
+
+
+@pytest.mark.parametrize("raw, text", [
+    ("ends with <", "ends with <"),
+    ("a <ACT", "a <ACT"),
+    ("x <EXI", "x <EXI"),
+])
+def test_finish_releases_pending_partial_tag(raw, text):
+    visible, action = split_reply(raw)
+    assert visible == text
+    assert not action
+
+
+def test_finish_keeps_unclosed_block_content():
+    visible, action = split_reply('hi <ACTION>{"animate":"EMOTION_SING_SAD"}</ACTI')
+    assert visible == "hi"
+    assert action.animate == "EMOTION_SING_SAD"
+
+
+def test_split_reply_bare_and_fenced_json():
+    assert split_reply('{"animate": "EMOTION_SING_BLUSH"}')[1].animate == "EMOTION_SING_BLUSH"
+    assert split_reply('```json\n{"animate": "EMOTION_SING_BLUSH"}\n```')[1].animate == "EMOTION_SING_BLUSH"
+    assert not split_reply("普通回复")[1]
+
+
+def test_parse_tag_json():
+    raw = '<EXIT>{"goodbye": "拜拜", "summary": "s"}</EXIT>'
+    assert parse_tag_json(raw, "EXIT") == {"goodbye": "拜拜", "summary": "s"}
+    assert parse_tag_json("nothing", "EXIT") == {}
+
+
+def test_pet_action_validates_and_clamps():
+    action = PetAction.from_dict({
+        "animate": "EMOTION_SING_NOPE",
+        "adjust": {"mood": 99, "intimacy": -5, "hunger": 1, "boredom": "x"},
+        "memorize": "  用户是工程师 ",
+        "update_relationship": 3,
+        "extra": True,
+    })
+    assert action.animate is None
+    assert action.adjust == {"mood": ADJUST_LIMITS["mood"][1], "intimacy": ADJUST_LIMITS["intimacy"][0]}
+    assert action.memorize == "用户是工程师"
+    assert action.update_relationship == ""
+
+
+def test_pet_action_presentation_and_round_trip():
+    data = {"animate": "EMOTION_SING_HAPPY", "adjust": {"mood": 1.0}, "memorize": "m", "update_relationship": "r"}
+    action = PetAction.from_dict(data)
+    assert action.to_dict() == data
+    assert action.presentation().to_dict() == {"animate": "EMOTION_SING_HAPPY", "adjust": {"mood": 1.0}}
+    assert not PetAction.from_dict(None)
+    assert PetAction.from_dict(action) is action
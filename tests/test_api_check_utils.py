@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+from src.api_check_utils import ModelListCache, run_api_checks, MODEL_LIST_TTL
+
+
+def _checks(cache, probes=("connection",), refresh_models=True, backend="stub", base_url="https://api.example.com"):
+    return asyncio.run(run_api_checks("", base_url, None, False, "stub", "stub", probes=probes,
+                                      backend=backend, cache=cache, refresh_models=refresh_models))
+
+
+def test_cache_is_keyed_by_backend_and_base_url():
+    cache = ModelListCache()
+    cache.put("https://api.example.com/", ["gpt-4o"], backend="openai")
+    cache.put("https://api.example.com", ["stub"], backend="stub")
+    assert cache.get("https://api.example.com", backend="openai") == ["gpt-4o"]
+    assert cache.get("https://api.example.com", backend="stub") == ["stub"]
+    assert cache.get("https://other.example.com", backend="openai") is None
+
+
+def test_cache_expires_but_stale_entries_stay_readable():
+    cache = ModelListCache()
+    cache.put("", ["b", "a"], backend="openai")
+    entries = cache.memory_manager.load_model_cache()
+    for entry in entries.values():
+        entry["updated"] = time.time() - MODEL_LIST_TTL - 1
+    cache.memory_manager.save_model_cache(entries)
+    assert cache.is_stale("", backend="openai")
+    assert cache.get("", backend="openai") is None
+    assert cache.get("", allow_stale=True, backend="openai") == ["a", "b"]
+
+
+def test_stub_checks_do_not_touch_the_real_backend_entry():
+    cache = ModelListCache()
+    cache.put("https://api.example.com", ["gpt-4o"], backend="openai")
+    [result] = _checks(cache)
+    assert result["ok"]
+    assert cache.get("https://api.example.com", backend="openai") == ["gpt-4o"]
+    assert cache.get("https://api.example.com", backend="stub") == ["stub"]
+
+
+def test_connection_probe_reuses_a_fresh_entry():
+    cache = ModelListCache()
+    cache.put("https://api.example.com", ["cached-a", "cached-b"], backend="stub")
+    results = _checks(cache, probes=("connection", "chat"), refresh_models=False)
+    assert all(r["ok"] for r in results)
+    assert results[0]["message"].endswith("(缓存)")
+    assert cache.get("https://api.example.com", backend="stub") == ["cached-a", "cached-b"]
+
+    [result] = _checks(cache, refresh_models=True)
+    assert "(缓存)" not in result["message"]
+    assert cache.get("https://api.example.com", backend="stub") == ["stub"]
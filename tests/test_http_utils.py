@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+from src import http_utils
+from src.http_utils import get_async_openai_client, MAX_OPENAI_CLIENTS
+
+pytestmark = pytest.mark.skipif(http_utils.AsyncOpenAI is None, reason="openai 未安装")
+
+
+@pytest.fixture(autouse=True)
+def empty_pool():
+    asyncio.run(http_utils.aclose_all())
+    yield
+    asyncio.run(http_utils.aclose_all())
+
+
+def test_same_config_returns_same_client():
+    client = get_async_openai_client("sk-a", "https://a.example.com/v1/")
+    assert get_async_openai_client("sk-a", "https://a.example.com/v1") is client
+    assert get_async_openai_client("sk-b", "https://a.example.com/v1") is not client
+
+
+def test_clients_per_key_are_bounded_and_share_one_transport():
+    keep = get_async_openai_client("sk-keep", "https://a.example.com/v1")
+    for i in range(MAX_OPENAI_CLIENTS * 2):
+        get_async_openai_client(f"sk-{i}", "https://a.example.com/v1")
+        get_async_openai_client("sk-keep", "https://a.example.com/v1")  # 一直在用的不会被挤掉
+
+    assert len(http_utils._async_openai_clients) == MAX_OPENAI_CLIENTS
+    assert get_async_openai_client("sk-keep", "https://a.example.com/v1") is keep
+    api_keys = [key[-1] for key in http_utils._async_openai_clients]
+    assert "sk-0" not in api_keys and api_keys[-2] == f"sk-{MAX_OPENAI_CLIENTS * 2 - 1}"
+    assert len(http_utils._async_http_clients) == 1
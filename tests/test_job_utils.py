@@ -0,0 +1,69 @@
+import asyncio
+
+from src.job_utils import JobQueue, MAX_JOB_ATTEMPTS
+from src.llm_scheduler import request_priority, PRIORITY_USER, PRIORITY_BACKGROUND
+
+
+def _queue(handler, kind="summary"):
+    queue = JobQueue()
+    queue.register(kind, handler)
+    return queue
+
+
+def test_jobs_survive_restart_until_completed():
+    seen = []
+
+    async def handler(payload):
+        seen.append(payload)
+
+    queue = _queue(handler)
+    queue.put("summary", "session:1", {"n": 1})
+    assert JobQueue().pending() == ["session:1"]
+
+    assert asyncio.run(queue.run("session:1")) is True
+    assert seen == [{"n": 1}]
+    assert JobQueue().jobs == {}
+
+
+def test_put_overwrites_same_key_and_held_jobs_wait():
+    async def handler(payload):
+        pass
+
+    queue = _queue(handler)
+    queue.put("summary", "session:1", {"n": 1}, hold=True)
+    queue.put("summary", "session:1", {"n": 2}, hold=True)
+    assert queue.pending() == []
+    assert asyncio.run(queue.run("session:1")) is False
+    assert queue.jobs["session:1"]["payload"] == {"n": 2}
+
+    restarted = JobQueue()
+    assert restarted.pending() == ["session:1"]
+
+
+def test_failed_jobs_are_dropped_after_max_attempts():
+    async def handler(payload):
+        raise RuntimeError("boom")
+
+    queue = _queue(handler)
+    queue.put("summary", "session:1", {})
+    for _ in range(MAX_JOB_ATTEMPTS):
+        assert asyncio.run(queue.run("session:1")) is False
+    assert "session:1" in queue.jobs
+    assert asyncio.run(queue.run("session:1")) is False
+    assert queue.jobs == {}
+
+
+def test_run_does_not_leak_background_priority_to_caller():
+    inside = []
+
+    async def handler(payload):
+        inside.append(request_priority.get())
+
+    async def main():
+        queue = _queue(handler)
+        queue.put("summary", "session:1", {})
+        await queue.run("session:1")
+        return request_priority.get()
+
+    assert asyncio.run(main()) == PRIORITY_USER
+    assert inside == [PRIORITY_BACKGROUND]
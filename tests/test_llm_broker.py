@@ -0,0 +1,98 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from src.memory_utils import MemoryManager
+from src.llm_broker import LLMBroker, UI_SAFE_DEFAULTS
+from src.llm_engine import get_engine
+
+STATS = {"mood": 50, "boredom": 10, "fatigue": 10, "capability": 1, "intimacy": 0.5}
+
+
+@pytest.fixture
+def broker():
+    manager = MemoryManager()
+    settings = manager.load_settings()
+    settings.update(llm_backend="stub", stub_latency=0.0, stub_token_delay=0.0, agent_mode="local")
+    manager.save_settings(settings)
+    broker = LLMBroker()
+    broker.start()
+    yield broker
+    broker.shutdown(timeout=1.0)
+
+
+def test_round_trip_streams_and_brings_back_stats(broker):
+    client = broker.client("chat")
+    assert client.is_ready() is True
+    deltas = []
+    reply, action = get_engine().run_sync(client.chat("你好", STATS, "persona", on_delta=deltas.append), 20)
+    assert reply and deltas and deltas[-1] == reply
+    assert client.session_length() == 2
+    assert broker.remote_stats["queue"] == {}
+    assert isinstance(broker.remote_stats["ranking"], list)
+
+
+def test_sync_failures_raise_except_ui_safe_methods(broker):
+    coder = broker.client("coder")
+    with pytest.raises(RuntimeError):
+        coder.route()  # 缺少参数，子进程中抛出 TypeError
+    assert coder.is_ready(1, 2, 3) is UI_SAFE_DEFAULTS["is_ready"]
+    with pytest.raises(AttributeError):
+        coder.no_such_method
+
+
+def test_restarts_after_crash(broker):
+    client = broker.client("chat")
+    broker.process.kill()
+    broker.process.wait()
+    reply, _ = get_engine().run_sync(client.chat("你好", STATS, "persona"), 20)
+    assert reply
+
+
+def _wait_until(predicate, timeout=20.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def test_ui_queries_read_cached_state_without_round_trip(broker, monkeypatch):
+    client = broker.client("chat")
+    get_engine().run_sync(client.chat("你好", STATS, "persona"), 20)
+    monkeypatch.setattr(broker, "_request", lambda *args, **kwargs: pytest.fail("UI query hit the broker"))
+    assert client.is_ready() is True and client.session_length() == 2
+    assert client.has_pending_jobs() is False
+
+
+def test_fire_and_forget_updates_state_when_reply_arrives(broker):
+    client = broker.client("chat")
+    assert client.remember_goodbye("拜拜") is None
+    _wait_until(lambda: client.session_length() == 1)
+
+
+def test_crash_is_restarted_in_background_without_blocking_ui(broker):
+    client = broker.client("chat")
+    old_pid = broker.process.pid
+    broker.process.kill()
+    broker.process.wait()
+    _wait_until(lambda: not broker.state or broker.process.pid != old_pid)
+
+    started = time.time()
+    client.is_ready()
+    assert client.peek_response("key") is None
+    assert time.time() - started < 1.0
+    _wait_until(lambda: broker.alive() and broker.process.pid != old_pid and client.is_ready())
+
+
+def test_pet_core_falls_back_to_in_process_clients(monkeypatch):
+    from src import pet_core
+    from src.vlm_utils import LLMClient, CoderClient
+
+    def broken():
+        raise RuntimeError("no broker")
+
+    monkeypatch.setattr(pet_core, "get_broker", broken)
+    core = SimpleNamespace(settings={"llm_broker": True})
+    chat, coder = pet_core.PetCore._create_llm_clients(core)
+    assert isinstance(chat, LLMClient) and isinstance(coder, CoderClient)
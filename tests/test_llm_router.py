@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src import llm_router
+from src.llm_router import ProviderRouter, FAILURES_TO_COOLDOWN, REJOIN_STEP
+
+
+class StatusError(Exception):
+    def __init__(self, status):
+        super().__init__(f"status {status}")
+        self.status_code = status
+
+
+@pytest.fixture
+def router(monkeypatch):
+    monkeypatch.setattr(llm_router, "get_llm_client", lambda *args, **kwargs: SimpleNamespace())
+    router = ProviderRouter()
+    router.configure({"base_url": "https://a.example.com", "api_key": "key-a", "model_name": "chat-a",
+                      "coder_model_name": "",
+                      "providers": [{"name": "B", "base_url": "https://b.example.com",
+                                     "models": {"chat": "chat-b", "coder": "coder-b"}}]})
+    return router
+
+
+def _names(router):
+    return [row[0] for row in router.ranking()]
+
+
+def test_choose_skips_endpoints_without_the_role(router):
+    assert router.choose("coder").name == "B"
+
+
+def test_faster_endpoint_ranks_first(router):
+    a, b = router.endpoints
+    router.record(a, 2.0, ok=True)
+    router.record(b, 0.5, ok=True)
+    assert router.choose("chat") is b
+    assert _names(router) == ["B", "默认"]
+
+
+def test_transient_failures_cool_down_but_client_errors_do_not(router):
+    endpoint = router.endpoints[0]
+
+    async def fail(status):
+        async def request(client, model):
+            raise StatusError(status)
+        with pytest.raises(StatusError):
+            await router.call("chat", request, None, None)
+
+    router.endpoints = [endpoint]
+    for _ in range(FAILURES_TO_COOLDOWN + 1):
+        asyncio.run(fail(400))
+    assert endpoint.failures == 0 and endpoint.error_rate == 0.0
+    assert router.ranking()[0][-1] == "正常"
+
+    for _ in range(FAILURES_TO_COOLDOWN):
+        asyncio.run(fail(503))
+    assert router.ranking()[0][-1].startswith("暂停")
+    assert endpoint.trust == REJOIN_STEP
+
+
+def test_stream_calls_record_first_token_latency_separately(router):
+    endpoint = router.endpoints[0]
+    router.endpoints = [endpoint]
+
+    async def streamed(client, model, first_token):
+        first_token()
+        await asyncio.sleep(0.05)
+        return model
+
+    async def plain(client, model):
+        await asyncio.sleep(0.02)
+        return model
+
+    assert asyncio.run(router.call("chat", streamed, None, None, stream=True)) == "chat-a"
+    assert endpoint.latency is None
+    assert endpoint.first_token < 0.02
+
+    assert asyncio.run(router.call("chat", plain, None, None)) == "chat-a"
+    assert endpoint.latency >= 0.02
+    name, latency_ms, first_token_ms, error_rate, status = router.ranking()[0]
+    assert latency_ms >= 20 and first_token_ms < 20
+
+
+def test_configure_keeps_stats_of_unchanged_endpoints(router):
+    a, b = router.endpoints
+    router.record(b, 0.5, ok=True, stream=True)
+    router.configure({"base_url": "https://a.example.com", "api_key": "key-a", "model_name": "chat-a",
+                      "providers": [{"name": "B", "base_url": "https://b.example.com", "api_key": "key-a",
+                                     "models": {"chat": "chat-b"}}]})
+    assert router.endpoints[1].first_token == 0.5
+
+
+def test_no_endpoint_uses_fallback_client(router):
+    router.endpoints = []
+
+    async def request(client, model):
+        return client, model
+
+    assert asyncio.run(router.call("chat", request, "client", "model")) == ("client", "model")
@@ -0,0 +1,148 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src import llm_scheduler
+from src.llm_scheduler import (LLMScheduler, TokenBucket, LatencyTracker, request_priority,
+                               PRIORITY_USER, PRIORITY_BACKGROUND, _is_transient, _rate_limit_delay)
+
+
+class StatusError(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(f"status {status}")
+        self.status_code = status
+        self.response = SimpleNamespace(status_code=status, headers=headers or {})
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "_backoff_delay", lambda attempt: 0.0)
+
+
+def test_configure_keeps_rate_limited_speed_when_rate_unchanged():
+    bucket = TokenBucket(60)
+    bucket.on_rate_limited(0)
+    assert bucket.rate == 30
+    bucket.configure(60)
+    assert bucket.rate == 30
+    bucket.configure(120)
+    assert bucket.rate == 120 and bucket.configured_rate == 120
+
+
+def test_success_recovers_rate_slowly():
+    bucket = TokenBucket(10)
+    bucket.on_rate_limited(0)
+    bucket.on_success()
+    assert bucket.rate == 6
+    for _ in range(10):
+        bucket.on_success()
+    assert bucket.rate == 10
+
+
+@pytest.mark.parametrize("status, transient", [(500, True), (503, True), (408, True), (409, True),
+                                                (400, False), (401, False), (404, False)])
+def test_is_transient(status, transient):
+    assert _is_transient(StatusError(status)) is transient
+
+
+def test_rate_limit_delay_prefers_retry_after_headers():
+    assert _rate_limit_delay(StatusError(429, {"retry-after-ms": "1500"}), 0) == 1.5
+    assert _rate_limit_delay(StatusError(429, {"retry-after": "3"}), 0) == 3.0
+    assert _rate_limit_delay(StatusError(429), 2) == 4.0
+    assert _rate_limit_delay(StatusError(500), 0) is None
+
+
+def test_run_retries_transient_errors_only():
+    scheduler = LLMScheduler(max_retries=2, rate_per_minute=600)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise StatusError(502)
+        return "ok"
+
+    assert asyncio.run(scheduler.run(flaky)) == "ok"
+    assert len(calls) == 3
+
+    async def bad_request():
+        calls.append(1)
+        raise StatusError(400)
+
+    calls.clear()
+    with pytest.raises(StatusError):
+        asyncio.run(scheduler.run(bad_request))
+    assert len(calls) == 1
+    assert scheduler.active == 0
+
+
+def test_queue_serves_higher_priority_first():
+    scheduler = LLMScheduler(max_concurrency=1, rate_per_minute=600)
+    order = []
+
+    async def main():
+        gate = asyncio.Event()
+
+        async def blocker():
+            await gate.wait()
+
+        async def job(name):
+            order.append(name)
+
+        first = asyncio.create_task(scheduler.run(blocker, priority=PRIORITY_USER))
+        await asyncio.sleep(0)
+        background = asyncio.create_task(scheduler.run(lambda: job("background"), priority=PRIORITY_BACKGROUND))
+        user = asyncio.create_task(scheduler.run(lambda: job("user"), priority=PRIORITY_USER))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth() == {"background": 1, "user": 1}
+        gate.set()
+        await asyncio.gather(first, background, user)
+
+    asyncio.run(main())
+    assert order == ["user", "background"]
+    assert scheduler.queue_depth() == {}
+
+
+def test_run_uses_context_priority():
+    scheduler = LLMScheduler(max_concurrency=1, rate_per_minute=600)
+
+    async def main():
+        request_priority.set(PRIORITY_BACKGROUND)
+        seen = []
+        original = scheduler._acquire
+
+        async def spy(priority):
+            seen.append(priority)
+            await original(priority)
+
+        scheduler._acquire = spy
+        await scheduler.run(lambda: asyncio.sleep(0))
+        return seen
+
+    assert asyncio.run(main()) == [PRIORITY_BACKGROUND]
+
+
+def test_latency_tracker_needs_minimum_samples():
+    tracker = LatencyTracker()
+    for seconds in (1, 2, 3, 4):
+        tracker.record(seconds)
+    assert tracker.percentile(90, default=-1) == -1
+    tracker.record(5)
+    assert tracker.percentile(90) == 5
+    assert tracker.percentile(0) == 1
+
+
+def test_errors_marked_no_retry_are_not_retried():
+    scheduler = LLMScheduler(max_retries=2, rate_per_minute=600)
+    calls = []
+
+    async def dropped_mid_stream():
+        calls.append(1)
+        error = StatusError(502)
+        error.no_retry = True
+        raise error
+
+    with pytest.raises(StatusError):
+        asyncio.run(scheduler.run(dropped_mid_stream))
+    assert len(calls) == 1
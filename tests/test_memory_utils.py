@@ -0,0 +1,32 @@
+import os
+import threading
+
+from src.memory_utils import MemoryManager, DATA_DIR, MEMORY_FILE
+
+
+def test_readers_never_see_a_half_written_file():
+    manager = MemoryManager()
+    memories = ["Relationship: Friend"] + [f"记忆 {i} " * 20 for i in range(200)]
+    manager.save_long_term_memories(memories)
+    stop = threading.Event()
+
+    def writer():
+        while not stop.is_set():
+            manager.save_long_term_memories(memories)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for _ in range(300):
+            assert MemoryManager().load_long_term_memories()[0] == "Relationship: Friend"
+    finally:
+        stop.set()
+        thread.join()
+    assert manager.load_long_term_memories() == memories
+
+
+def test_write_leaves_no_temp_files():
+    manager = MemoryManager()
+    manager.add_memory("用户喜欢猫")
+    assert not [name for name in os.listdir(DATA_DIR) if name.endswith(".tmp")]
+    assert os.path.exists(MEMORY_FILE)
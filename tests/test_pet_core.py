@@ -0,0 +1,122 @@
+import pytest
+from PyQt6.QtCore import QCoreApplication, QObject, pyqtSignal
+
+from src import pet_core
+from src.memory_utils import MemoryManager
+
+
+class FakeChatWorker(QObject):
+    """记录请求，不真正调用 LLM；测试里手动发出回复"""
+    reply_signal = pyqtSignal(str, dict)
+    partial_signal = pyqtSignal(str)
+    started = []
+
+    def __init__(self, client, text, current_stats, persona, cacheable=False, is_touch=False):
+        super().__init__()
+        self.text = text
+        self.running = False
+        self.cancelled = False
+
+    def start(self):
+        self.running = True
+        FakeChatWorker.started.append(self)
+
+    def isRunning(self):
+        return self.running
+
+    def cancel(self):
+        self.running, self.cancelled = False, True
+
+    def finish(self, reply):
+        self.running = False
+        self.reply_signal.emit(reply, {})
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+@pytest.fixture
+def core(app, monkeypatch):
+    manager = MemoryManager()
+    settings = manager.load_settings()
+    settings.update(llm_backend="stub", stub_latency=0.0, stub_token_delay=0.0, touch_llm_interval=1)
+    manager.save_settings(settings)
+    FakeChatWorker.started = []
+    monkeypatch.setattr(pet_core, "ChatWorker", FakeChatWorker)
+    monkeypatch.setattr(pet_core.PetCore, "warm_up_connections", lambda self: None)
+    core = pet_core.PetCore()
+    core.logic_timer.stop()
+    replies = []
+    core.chat_reply_received.connect(replies.append)
+    core.replies = replies
+    return core
+
+
+def test_rapid_touches_become_one_request(core):
+    for part, touch_type in [("脑袋", "gentle"), ("脑袋", "gentle"), ("手", "stroke")]:
+        core.process_touch(part, touch_type)
+    assert FakeChatWorker.started == [] and core.touch_timer.isActive()
+
+    core._flush_touches()
+    [worker] = FakeChatWorker.started
+    assert worker.text == pet_core.coalesced_touch_prompt(
+        [(("脑袋", pet_core.TOUCH_TYPE_DESC["gentle"]), 2), (("手", pet_core.TOUCH_TYPE_DESC["stroke"]), 1)])
+    assert core.pending_touches == [] and core.active_kind == "touch"
+
+
+def test_single_touch_prompt_is_unchanged():
+    groups = [(("脑袋", "轻轻触摸了"), 1)]
+    assert pet_core.coalesced_touch_prompt(groups) == pet_core.touch_prompt("脑袋", "轻轻触摸了")
+
+
+def test_new_chat_supersedes_and_drops_late_reply(core):
+    core.start_chat("第一句")
+    core.start_chat("第二句")
+    first, second = FakeChatWorker.started
+    assert first.cancelled and not second.cancelled
+
+    first.finish("晚到的回复")
+    assert core.replies == []
+    second.finish("第二句的回复")
+    assert core.replies == ["第二句的回复"]
+
+
+def test_user_message_drops_pending_touches(core):
+    core.process_touch("脑袋", "gentle")
+    core.start_chat("你好")
+    assert core.pending_touches == [] and not core.touch_timer.isActive()
+    assert [w.text for w in FakeChatWorker.started] == ["你好"]
+
+
+def test_touch_batch_waits_for_user_reply(core):
+    core.start_chat("你好")
+    core.process_touch("脑袋", "gentle")
+    core._flush_touches()
+    assert len(FakeChatWorker.started) == 1 and core.touch_timer.isActive()
+
+    FakeChatWorker.started[0].finish("你好呀")
+    core._flush_touches()
+    assert len(FakeChatWorker.started) == 2 and core.active_kind == "touch"
+
+
+def test_stop_cancels_reply_and_pending_touches(core):
+    interrupted = []
+    core.chat_interrupted.connect(lambda: interrupted.append(True))
+    assert core.cancel_chat() is False
+
+    core.start_chat("讲个长故事")
+    core.process_touch("脑袋", "gentle")
+    worker = FakeChatWorker.started[0]
+    assert core.cancel_chat() is True
+    assert worker.cancelled and interrupted == [True]
+    assert core.pending_touches == [] and core.active_worker is None
+    assert core.current_role_state == "idle"
+
+
+def test_stop_does_not_cancel_goodbye(core):
+    core.start_chat("你好")
+    core.active_kind = "goodbye"
+    assert core.cancel_chat() is False
+    assert not FakeChatWorker.started[0].cancelled
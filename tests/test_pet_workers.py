@@ -0,0 +1,143 @@
+import asyncio
+import threading
+
+import pytest
+
+from src import pet_workers
+from src.pet_workers import LLMTask, ActiveChatWorker, PrefetchSlot
+from src.parameters import PREFETCH_RETRY_BASE, PREFETCH_RETRY_MAX
+
+
+class FakeClient:
+    """compose_* 按 replies 依次返回，值为异常时抛出"""
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    def is_ready(self):
+        return True
+
+    def _next(self):
+        self.calls += 1
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    async def compose_goodbye(self, persona, stats):
+        return self._next()
+
+    async def compose_active_message(self, stats, persona):
+        return self._next(), {}
+
+
+class InlineWorker(ActiveChatWorker):
+    """在当前线程同步执行，信号直接投递到 PrefetchSlot"""
+    def start(self):
+        asyncio.run(self._guarded_run())
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(pet_workers.time, "time", clock.time)
+    return clock
+
+
+def _tick(slot, client, mode):
+    """模拟 _check_autonomous_actions：能预取就发一次请求"""
+    if slot.can_prefetch():
+        slot.start(InlineWorker(client, {}, "persona", mode=mode))
+
+
+def test_failing_goodbye_prefetch_backs_off(clock):
+    client = FakeClient(*[RuntimeError("boom")] * 5, "再见")
+    slot = PrefetchSlot("goodbye", lambda: "same", hourly_cap=6)
+
+    for _ in range(10):  # 10 个 tick 内只请求一次
+        _tick(slot, client, "prefetch_goodbye")
+        clock.now += 1
+    assert client.calls == 1 and slot.result is None and not slot.running()
+
+    clock.now = slot.retry_after
+    _tick(slot, client, "prefetch_goodbye")
+    assert client.calls == 2
+    assert slot.retry_after - clock.now == 2 * PREFETCH_RETRY_BASE
+
+
+def test_backoff_is_capped_and_reset_by_success(clock):
+    client = FakeClient(*[RuntimeError("boom")] * 6, "再见")
+    slot = PrefetchSlot("goodbye", lambda: "same", hourly_cap=100)
+    for _ in range(6):
+        clock.now = slot.retry_after
+        _tick(slot, client, "prefetch_goodbye")
+    assert slot.retry_after - clock.now == PREFETCH_RETRY_MAX
+
+    clock.now = slot.retry_after
+    _tick(slot, client, "prefetch_goodbye")
+    assert slot.failures == 0
+    assert slot.take() == ("再见", {})
+
+
+def test_failures_count_against_hourly_cap(clock):
+    client = FakeClient(*[RuntimeError("boom")] * 3)
+    slot = PrefetchSlot("goodbye", lambda: "same", hourly_cap=2)
+    for _ in range(2):
+        clock.now = slot.retry_after
+        _tick(slot, client, "prefetch_goodbye")
+    clock.now = slot.retry_after
+    assert not slot.can_prefetch()
+    clock.now += 3600
+    assert slot.can_prefetch()
+
+
+def test_empty_active_prefetch_backs_off(clock):
+    client = FakeClient("", "", "在干嘛呀")
+    slot = PrefetchSlot("active", lambda: "same", hourly_cap=6)
+    for _ in range(10):
+        _tick(slot, client, "prefetch")
+        clock.now += 1
+    assert client.calls == 1 and slot.failures == 1
+
+    clock.now = slot.retry_after
+    _tick(slot, client, "prefetch")
+    clock.now = slot.retry_after
+    _tick(slot, client, "prefetch")
+    assert client.calls == 3
+    assert slot.take() == ("在干嘛呀", {})
+
+
+def test_result_discarded_when_fingerprint_changes(clock):
+    fingerprint = ["a"]
+    slot = PrefetchSlot("active", lambda: fingerprint[0], hourly_cap=6)
+    _tick(slot, FakeClient("你好"), "prefetch")
+    fingerprint[0] = "b"
+    assert slot.take() is None
+    assert len(slot.discards) == 1 and slot.can_prefetch()
+
+
+def test_cancel_aborts_the_running_coroutine():
+    started, aborted = threading.Event(), threading.Event()
+
+    class HangingTask(LLMTask):
+        async def run(self):
+            started.set()
+            try:
+                await asyncio.sleep(60)  # 模拟一直没有响应的 HTTP 请求
+            except asyncio.CancelledError:
+                aborted.set()
+                raise
+
+    task = HangingTask()
+    task.start()
+    assert started.wait(5) and task.isRunning()
+    task.cancel()
+    assert aborted.wait(5) and not task.isRunning()
@@ -0,0 +1,71 @@
+import time
+
+from src.memory_utils import MemoryManager
+from src.vlm_utils import ResponseCache
+
+SETTINGS = {"response_cache": True, "cache_variety": 0.0, "cache_ttl": 60, "cache_max_entries": 2,
+            "cache_persist": True}
+
+
+def _cache(**overrides):
+    return ResponseCache(MemoryManager(), {**SETTINGS, **overrides})
+
+
+def test_key_buckets_stats_and_normalizes_whitespace():
+    key = ResponseCache.make_key("chat", "persona", "摸摸  头", {"mood": 41, "hunger": 5}, "Friend")
+    assert key == ResponseCache.make_key("chat", " persona ", "摸摸 头", {"mood": 59, "hunger": 19}, "Friend ")
+    assert key != ResponseCache.make_key("chat", "persona", "摸摸 头", {"mood": 61, "hunger": 5}, "Friend")
+    assert key != ResponseCache.make_key("intro", "persona", "摸摸 头", {"mood": 41, "hunger": 5}, "Friend")
+
+
+def test_store_lookup_and_stats():
+    cache = _cache()
+    assert cache.lookup("a") is None
+    cache.store("a", "你好", {"animate": "EMOTION_SING_HAPPY"})
+    assert cache.lookup("a") == ("你好", {"animate": "EMOTION_SING_HAPPY"})
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_variants_are_deduplicated_and_capped():
+    cache = _cache()
+    for reply in ["一", "二", "二", "三", "四"]:
+        cache.store("a", reply)
+    assert [v[0] for v in cache.entries["a"]["variants"]] == ["二", "三", "四"]
+
+
+def test_variety_forces_misses():
+    cache = _cache(cache_variety=1.0)
+    cache.store("a", "你好")
+    assert cache.lookup("a") is None
+    assert cache.peek("a") == ("你好", {})
+    assert cache.misses == 1 and cache.hits == 0
+
+
+def test_lru_eviction_and_ttl():
+    cache = _cache()
+    cache.store("a", "1")
+    cache.store("b", "2")
+    cache.lookup("a")
+    cache.store("c", "3")
+    assert list(cache.entries) == ["a", "c"]
+
+    cache.entries["a"]["updated"] = time.time() - 61
+    assert cache.lookup("a") is None
+    assert "a" not in cache.entries
+
+
+def test_persisted_entries_reload_without_expired_ones():
+    cache = _cache()
+    cache.store("a", "1")
+    cache.store("b", "2")
+    data = cache.memory_manager.load_response_cache()
+    data["a"]["updated"] = time.time() - 61
+    cache.memory_manager.save_response_cache(data)
+    assert list(_cache().entries) == ["b"]
+    assert list(_cache(cache_persist=False).entries) == []
+
+
+def test_disabled_cache_stores_nothing():
+    cache = _cache(response_cache=False)
+    cache.store("a", "1")
+    assert cache.lookup("a") is None and cache.entries == {}
@@ -0,0 +1,73 @@
+import pytest
+
+from src import token_utils
+from src.token_utils import (TokenBudgetWindow, count_tokens, count_message_tokens, get_context_limit,
+                             set_verbose, MESSAGE_OVERHEAD, REPLY_RESERVE, DEFAULT_CONTEXT_LIMIT)
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    set_verbose(False)
+    yield
+    set_verbose(False)
+
+
+def _history(n, text="一二三四五六七八九十"):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}{text}"} for i in range(n)]
+
+
+def test_context_limit_matches_most_specific_prefix():
+    assert get_context_limit("gpt-4o-mini") == 128000
+    assert get_context_limit("gpt-4-0613") == 8192
+    assert get_context_limit("openrouter/deepseek-chat") == 64000
+    assert get_context_limit("unknown-model") == DEFAULT_CONTEXT_LIMIT
+
+
+def test_count_tokens_is_zero_for_empty_and_grows_with_text():
+    assert count_tokens("") == 0
+    assert count_tokens("你好世界") > count_tokens("你好")
+    messages = [{"role": "user", "content": "你好"}, {"role": "assistant", "content": None}]
+    assert count_message_tokens(messages) == count_tokens("你好") + 2 * MESSAGE_OVERHEAD
+
+
+def test_budget_defaults_to_model_limit_minus_reply_reserve():
+    assert TokenBudgetWindow("chat", "gpt-4").budget == 8192 - REPLY_RESERVE
+    assert TokenBudgetWindow("chat", "gpt-4", budget=1000).budget == 1000
+    assert TokenBudgetWindow("chat", "gpt-4", budget=10 ** 6).budget == 8192 - REPLY_RESERVE
+
+
+def test_build_keeps_newest_history_within_budget():
+    history = _history(20)
+    per_message = count_tokens(history[-1]["content"]) + MESSAGE_OVERHEAD
+    fixed = count_message_tokens([{"content": "system"}, {"content": "input"}])
+    window = TokenBudgetWindow("chat", "gpt-4", budget=fixed + per_message * 5 + 1)
+
+    messages, kept = window.build("system", history, "input")
+    assert kept == history[-len(kept):]
+    assert 3 <= len(kept) <= 5
+    assert messages[0] == {"role": "system", "content": "system"}
+    assert messages[-1] == {"role": "user", "content": "input"}
+    assert window.last_prompt_tokens <= window.budget
+
+
+def test_fixed_messages_are_always_sent_even_over_budget():
+    window = TokenBudgetWindow("chat", "gpt-4", budget=1)
+    messages, kept = window.build("system", _history(4), "input")
+    assert kept == [] and len(messages) == 2
+
+
+def test_trim_uses_history_only():
+    history = _history(10)
+    per_message = count_tokens(history[-1]["content"]) + MESSAGE_OVERHEAD
+    window = TokenBudgetWindow("chat", "gpt-4", budget=per_message * 3)
+    assert window.trim(history) == history[-3:]
+
+
+def test_context_log_only_when_verbose(capsys):
+    window = TokenBudgetWindow("chat", "gpt-4", budget=1000)
+    window.build("system", _history(2), "input")
+    assert "[Context:chat]" not in capsys.readouterr().out
+    set_verbose(True)
+    window.build("system", _history(2), "input")
+    assert "[Context:chat]" in capsys.readouterr().out
+    assert token_utils.is_verbose()
@@ -0,0 +1,429 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src.vlm_utils import LLMClient
+from src.llm_scheduler import LatencyTracker
+
+
+def _client(hedge=True, delay=0.05):
+    client = SimpleNamespace(hedge_client=object() if hedge else None, hedge_base_url="https://hedge.example.com",
+                             hedge_percentile=90,
+                             latency={"stream": LatencyTracker(), "complete": LatencyTracker()})
+    for tracker in client.latency.values():
+        for _ in range(LatencyTracker.MIN_SAMPLES):
+            tracker.record(delay)
+    return client
+
+
+def _hedged(client, make_attempt, stream=False):
+    return asyncio.run(LLMClient._hedged(client, make_attempt, stream=stream))
+
+
+def test_fast_primary_failure_is_raised_without_hedging():
+    attempts = []
+
+    async def attempt(hedge, claim):
+        attempts.append(hedge)
+        raise RuntimeError("bad request")
+
+    with pytest.raises(RuntimeError):
+        _hedged(_client(), attempt)
+    assert attempts == [False]
+
+
+def test_slow_primary_is_hedged_and_first_token_wins():
+    attempts = []
+
+    async def attempt(hedge, claim):
+        attempts.append(hedge)
+        await asyncio.sleep(0.01 if hedge else 1.0)
+        return "hedge" if claim() else ""
+
+    assert _hedged(_client(), attempt, stream=True) == "hedge"
+    assert attempts == [False, True]
+
+
+def test_primary_that_already_streams_is_not_hedged():
+    attempts = []
+
+    async def attempt(hedge, claim):
+        attempts.append(hedge)
+        assert claim()
+        await asyncio.sleep(0.1)
+        return "primary"
+
+    assert _hedged(_client(), attempt, stream=True) == "primary"
+    assert attempts == [False]
+
+
+def test_stream_and_complete_latency_are_sampled_separately():
+    client = _client(hedge=False)
+
+    async def attempt(hedge, claim):
+        claim()
+        return "ok"
+
+    _hedged(client, attempt, stream=True)
+    assert len(client.latency["stream"].samples) == LatencyTracker.MIN_SAMPLES + 1
+    assert len(client.latency["complete"].samples) == LatencyTracker.MIN_SAMPLES
+
+
+@pytest.fixture
+def stub_settings():
+    from src.memory_utils import MemoryManager
+    manager = MemoryManager()
+    settings = manager.load_settings()
+    settings.update(llm_backend="stub", stub_latency=0.0, stub_token_delay=0.0)
+    manager.save_settings(settings)
+
+
+@pytest.fixture
+def sent_messages(monkeypatch):
+    from src import backend_utils
+    sent = []
+    create = backend_utils._StubCompletions.create
+
+    async def spy(self, model, messages, **kwargs):
+        sent.append(messages)
+        return await create(self, model, messages, **kwargs)
+
+    monkeypatch.setattr(backend_utils._StubCompletions, "create", spy)
+    return sent
+
+
+STATS = {"current_time": "2026年10月17日08点30分", "mood": 50, "intimacy": 0}
+
+
+def test_self_introduction_knows_the_time(stub_settings, sent_messages):
+    from src.vlm_utils import LLMClient
+    client = LLMClient()
+    reply, _ = asyncio.run(client.get_self_introduction("persona", STATS))
+    assert reply
+    assert STATS["current_time"] in sent_messages[-1][-1]["content"]
+
+
+def test_coder_turn_knows_the_time_but_history_keeps_raw_input(stub_settings, sent_messages):
+    from src.vlm_utils import CoderClient
+    client = CoderClient()
+    asyncio.run(client.chat("写一个函数", STATS, "persona"))
+    assert STATS["current_time"] in sent_messages[-1][-1]["content"]
+    assert client.coder_history[0] == {"role": "user", "content": "写一个函数"}
+
+
+def test_memory_writes_go_through_the_job_queue(stub_settings):
+    from src.vlm_utils import LLMClient
+    from src.job_utils import JobQueue, get_job_queue
+    client = LLMClient()
+
+    async def main():
+        task = client._save_memories(summary=" 聊了天 ", memorize="用户喜欢猫", relationship="Friend")
+        assert [job["kind"] for job in JobQueue().jobs.values()] == ["memory_write"]
+        await task
+
+    asyncio.run(main())
+    assert get_job_queue().jobs == {}
+    memories = client.memory_manager.load_long_term_memories()
+    assert memories[0] == "Relationship: Friend" and "用户喜欢猫" in memories
+    assert client.memory_manager.load_recent_memories()[-1]["summary"] == "聊了天"
+    assert client._save_memories(memorize="  ") is None
+
+
+def test_unfinished_memory_write_is_replayed_on_next_start(stub_settings):
+    from src.vlm_utils import LLMClient
+    from src.job_utils import get_job_queue
+    queue = get_job_queue()
+    queue.put("memory_write", "memory:crashed", {"memorize": "用户的生日是十月"})
+    client = LLMClient()
+    asyncio.run(client.run_jobs())
+    assert "用户的生日是十月" in client.memory_manager.load_long_term_memories()
+    assert queue.jobs == {}
+
+
+@pytest.mark.parametrize("text, role, reason", [
+    ("今天心情怎么样", "chat", "闲聊"),
+    ("/coder 你好", "coder", "手动指定"),
+    ("/chat def f(): pass", "chat", "手动指定"),
+    ("/CODER", "coder", "手动指定"),
+    ("/chatty 今天好无聊", "chat", "闲聊"),
+    ("/coderX 你好", "chat", "闲聊"),
+    ("看看这个\n```python\nprint(1)\n```", "coder", "代码块"),
+    ('Traceback (most recent call last):\n  File "a.py", line 1', "coder", "报错堆栈"),
+    ("KeyError: 'name' 是什么意思", "coder", "报错堆栈"),
+    ("x" * 400, "coder", "长输入"),
+    ("for (let i = 0; i < n; i++) {", "coder", "代码片段"),
+    ("帮我写一个排序函数", "coder", "编程任务"),
+    ("how do I write a regex for emails", "coder", "编程任务"),
+])
+def test_route_coder_turn(text, role, reason):
+    from src.vlm_utils import route_coder_turn
+    assert route_coder_turn(text)[:2] == (role, reason)
+
+
+def test_route_override_strips_prefix():
+    from src.vlm_utils import route_coder_turn
+    assert route_coder_turn("/chat  随便聊聊") == ("chat", "手动指定", "随便聊聊")
+
+
+def test_coder_client_route_respects_fixed_role_and_switch(stub_settings):
+    from src.vlm_utils import CoderClient
+    client = CoderClient()
+    assert client.route("你好", role="coder")[::2] == ("coder", "固定")
+    assert client.route("/chat 你好", role="coder")[::2] == ("chat", "手动指定")
+    client.routing = False
+    assert client.route("你好")[::2] == ("coder", "路由关闭")
+    assert client.route_counts == {"chat": 1, "coder": 2}
+
+
+def test_replayed_summary_job_is_not_stored_twice(stub_settings):
+    from src.vlm_utils import LLMClient
+    client = LLMClient()
+    payload = {"id": "memory:replayed", "summary": "聊了天", "memorize": "用户喜欢猫"}
+    asyncio.run(client.apply_memory_write(payload))
+    asyncio.run(client.apply_memory_write(payload))  # 写完但没来得及 complete 就崩溃，下次启动重放
+    assert [m["summary"] for m in client.memory_manager.load_recent_memories()] == ["聊了天"]
+    assert client.memory_manager.load_long_term_memories().count("用户喜欢猫") == 1
+
+
+def test_checkpoint_rewrites_jobs_only_when_session_grew(stub_settings, monkeypatch):
+    from src.vlm_utils import LLMClient
+    from src.job_utils import get_job_queue
+    client = LLMClient()
+    queue = get_job_queue()
+    puts = []
+    put = queue.put
+    monkeypatch.setattr(queue, "put", lambda *args, **kwargs: (puts.append(args[1]), put(*args, **kwargs)))
+
+    asyncio.run(client.checkpoint_session())
+    client.session_raw_history += ["User: 你好", "Pet: 你好呀"]
+    asyncio.run(client.checkpoint_session())
+    asyncio.run(client.checkpoint_session())
+    assert puts == [client._session_key()]
+    assert queue.jobs[client._session_key()]["payload"]["history"] == client.session_raw_history
+
+
+def _code(name, body="pass"):
+    return f"```python\ndef {name}():\n    {body}\n```"
+
+
+@pytest.mark.parametrize("content, keys, prose", [
+    ("只是聊天", [], "user: 只是聊天"),
+    (f"改好了 app.py:\n{_code('main')}", [["file:app.py"]], "user: 改好了 app.py:\n[代码块]"),
+    ("```\n# utils.py\nx = 1\n```", [["file:utils.py"]], "user: [代码块]"),
+    ("```python\nclass Bar:\n    pass\ndef foo():\n    pass\n```", [["sym:Bar", "sym:foo"]], "user: [代码块]"),
+    ("```js\nconsole.log(1)\n```", [[]], "user: [代码块]"),
+    ("没写完 ```python\ndef foo():\n    pass", [], "user: 没写完 ```python\ndef foo():\n    pass"),
+    (f"{_code('a')}\n然后\n{_code('b')}", [["sym:a"], ["sym:b"]], "user: [代码块]\n然后\n[代码块]"),
+])
+def test_split_code_blocks(content, keys, prose):
+    from src.vlm_utils import _split_code_blocks
+    transcript, blocks = _split_code_blocks([{"role": "user", "content": content}])
+    assert [block["keys"] for block in blocks] == keys
+    assert transcript == prose
+
+
+def _block(code, *keys):
+    return {"lang": "python", "code": code, "keys": sorted(keys)}
+
+
+@pytest.mark.parametrize("blocks, later, kept", [
+    # 同一文件改了两次，只留最后一版
+    ([_block("v1", "file:app.py"), _block("v2", "file:app.py")], [], ["v2"]),
+    # 最近几轮里又出现了，摘要里的版本作废
+    ([_block("v1", "file:app.py"), _block("util", "sym:util")], [_block("v2", "file:app.py")], ["util"]),
+    # 只被部分取代的代码块保留
+    ([_block("both", "sym:a", "sym:b"), _block("a2", "sym:a")], [], ["both", "a2"]),
+    # 没有名字的片段只留最近 KEEP_UNNAMED_BLOCKS (3) 个
+    ([_block(str(i)) for i in range(5)], [], ["2", "3", "4"]),
+    ([], [_block("v2", "file:app.py")], []),
+])
+def test_prune_superseded_blocks(blocks, later, kept):
+    from src.vlm_utils import _prune_superseded_blocks
+    assert [block["code"] for block in _prune_superseded_blocks(blocks, later)] == kept
+
+
+def _coder_turns(*codes):
+    history = []
+    for i, code in enumerate(codes):
+        history += [{"role": "user", "content": f"第{i}个问题"}, {"role": "assistant", "content": code}]
+    return history
+
+
+def test_compact_history_keeps_latest_code_and_recent_turns(stub_settings):
+    from src.vlm_utils import CoderClient
+    client = CoderClient()
+    client.coder_history = _coder_turns(f"app.py\n{_code('main', 'v1')}", f"app.py\n{_code('main', 'v2')}",
+                                        "好的", "好的", "好的")
+    recent = client.coder_history[-CoderClient.KEEP_RECENT_MESSAGES:]
+
+    before, after = asyncio.run(client.compact_history())
+    assert after < before
+    assert client.coder_history == recent
+    assert client.summary_text
+    assert [block["code"] for block in client.summary_blocks] == ["def main():\n    v2"]
+    assert not client.compacting
+
+
+def test_compact_history_under_budget_is_a_no_op(stub_settings):
+    from src.vlm_utils import CoderClient
+    client = CoderClient()
+    client.coder_history = _coder_turns("好的", "好的", "好的")
+    assert asyncio.run(client.compact_history()) is None
+    assert len(client.coder_history) == CoderClient.KEEP_RECENT_MESSAGES
+    assert client.summary_text == "" and not client.compacting
+
+
+def test_compact_history_falls_back_to_local_outline(stub_settings, monkeypatch):
+    from src import vlm_utils
+    from src.vlm_utils import CoderClient
+
+    async def unavailable(*args, **kwargs):
+        raise RuntimeError("offline")
+
+    monkeypatch.setattr(vlm_utils, "_create_completion", unavailable)
+    client = CoderClient()
+    client.coder_history = _coder_turns(_code("main"), "好的", "好的", "好的")
+    assert asyncio.run(client.compact_history())
+    assert "第0个问题" in client.summary_text
+    assert [block["keys"] for block in client.summary_blocks] == [["sym:main"]]
+
+
+def _finish(client, goodbye=None):
+    async def main():
+        result = await client.finish_session("persona", STATS, goodbye=goodbye)
+        await asyncio.gather(*client._memory_writes)
+        return result
+    return asyncio.run(main())
+
+
+def test_exit_makes_one_call_for_goodbye_summary_and_memories(stub_settings, sent_messages):
+    from src.vlm_utils import LLMClient
+    from src.backend_utils import STUB_SCRIPT
+    from src.job_utils import get_job_queue
+    client = LLMClient()
+    asyncio.run(client.chat("你好", STATS, "persona"))
+    session_id = client.session_id
+    sent_messages.clear()
+
+    assert _finish(client) == (STUB_SCRIPT["goodbye"], {})
+    assert len(sent_messages) == 1
+    assert client.memory_manager.load_recent_memories()[-1]["summary"] == STUB_SCRIPT["summary"]
+    assert get_job_queue().jobs == {}
+    assert client.session_length() == 0 and client.session_id != session_id
+
+
+def test_exit_keeps_prefetched_goodbye(stub_settings):
+    from src.vlm_utils import LLMClient
+    from src.backend_utils import STUB_SCRIPT
+    client = LLMClient()
+    asyncio.run(client.chat("你好", STATS, "persona"))
+    assert _finish(client, goodbye="早点睡哦") == ("早点睡哦", {})
+    assert client.memory_manager.load_recent_memories()[-1]["summary"] == STUB_SCRIPT["summary"]
+
+
+def test_exit_falls_back_to_standalone_summary(stub_settings, sent_messages, monkeypatch):
+    from src import vlm_utils
+    from src.vlm_utils import LLMClient
+    from src.backend_utils import STUB_SCRIPT
+    client = LLMClient()
+    asyncio.run(client.chat("你好", STATS, "persona"))
+    sent_messages.clear()
+    monkeypatch.setattr(vlm_utils, "parse_tag_json", lambda text, tag: {})  # 模型没按格式输出 <EXIT>
+
+    assert _finish(client) == ("拜拜！下次见！", {})
+    assert len(sent_messages) == 2
+    assert client.memory_manager.load_recent_memories()[-1]["summary"] == STUB_SCRIPT["summary"]
+    assert client.session_length() == 0
+
+
+def test_exit_without_conversation_only_says_goodbye(stub_settings):
+    from src.vlm_utils import LLMClient
+    client = LLMClient()
+    reply, _ = _finish(client)
+    assert reply
+    assert client.memory_manager.load_recent_memories() == []
+
+
+class StatusError(Exception):
+    def __init__(self, status):
+        super().__init__(f"status {status}")
+        self.status_code = status
+
+
+def _models_client(error=None):
+    async def list_models():
+        if error:
+            raise error
+        return []
+    return SimpleNamespace(models=SimpleNamespace(list=list_models))
+
+
+@pytest.mark.parametrize("error, state, ready", [
+    (None, "warm", True),
+    (StatusError(401), "rejected", False),
+    (StatusError(404), "warm", True),  # 不支持 models 接口，但连接已经建立
+    (OSError("connection refused"), "failed", True),  # 网络不通不影响发起对话
+])
+def test_warm_up_result_feeds_is_ready(stub_settings, monkeypatch, error, state, ready):
+    from src import vlm_utils
+    from src.vlm_utils import LLMClient
+    client = LLMClient()
+    assert client.needs_warm_up()
+    monkeypatch.setattr(vlm_utils, "requires_api_key", lambda: True)  # 真实后端才校验 Key
+    client.api_key = "sk-test-key"
+    client.client = _models_client(error)
+    asyncio.run(client.warm_up())
+    assert client.warm_state == state and bool(client.is_ready()) is ready
+    assert not client.needs_warm_up()
+
+
+def test_warm_up_result_is_dropped_when_config_changes_meanwhile(stub_settings):
+    from src.vlm_utils import LLMClient
+    client = LLMClient()
+
+    async def list_models():
+        client.base_url = "https://other.example.com"
+        return []
+
+    client.client = SimpleNamespace(models=SimpleNamespace(list=list_models))
+    asyncio.run(client.warm_up())
+    assert client.warm_state == "warming"
+
+
+def test_endpoint_change_requires_new_warm_up(stub_settings):
+    from src.vlm_utils import LLMClient
+    client = LLMClient()
+    asyncio.run(client.warm_up())
+    assert client.warm_state == "warm"
+    client.update_config({**client.memory_manager.load_settings(), "stream_reply": False})
+    assert client.warm_state == "warm"
+    client.update_config({**client.memory_manager.load_settings(), "base_url": "https://other.example.com/v1"})
+    assert client.needs_warm_up() and client.first_reply_pending
+
+
+def test_warm_up_covers_router_providers(stub_settings, monkeypatch):
+    from src.vlm_utils import LLMClient
+    from src.llm_router import get_router
+    client = LLMClient()
+    router = get_router()
+    router.configure({"base_url": "https://a.example.com", "api_key": "key-a", "model_name": "chat-a",
+                      "providers": [{"name": "B", "base_url": "https://b.example.com",
+                                     "models": {"chat": "chat-b"}}]})
+    warmed = []
+
+    def tracked(name, error=None):
+        async def list_models():
+            warmed.append(name)
+            if error:
+                raise error
+            return []
+        return SimpleNamespace(models=SimpleNamespace(list=list_models))
+
+    client.client = tracked("primary")
+    provider = tracked("B", StatusError(503))
+    # 默认线路与主线路共用同一个客户端，只预热一次
+    monkeypatch.setattr(router, "client_for", lambda e: client.client if e.name == "默认" else provider)
+    asyncio.run(client.warm_up())
+    assert sorted(warmed) == ["B", "primary"]
+    assert client.warm_state == "warm"